@@ -25,7 +25,7 @@ class BootSetup:
 
   __metaclass__ = abc.ABCMeta
 
-  def __init__(self, appName, version, localeDir, bootloader, targetPartition, isTest, useTestData):
+  def __init__(self, appName, version, localeDir, bootloader, targetPartition, isTest, useTestData, rescan = False):
     self._appName = appName
     self._version = version
     self._localeDir = localeDir
@@ -33,6 +33,7 @@ class BootSetup:
     self._targetPartition = targetPartition
     self._isTest = isTest
     self._useTestData = useTestData
+    self._rescan = rescan
     print "BootSetup v{ver}".format(ver = version)
   
   @abc.abstractmethod
@@ -63,13 +64,20 @@ def usage():
 {license}
 {author}
 
-  bootsetup.py [--help] [--version] [--test [--data]] [bootloader] [partition]
+  bootsetup.py [--help] [--version] [--rescan] [--test [--data]] [bootloader] [partition]
+  bootsetup.py --batch [--spec=FILE] [--mbr=DEVICE] [--entries=DEVICE:LABEL,…] [--dry-run] [--rescan] [--test [--data]] [bootloader] [partition]
 
 Parameters:
   --help: Show this help message
   --version: Show the BootSetup version
+  --rescan: Probe again every partition, ignoring the cached probes of previous runs
   --test: Run it in test mode
     --data: Run it with some pre-filled data
+  --batch: Install the bootloader without any user interface and write the result as JSON on stdout
+    --spec: JSON file with the bootloader, partition, mbr and entries, the other parameters override it
+    --mbr: Disk where the bootloader will be installed, the disk of the partition by default
+    --entries: LiLo boot menu entries in order, with their labels. Every operating system found by default
+    --dry-run: Only preview the configuration and compute the installation plan, nothing is installed
   bootloader: could be lilo or grub2, by default nothing is proposed. You could use "_" to tell it's undefined.
   partition: target partition to install the bootloader.
     The disk of that partition is, by default, where the bootloader will be installed
@@ -91,6 +99,10 @@ if __name__ == '__main__':
   is_graphic = bool(os.environ.get('DISPLAY'))
   is_test = False
   use_test_data = False
+  rescan = False
+  batch = False
+  batch_spec = {}
+  dry_run = False
   bootloader = None
   target_partition = None
   locale_dir = '/usr/share/locale'
@@ -103,6 +115,23 @@ if __name__ == '__main__':
       elif arg == '--version':
         print __version__
         sys.exit(0)
+      elif arg == '--rescan':
+        rescan = True
+      elif arg == '--batch':
+        batch = True
+      elif arg.startswith('--spec='):
+        from lib.bootsetup_batch import readBatchSpec
+        try:
+          batch_spec.update(readBatchSpec(arg[len('--spec='):]))
+        except (IOError, ValueError, KeyError) as e:
+          die(_("Cannot read the specification file: {0}").format(e))
+      elif arg.startswith('--mbr='):
+        batch_spec['mbr'] = arg[len('--mbr='):]
+      elif arg.startswith('--entries='):
+        from lib.bootsetup_batch import parseBatchEntries
+        batch_spec['entries'] = parseBatchEntries(arg[len('--entries='):])
+      elif arg == '--dry-run':
+        dry_run = True
       elif arg == '--test':
         is_test = True
         # relaod locale to the correct one for the tests
@@ -121,16 +150,23 @@ if __name__ == '__main__':
           target_partition = arg
         else:
           die(_("Unrecognized parameter '{0}'.").format(arg))
+  if batch:
+    bootloader = bootloader or batch_spec.get('bootloader')
+    target_partition = target_partition or batch_spec.get('partition')
   if not bootloader or bootloader not in ['lilo', 'grub2', '_']:
     die(_("bootloader parameter should be lilo, grub2 or '_', given {0}.").format(bootloader))
   if bootloader == '_':
     bootloader = None
   if target_partition and not os.path.exists(target_partition):
     die(_("Partition {0} not found.").format(target_partition))
-  if is_graphic:
+  if batch:
+    # neither gtk nor urwid are imported
+    from lib.bootsetup_batch import *
+    bootsetup = BootSetupBatch(__app__, __version__, locale_dir, bootloader, target_partition, is_test, use_test_data, rescan, mbrDevice = batch_spec.get('mbr'), entries = batch_spec.get('entries'), dryRun = dry_run)
+  elif is_graphic:
     from lib.bootsetup_gtk import *
-    bootsetup = BootSetupGtk(__app__, __version__, locale_dir, bootloader, target_partition, is_test, use_test_data)
+    bootsetup = BootSetupGtk(__app__, __version__, locale_dir, bootloader, target_partition, is_test, use_test_data, rescan)
   else:
     from lib.bootsetup_curses import *
-    bootsetup = BootSetupCurses(__app__, __version__, locale_dir, bootloader, target_partition, is_test, use_test_data)
+    bootsetup = BootSetupCurses(__app__, __version__, locale_dir, bootloader, target_partition, is_test, use_test_data, rescan)
   bootsetup.run_setup()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Unattended BootSetup.
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import re
+import sys
+import json
+import codecs
+import salix_livetools_library as sltl
+from bootsetup import *
+from config import *
+from lilo import *
+from grub2 import *
+
+def parseBatchEntries(spec):
+  """
+  Returns the list of (device, label or None) of a 'sda1:Salix,sda2:Windows' specification of the LiLo entries.
+  """
+  entries = []
+  for entry in spec.split(','):
+    if entry.strip():
+      (device, sep, label) = entry.strip().partition(':')
+      entries.append((device, label or None))
+  return entries
+
+def readBatchSpec(path):
+  """
+  Returns the specification of a batch installation read from the JSON file 'path', as a dictionary with the optional keys:
+    - bootloader: lilo or grub2
+    - partition: boot partition
+    - mbr: disk where the bootloader is installed
+    - entries: LiLo entries in order, as a list of {"device": …, "label": …} or as a 'sda1:Salix,sda2:Windows' string
+  """
+  with codecs.open(path, 'r', 'utf-8') as f:
+    spec = json.load(f)
+  entries = spec.get('entries')
+  if isinstance(entries, basestring):
+    spec['entries'] = parseBatchEntries(entries)
+  elif entries:
+    spec['entries'] = [(e['device'], e.get('label')) for e in entries]
+  return spec
+
+class BootSetupBatch(BootSetup):
+  """
+  Installs the bootloader without any UI, using Config, Lilo and Grub2 directly, and writes the result as JSON on stdout.
+  Everything else printed by BootSetup or by the commands it runs goes to stderr.
+  """
+
+  _liloMaxChars = 15
+  _mbrDevice = None
+  _entries = None
+  _dryRun = False
+  _output = None
+
+  def __init__(self, appName, version, localeDir, bootloader, targetPartition, isTest, useTestData, rescan = False, mbrDevice = None, entries = None, dryRun = False):
+    """
+    'entries' is the list of (device, label or None) of the LiLo entries, in order. All the boot partitions are used by default.
+    In dry run, the LiLo configuration is only previewed and the installation plan is only built.
+    """
+    sys.stdout.flush()
+    self._output = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    if isinstance(sys.stdout, file) and not sys.stdout.encoding: # not a terminal, but BootSetup prints unicode
+      sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
+    BootSetup.__init__(self, appName, version, localeDir, bootloader, targetPartition, isTest, useTestData, rescan)
+    self._mbrDevice = mbrDevice and re.sub(r'^/dev/', '', mbrDevice)
+    self._entries = entries
+    self._dryRun = dryRun
+
+  def info_dialog(self, message, title = None, parent = None):
+    if title:
+      message = "{0}: {1}".format(title, message)
+    sys.stderr.write((message + "\n").encode('utf-8'))
+
+  def error_dialog(self, message, title = None, parent = None):
+    self.info_dialog(message, title, parent)
+
+  def _defaultLabel(self, bootPartition):
+    """
+    Label of a boot partition, as proposed by the UIs: lilo does not like spaces.
+    """
+    label = re.sub(r'[()]', '', re.sub(r'_\(loader\)', '', re.sub(' ', '_', bootPartition[4])))
+    return label[0:self._liloMaxChars]
+
+  def _partitionRecord(self, device):
+    """
+    Returns the sltl.PartitionRecord of the partition, or None with the test data.
+    """
+    if self._useTestData:
+      return None
+    return sltl.getInventory()[1].get(device)
+
+  def _partitionDisk(self, device):
+    """
+    Returns the disk of the partition: nvme0n1 for nvme0n1p2, as the kernel names it.
+    """
+    record = self._partitionRecord(device)
+    if record:
+      return record.disk
+    return re.sub(r'^(.+?)[0-9]*$', r'\1', device) # sda1 of the test data
+
+  def _partitionFlags(self, device):
+    """
+    Returns the flags of the partition in the partition table of its disk ('boot', 'esp', ...), see sltl.getInventory.
+    """
+    record = self._partitionRecord(device)
+    return record and record.flags or frozenset()
+
+  def _firstLinuxPartition(self, devices, types, mbrDevice):
+    """
+    Returns the active linux partition of 'mbrDevice', else its first linux partition, or the first of any disk if there is none.
+    """
+    linux = [d for d in devices if types.get(d) == 'linux']
+    onDisk = [d for d in linux if self._partitionDisk(d) == mbrDevice]
+    active = [d for d in onDisk if 'boot' in self._partitionFlags(d)]
+    return (active + onDisk + linux + [None])[0]
+
+  def _liloPartitions(self, cfg):
+    """
+    Returns the LiLo partitions in the format of Lilo.createConfiguration: [device, filesystem, boot type, label].
+    """
+    known = dict([(p[0], p) for p in cfg.boot_partitions])
+    if self._entries:
+      partitions = []
+      for (device, label) in self._entries:
+        device = re.sub(r'^/dev/', '', device)
+        if device not in known:
+          raise Exception(_("{0} is not a bootable partition.").format(device))
+        p = known[device]
+        partitions.append([device, p[1], p[2], label or self._defaultLabel(p)])
+    else:
+      partitions = [[p[0], p[1], p[2], self._defaultLabel(p)] for p in cfg.boot_partitions]
+    labels = [p[3] for p in partitions]
+    for label in labels:
+      if not label or re.search(r'\s', label):
+        raise Exception(_("An Operating System label should not contain spaces.") + " [{0}]".format(label))
+      elif len(label) > self._liloMaxChars:
+        raise Exception(_("An Operating System label should not be more than {max} characters long.").format(max = self._liloMaxChars) + " [{0}]".format(label))
+      elif labels.count(label) > 1:
+        raise Exception(_("You have used the same label for different Operating Systems.") + " [{0}]".format(label))
+    return partitions
+
+  def _install(self, result):
+    if self._bootloader not in ('lilo', 'grub2'):
+      raise Exception(_("bootloader parameter should be lilo or grub2 in batch mode, given {0}.").format(self._bootloader))
+    cfg = Config(self._bootloader, self._targetPartition, self._isTest, self._useTestData, self._rescan)
+    result['disks'] = cfg.disks
+    result['partitions'] = cfg.partitions
+    result['bootPartitions'] = cfg.boot_partitions
+    mbrDevice = self._mbrDevice or cfg.cur_mbr_device
+    if not mbrDevice:
+      raise Exception(_("No disk found to install the bootloader on."))
+    result['mbrDevice'] = mbrDevice
+    types = dict([(p[0], p[2]) for p in cfg.boot_partitions])
+    if self._bootloader == 'lilo':
+      partitions = self._liloPartitions(cfg)
+      result['entries'] = [{'device':p[0], 'filesystem':p[1], 'bootType':p[2], 'label':p[3]} for p in partitions]
+      bootPartition = cfg.cur_boot_partition or self._firstLinuxPartition([p[0] for p in partitions], types, mbrDevice)
+      if not bootPartition:
+        raise Exception(_("Sorry, BootSetup is unable to find a Linux filesystem on your choosen boot entries, so cannot install LiLo.\n").strip())
+      result['bootPartition'] = bootPartition
+      lilo = Lilo(self._isTest)
+      if self._dryRun:
+        result['configuration'] = lilo.previewConfiguration(mbrDevice, bootPartition, partitions)
+      else:
+        lilo.createConfiguration(mbrDevice, bootPartition, partitions)
+        with codecs.open(lilo.getConfigurationPath(), 'r', 'utf-8') as f:
+          result['configuration'] = f.read()
+      plan = lilo.planInstall()
+    else:
+      bootPartition = cfg.cur_boot_partition or self._firstLinuxPartition([p[0] for p in cfg.boot_partitions], types, mbrDevice)
+      if not bootPartition:
+        raise Exception(_("No Linux partition found to install Grub2 from."))
+      result['bootPartition'] = bootPartition
+      plan = Grub2(self._isTest).planInstall(mbrDevice, bootPartition)
+    result['dryRun'] = self._dryRun
+    result['success'] = plan.execute(dryRun = self._dryRun)
+    result['steps'] = plan.steps
+    result['errors'].extend(plan.errors())
+
+  def run_setup(self):
+    result = {'bootloader':self._bootloader, 'success':False, 'errors':[]}
+    try:
+      if not (self._isTest and self._useTestData) and os.getuid() != 0:
+        raise Exception(_("Root privileges are required to run this program."))
+      self._install(result)
+    except Exception as e:
+      result['success'] = False
+      result['errors'].append(unicode(e))
+    self._output.write(json.dumps(result, indent = 2, sort_keys = True) + "\n")
+    self._output.flush()
+    sys.exit(0 if result['success'] else 1)
@@ -12,7 +12,10 @@ __license__ = 'GPL2+'
 import sys
 import re
 import codecs
+import threading
 import salix_livetools_library as sltl
+from osprober import *
+from probecache import *
 
 class Config:
   """
@@ -27,14 +30,28 @@ class Config:
   is_test = False
   use_test_data = False
   is_live = False
+  rescan = False
+  probe_timings = {}
+  discovered = False
+  _callback = None
+  _thread = None
   
-  def __init__(self, bootloader, target_partition, is_test, use_test_data):
+  def __init__(self, bootloader, target_partition, is_test, use_test_data, rescan = False, background = False):
+    """
+    If 'background' is True, nothing is gathered until start_discovery is called.
+    """
     self.cur_bootloader = bootloader
     self.cur_boot_partition = target_partition and re.sub(r'/dev/', '', target_partition) or ''
     self.cur_mbr_device = ''
     self.is_test = is_test
     self.use_test_data = use_test_data
-    self._get_current_config()
+    self.rescan = rescan
+    self.discovered = False
+    self.disks = []
+    self.partitions = []
+    self.boot_partitions = []
+    if not background:
+      self._get_current_config()
 
   def __debug(self, msg):
     if self.is_test:
@@ -42,11 +59,85 @@ class Config:
       with codecs.open("bootsetup.log", "a+", "utf-8") as fdebug:
         fdebug.write("Debug: {0}\n".format(msg))
 
-  def _get_current_config(self):
-    print 'Gathering current configuration…',
-    if self.is_test:
-      print ''
-    sys.stdout.flush()
+  def start_discovery(self, callback):
+    """
+    Gathers the configuration in a background thread.
+    'callback' is called from that thread for each discovered item, with one of these events:
+      - 'disk', row of disks
+      - 'partition', row of partitions
+      - 'boot_partition', row of boot_partitions, to be added by the UI with add_boot_partition
+      - 'progress', number of probed partitions, number of partitions
+      - 'error', message
+      - 'done'
+    The UI is responsible for handling them in its own thread.
+    """
+    self._thread = threading.Thread(target = self._discover, args = (callback,))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _discover(self, callback):
+    try:
+      self._get_current_config(callback)
+    except Exception as e:
+      self.__debug("Discovery failed: " + unicode(e))
+      self.discovered = True
+      callback('error', unicode(e))
+      callback('done')
+
+  def _notify(self, event, *args):
+    if self._callback:
+      self._callback(event, *args)
+
+  def _add_disk(self, row):
+    self.disks.append(row)
+    self._notify('disk', row)
+
+  def _add_partition(self, row):
+    self.partitions.append(row)
+    self._notify('partition', row)
+
+  def _add_boot_partition(self, row):
+    """
+    In background, boot_partitions is reordered and edited by the UI: the row is only added from the UI thread, when it handles the event.
+    """
+    if self._callback:
+      self._notify('boot_partition', row)
+    else:
+      self.add_boot_partition(row)
+
+  def add_boot_partition(self, row):
+    """
+    Adds the row to boot_partitions, unless its device is already there.
+    Returns True if it has been added.
+    """
+    if row[0] in [p[0] for p in self.boot_partitions]:
+      return False
+    self.boot_partitions.append(row)
+    return True
+
+  def _add_probes(self, probes):
+    for probe in probes:
+      probe = unicode(probe).strip() # ensure clean line
+      if not probe or probe[0] != '/':
+        continue
+      probe_info = probe.split(':')
+      probe_dev = re.sub(r'/dev/', '', probe_info[0])
+      probe_os = probe_info[1]
+      probe_label = probe_info[2]
+      probe_boottype = probe_info[3]
+      try:
+        probe_fstype = [p[1] for p in self.partitions if p[0] == probe_dev][0]
+      except IndexError:
+        probe_fstype = ''
+      self._add_boot_partition([probe_dev, probe_fstype, probe_boottype, probe_os, probe_label])
+
+  def _get_current_config(self, callback = None):
+    self._callback = callback
+    if not callback: # the UI shows the progress otherwise
+      print 'Gathering current configuration…',
+      if self.is_test:
+        print ''
+      sys.stdout.flush()
     if self.is_test:
       self.is_live = False
     else:
@@ -62,55 +153,81 @@ class Config:
             ['sdb1', 'fat32', 'Data (300GB)'],
             ['sdb2', 'ext4', 'Debian (50GB)']
           ]
-      self.boot_partitions = [
+      boot_partitions = [
             ['sda5', 'ext2', 'linux', 'Salix', 'Salix 14.0'],
             ['sda1', 'ntfs', 'chain', 'Windows', 'Vista'],
             ['sdb2', 'ext4', 'linux', 'Debian', 'Debian 7']
           ]
       if not self.cur_boot_partition:
         self.cut_boot_partition = 'sda5'
+      for row in self.disks:
+        self._notify('disk', row)
+      for row in self.partitions:
+        self._notify('partition', row)
+      self.boot_partitions = []
+      for row in boot_partitions:
+        self._add_boot_partition(row)
     else:
+      cache = ProbeCache()
+      if self.rescan:
+        cache.clear()
+      identities = {}
       self.disks = []
       self.partitions = []
+      self.boot_partitions = []
       for disk_device in sltl.getDisks():
         di = sltl.getDiskInfo(disk_device)
-        self.disks.append([disk_device, "{0} ({1})".format(di['model'], di['sizeHuman'])])
+        self._add_disk([disk_device, "{0} ({1})".format(di['model'], di['sizeHuman'])])
         for p in sltl.getPartitions(disk_device):
           pi = sltl.getPartitionInfo(p)
-          self.partitions.append([p, pi['fstype'], "{0} ({1})".format(pi['label'], pi['sizeHuman'])])
-      self.boot_partitions = []
-      probes = []
+          identities[p] = cache.identity(p, pi['fstype'])
+          self._add_partition([p, pi['fstype'], "{0} ({1})".format(pi['label'], pi['sizeHuman'])])
+      total = len(self.partitions)
+      self._notify('progress', 0, total)
+      prober = OsProber(self.is_test)
       if not self.is_live:
         # os-prober doesn't want to probe for /
         slashDevice = sltl.execGetOutput(r"readlink -f $(df / | tail -n 1 | cut -d' ' -f1)")[0]
-        slashFS = sltl.getFsType(re.sub(r'^/dev/', '', slashDevice))
+        slashFS = sltl.getFsType(re.sub(r'^/dev/', '', slashDevice)) or ''
         self.__debug("Root device {0} ({1})".format(slashDevice, slashFS))
-        self.__debug("/usr/lib/os-probes/mounted/90linux-distro " + slashDevice + " / " + slashFS)
-        slashDistro = sltl.execGetOutput(['/usr/lib/os-probes/mounted/90linux-distro', slashDevice, '/', slashFS])
-        if slashDistro:
-          probes = slashDistro
-      self.__debug("Probes: " + unicode(probes))
-      probes.extend(sltl.execGetOutput('/usr/sbin/os-prober', shell = False))
-      self.__debug("Probes: " + unicode(probes))
-      for probe in probes:
-        probe = unicode(probe).strip() # ensure clean line
-        if probe[0] != '/':
-          continue
-        probe_info = probe.split(':')
-        probe_dev = re.sub(r'/dev/', '', probe_info[0])
-        probe_os = probe_info[1]
-        probe_label = probe_info[2]
-        probe_boottype = probe_info[3]
-        try:
-          probe_fstype = [p[1] for p in self.partitions if p[0] == probe_dev][0]
-        except IndexError:
-          probe_fstype = ''
-        self.boot_partitions.append([probe_dev, probe_fstype, probe_boottype, probe_os, probe_label])
+        slashDistro = prober.probeRunningSystem(slashDevice, slashFS)
+        self.__debug("Probes: " + unicode(slashDistro))
+        self._add_probes(slashDistro)
+      if prober.isAvailable():
+        toProbe = [p for p in self.partitions if not cache.get(identities[p[0]])]
+        self.__debug("Partitions to probe: {0}, {1} from cache".format(unicode([p[0] for p in toProbe]), total - len(toProbe)))
+        probed = prober.iprobe(toProbe)
+        done = 0
+        for p in self.partitions:
+          dev = '/dev/' + p[0]
+          if p in toProbe:
+            probedPartition, newProbes = next(probed)
+            # keep only what follows the device, which could be renamed on next run
+            partProbes = [probe[len(dev):] for probe in newProbes if probe.startswith(dev) and probe[len(dev):len(dev) + 1] in (':', '@')]
+            cache.set(identities[p[0]], partProbes)
+          else:
+            partProbes = cache.get(identities[p[0]])['probes']
+          self.__debug("Probes: " + unicode(partProbes))
+          self._add_probes([dev + probe for probe in partProbes])
+          done += 1
+          self._notify('progress', done, total)
+        probed.close()
+        self.probe_timings = prober.timings
+        cache.save()
+      else:
+        probes = sltl.execGetOutput('/usr/sbin/os-prober', shell = False)
+        self.__debug("Probes: " + unicode(probes))
+        self._add_probes(probes)
+        self._notify('progress', total, total)
+    self.__debug("Commands: " + unicode(sltl.getExecStats()))
     if self.cur_boot_partition:
       # use the disk of that partition.
       self.cur_mbr_device = re.sub(r'^(.+?)[0-9]*$', r'\1', self.cur_boot_partition)
     elif len(self.disks) > 0:
       # use the first disk.
       self.cur_mbr_device = self.disks[0][0]
-    print ' Done'
-    sys.stdout.flush()
+    if not callback:
+      print ' Done'
+      sys.stdout.flush()
+    self.discovered = True
+    self._notify('done')
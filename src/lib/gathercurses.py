@@ -15,10 +15,12 @@ import urwid_more as urwidm
 import re
 import math
 import subprocess
+import Queue
 from config import *
 import salix_livetools_library as sltl
 from lilo import *
 from grub2 import *
+from mountsession import *
 
 class GatherCurses:
   """
@@ -57,23 +59,22 @@ class GatherCurses:
   _labelPerDevice = {}
   _lilo = None
   _grub2 = None
+  _mounts = None
   _editing = False
   _custom_lilo = False
   _grub2_cfg = False
   _liloMaxChars = 15
+  _discoveryEvents = None
+  _discoveryPipe = None
 
-  def __init__(self, bootsetup, version, bootloader = None, target_partition = None, is_test = False, use_test_data = False):
+  def __init__(self, bootsetup, version, bootloader = None, target_partition = None, is_test = False, use_test_data = False, rescan = False):
     self._bootsetup = bootsetup
     self._version = version
-    self.cfg = Config(bootloader, target_partition, is_test, use_test_data)
-    print """
-bootloader         = {bootloader}
-target partition   = {partition}
-MBR device         = {mbr}
-disks:{disks}
-partitions:{partitions}
-boot partitions:{boot_partitions}
-""".format(bootloader = self.cfg.cur_bootloader, partition = self.cfg.cur_boot_partition, mbr = self.cfg.cur_mbr_device, disks = "\n - " + "\n - ".join(map(" ".join, self.cfg.disks)), partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.partitions)), boot_partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.boot_partitions)))
+    self.cfg = Config(bootloader, target_partition, is_test, use_test_data, rescan, background = True)
+    # partitions stay mounted until BootSetup exits
+    self._mounts = MountSession(is_test)
+    self._discoveryEvents = Queue.Queue()
+    self._labelPerDevice = {}
     self.ui = urwidm.raw_display.Screen()
     self.ui.set_mouse_tracking()
     self._palette.extend(bootsetup._palette)
@@ -90,7 +91,58 @@ boot partitions:{boot_partitions}
     elif self.cfg.cur_bootloader == 'grub2':
       self._radioGrub2.set_state(True)
       self._mainView.body.set_focus(self._mbrDeviceSectionPosition)
+    # disks, partitions and operating systems are discovered while the UI is already shown
+    self._discoveryPipe = self._loop.watch_pipe(self._onDiscoveryPipe)
+    self.cfg.start_discovery(self._onDiscoveryEvent)
     self._loop.run()
+    self._printConfig()
+
+  def _printConfig(self):
+    print """
+bootloader         = {bootloader}
+target partition   = {partition}
+MBR device         = {mbr}
+disks:{disks}
+partitions:{partitions}
+boot partitions:{boot_partitions}
+""".format(bootloader = self.cfg.cur_bootloader, partition = self.cfg.cur_boot_partition, mbr = self.cfg.cur_mbr_device, disks = "\n - " + "\n - ".join(map(" ".join, self.cfg.disks)), partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.partitions)), boot_partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.boot_partitions)))
+
+  def _onDiscoveryEvent(self, event, *args):
+    """
+    Called from the discovery thread, the events are handled in the urwid loop by _onDiscoveryPipe.
+    """
+    self._discoveryEvents.put((event, args))
+    os.write(self._discoveryPipe, b'.')
+
+  def _onDiscoveryPipe(self, data):
+    while True:
+      try:
+        event, args = self._discoveryEvents.get_nowait()
+      except Queue.Empty:
+        break
+      if event == 'disk':
+        self._mbrComboBox.list = self._comboBoxItems(self.cfg.disks)
+      elif event == 'partition':
+        if self.cfg.cur_bootloader == 'grub2':
+          self._grub2ComboBox.list = self._comboBoxItems(self.cfg.partitions)
+      elif event == 'boot_partition':
+        # a table rebuilt from cfg.boot_partitions after this event was queued already has the row
+        if self.cfg.add_boot_partition(args[0]) and self.cfg.cur_bootloader == 'lilo':
+          for col, w in zip(self._liloTable.widget_list, self._createLiLoLine(args[0])):
+            col.contents.append((w, col.options()))
+          self._updateLiLoButtons()
+      elif event == 'progress':
+        done, total = args
+        self._txtDiscovery.set_text(_("Searching for operating systems… ({done}/{total})").format(done = done, total = total))
+      elif event == 'error':
+        self._errorDialog(args[0])
+      elif event == 'done':
+        self._txtDiscovery.set_text("")
+        self._btnInstall.sensitive = True
+        if self.cfg.cur_bootloader == 'grub2':
+          self._changeBootloaderSection()
+    self._updateScreen()
+    return True
   
   def _infoDialog(self, message):
     self._bootsetup.info_dialog(message, parent = self._loop.widget)
@@ -111,15 +163,18 @@ boot partitions:{boot_partitions}
     self._helpCtx = ''
     return True
 
+  def _comboBoxItems(self, elements):
+    return [urwidm.TextMultiValues(el) if isinstance(el, list) else el for el in elements]
+
   def _createComboBox(self, label, elements):
-    l = [urwidm.TextMultiValues(el) if isinstance(el, list) else el for el in elements]
+    l = self._comboBoxItems(elements)
     comboBox = urwidm.ComboBox(label, l)
     comboBox.set_combo_attrs('combobody', 'combofocus')
     comboBox.cbox.sensitive_attr = ('focusable', 'focus_combo')
     return comboBox
   
   def _createComboBoxEdit(self, label, elements):
-    l = [urwidm.TextMultiValues(el) if isinstance(el, list) else el for el in elements]
+    l = self._comboBoxItems(elements)
     comboBox = urwidm.ComboBoxEdit(label, l)
     comboBox.set_combo_attrs('combobody', 'combofocus')
     comboBox.cbox.sensitive_attr = ('focusable', 'focus_edit')
@@ -198,12 +253,15 @@ a boot menu if several operating systems are available on the same computer.")
     # bootloader section
     self._bootloaderSection = urwidm.WidgetPlaceholderMore(urwidm.Text(""))
     # install section
-    btnInstall = self._createButton(_("_Install bootloader").replace("_", ""), on_press = self._onInstall)
-    urwidm.connect_signal(btnInstall, 'focusgain', self._onHelpFocusGain, 'install')
-    urwidm.connect_signal(btnInstall, 'focuslost', self._onHelpFocusLost)
-    installSection = self._createCenterButtonsWidget([btnInstall])
+    self._btnInstall = self._createButton(_("_Install bootloader").replace("_", ""), on_press = self._onInstall)
+    self._btnInstall.sensitive = self.cfg.discovered
+    urwidm.connect_signal(self._btnInstall, 'focusgain', self._onHelpFocusGain, 'install')
+    urwidm.connect_signal(self._btnInstall, 'focuslost', self._onHelpFocusLost)
+    installSection = self._createCenterButtonsWidget([self._btnInstall])
+    # discovery progress
+    self._txtDiscovery = urwidm.Text(_("Searching for operating systems…"), align = "center")
     # body
-    bodyList = [urwidm.Divider(), txtIntro, urwidm.Divider('─', bottom = 1), bootloaderTypeSection, mbrDeviceSection, urwidm.Divider(), self._bootloaderSection, urwidm.Divider('─', top = 1, bottom = 1), installSection]
+    bodyList = [urwidm.Divider(), txtIntro, urwidm.Divider('─', bottom = 1), bootloaderTypeSection, mbrDeviceSection, urwidm.Divider(), self._bootloaderSection, urwidm.Divider('─', top = 1, bottom = 1), installSection, self._txtDiscovery]
     self._mbrDeviceSectionPosition = 4
     body = urwidm.ListBoxMore(urwidm.SimpleListWalker(bodyList))
     body.attr = 'body'
@@ -259,6 +317,7 @@ a boot menu if several operating systems are available on the same computer.")
 
   def _createMbrDeviceSectionView(self):
     comboBox = self._createComboBoxEdit(_("Install bootloader on:"), self.cfg.disks)
+    self._mbrComboBox = comboBox
     urwidm.connect_signal(comboBox, 'change', self._onMBRChange)
     urwidm.connect_signal(comboBox, 'focusgain', self._onHelpFocusGain, 'mbr')
     urwidm.connect_signal(comboBox, 'focuslost', self._onHelpFocusLost)
@@ -276,29 +335,9 @@ a boot menu if several operating systems are available on the same computer.")
       listAction = [urwidm.TextMore("")]
       for l in (listDev, listFS, listType, listLabel, listAction):
         l[0].sensitive_attr = 'strong'
-      self._labelPerDevice = {}
       for p in self.cfg.boot_partitions:
-        dev = p[0]
-        fs = p[1]
-        ostype = p[3]
-        label = re.sub(r'[()]', '', re.sub(r'_\(loader\)', '', re.sub(' ', '_', p[4]))) # lilo does not like spaces and pretty print the label
-        listDev.append(urwidm.TextMore(dev))
-        listFS.append(urwidm.TextMore(fs))
-        listType.append(urwidm.TextMore(ostype))
-        self._labelPerDevice[dev] = label
-        editLabel = self._createEdit(edit_text = label, wrap = urwidm.CLIP)
-        urwidm.connect_signal(editLabel, 'change', self._onLabelChange, dev)
-        urwidm.connect_signal(editLabel, 'focuslost', self._onLabelFocusLost, dev)
-        urwidm.connect_signal(editLabel, 'focusgain', self._onHelpFocusGain, 'lilotable')
-        urwidm.connect_signal(editLabel, 'focuslost', self._onHelpFocusLost)
-        listLabel.append(editLabel)
-        btnUp = self._createButton("↑", on_press = self._moveLineUp, user_data = p[0])
-        btnDown = self._createButton("↓", on_press = self._moveLineDown, user_data = p[0])
-        urwidm.connect_signal(btnUp, 'focusgain', self._onHelpFocusGain, 'liloup')
-        urwidm.connect_signal(btnUp, 'focuslost', self._onHelpFocusLost)
-        urwidm.connect_signal(btnDown, 'focusgain', self._onHelpFocusGain, 'lilodown')
-        urwidm.connect_signal(btnDown, 'focuslost', self._onHelpFocusLost)
-        listAction.append(urwidm.GridFlowMore([btnUp, btnDown], cell_width = 5, h_sep = 1, v_sep = 1, align = "center"))
+        for l, w in zip((listDev, listFS, listType, listLabel, listAction), self._createLiLoLine(p)):
+          l.append(w)
       colDev = urwidm.PileMore(listDev)
       colFS = urwidm.PileMore(listFS)
       colType = urwidm.PileMore(listType)
@@ -320,6 +359,7 @@ a boot menu if several operating systems are available on the same computer.")
       return pile
     elif self.cfg.cur_bootloader == 'grub2':
       comboBox = self._createComboBox(_("Install Grub2 files on:"), self.cfg.partitions)
+      self._grub2ComboBox = comboBox
       urwidm.connect_signal(comboBox, 'change', self._onGrub2FilesChange)
       urwidm.connect_signal(comboBox, 'focusgain', self._onHelpFocusGain, 'partition')
       urwidm.connect_signal(comboBox, 'focuslost', self._onHelpFocusLost)
@@ -327,11 +367,38 @@ a boot menu if several operating systems are available on the same computer.")
       urwidm.connect_signal(self._grub2BtnEdit, 'focusgain', self._onHelpFocusGain, 'grub2edit')
       urwidm.connect_signal(self._grub2BtnEdit, 'focuslost', self._onHelpFocusLost)
       pile = urwidm.PileMore([comboBox, self._createCenterButtonsWidget([self._grub2BtnEdit])])
-      self._onGrub2FilesChange(comboBox, comboBox.selected_item[0], None)
+      if self.cfg.discovered:
+        self._onGrub2FilesChange(comboBox, comboBox.selected_item[0], None)
+      else:
+        self._updateGrub2EditButton(False)
       return pile
     else:
       return urwidm.Text("")
 
+  def _createLiLoLine(self, p):
+    """
+    Returns the widgets of the LiLo table line for the boot partition 'p': device, file system, OS, label and actions.
+    A label already chosen for the device is kept.
+    """
+    dev = p[0]
+    fs = p[1]
+    ostype = p[3]
+    label = re.sub(r'[()]', '', re.sub(r'_\(loader\)', '', re.sub(' ', '_', p[4]))) # lilo does not like spaces and pretty print the label
+    label = self._labelPerDevice.setdefault(dev, label)
+    editLabel = self._createEdit(edit_text = label, wrap = urwidm.CLIP)
+    urwidm.connect_signal(editLabel, 'change', self._onLabelChange, dev)
+    urwidm.connect_signal(editLabel, 'focuslost', self._onLabelFocusLost, dev)
+    urwidm.connect_signal(editLabel, 'focusgain', self._onHelpFocusGain, 'lilotable')
+    urwidm.connect_signal(editLabel, 'focuslost', self._onHelpFocusLost)
+    btnUp = self._createButton("↑", on_press = self._moveLineUp, user_data = dev)
+    btnDown = self._createButton("↓", on_press = self._moveLineDown, user_data = dev)
+    urwidm.connect_signal(btnUp, 'focusgain', self._onHelpFocusGain, 'liloup')
+    urwidm.connect_signal(btnUp, 'focuslost', self._onHelpFocusLost)
+    urwidm.connect_signal(btnDown, 'focusgain', self._onHelpFocusGain, 'lilodown')
+    urwidm.connect_signal(btnDown, 'focuslost', self._onHelpFocusLost)
+    actions = urwidm.GridFlowMore([btnUp, btnDown], cell_width = 5, h_sep = 1, v_sep = 1, align = "center")
+    return (urwidm.TextMore(dev), urwidm.TextMore(fs), urwidm.TextMore(ostype), editLabel, actions)
+
   def _changeBootloaderSection(self):
     self._bootloaderSection.original_widget = self._createBootloaderSectionView()
 
@@ -418,7 +485,7 @@ click on this button to install your bootloader.")
       self.cfg.cur_bootloader = 'lilo'
       if self._grub2:
         self._grub2 = None
-      self._lilo = Lilo(self.cfg.is_test)
+      self._lilo = Lilo(self.cfg.is_test, self._mounts)
       self._changeBootloaderSection()
 
   def _onGrub2Change(self, radioGrub2, newState):
@@ -426,7 +493,7 @@ click on this button to install your bootloader.")
       self.cfg.cur_bootloader = 'grub2'
       if self._lilo:
         self._lilo = None
-      self._grub2 = Grub2(self.cfg.is_test)
+      self._grub2 = Grub2(self.cfg.is_test, self._mounts)
       self._changeBootloaderSection()
 
   def _isDeviceValid(self, device):
@@ -564,15 +631,12 @@ click on this button to install your bootloader.")
   def _updateGrub2EditButton(self, doTest = True):
     if doTest:
       partition = os.path.join("/dev", self.cfg.cur_boot_partition)
-      if sltl.isMounted(partition):
-        mp = sltl.getMountPoint(partition)
-        doumount = False
+      mp = self._mounts.acquire(partition)
+      if mp:
+        self._grub2_conf = os.path.exists(os.path.join(mp, "etc/default/grub"))
+        self._mounts.release(partition)
       else:
-        mp = sltl.mountDevice(partition)
-        doumount = True
-      self._grub2_conf = os.path.exists(os.path.join(mp, "etc/default/grub"))
-      if doumount:
-        sltl.umountDevice(mp)
+        self._grub2_conf = False
     else:
       self._grub2_conf = False
     self._grub2BtnEdit.sensitive = self._grub2_conf
@@ -580,12 +644,9 @@ click on this button to install your bootloader.")
   
   def _editGrub2Conf(self, button):
     partition = os.path.join("/dev", self.cfg.cur_boot_partition)
-    if sltl.isMounted(partition):
-      mp = sltl.getMountPoint(partition)
-      doumount = False
-    else:
-      mp = sltl.mountDevice(partition)
-      doumount = True
+    mp = self._mounts.acquire(partition)
+    if not mp:
+      return
     grub2cfg = os.path.join(mp, "etc/default/grub")
     launched = False
     for editor in ('vim', 'nano'):
@@ -597,17 +658,23 @@ click on this button to install your bootloader.")
         pass
     if not launched:
       self._errorDialog(_("Sorry, BootSetup is unable to find a suitable text editor in your system. You will not be able to manually modify the Grub2 default configuration.\n"))
-    if doumount:
-      sltl.umountDevice(mp)
+    self._mounts.release(partition)
 
   def _onInstall(self, btnInstall):
     if self.cfg.cur_bootloader == 'lilo':
       if not os.path.exists(self._lilo.getConfigurationPath()):
         self._create_lilo_config()
-      self._lilo.install()
+      ok = self._lilo.install()
+      errors = self._lilo.getInstallErrors()
     elif self.cfg.cur_bootloader == 'grub2':
-      self._grub2.install(self.cfg.cur_mbr_device, self.cfg.cur_boot_partition)
-    self.installation_done()
+      ok = self._grub2.install(self.cfg.cur_mbr_device, self.cfg.cur_boot_partition)
+      errors = self._grub2.getInstallErrors()
+    else:
+      return
+    if ok:
+      self.installation_done()
+    else:
+      self._errorDialog(_("The bootloader installation failed.") + "\n\n" + "\n".join(errors))
 
   def installation_done(self):
     print "Bootloader Installation Done."
@@ -620,5 +687,6 @@ click on this button to install your bootloader.")
       del self._lilo
     if self._grub2:
       del self._grub2
+    self._mounts.close()
     print "Bye _o/"
     raise urwidm.ExitMainLoop()
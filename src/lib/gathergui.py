@@ -20,6 +20,7 @@ from config import *
 import salix_livetools_library as sltl
 from lilo import *
 from grub2 import *
+from mountsession import *
 
 class GatherGui:
   """
@@ -28,20 +29,15 @@ class GatherGui:
   
   _lilo = None
   _grub2 = None
+  _mounts = None
   _editing = False
   _custom_lilo = False
 
-  def __init__(self, bootsetup, version, bootloader = None, target_partition = None, is_test = False, use_test_data = False):
+  def __init__(self, bootsetup, version, bootloader = None, target_partition = None, is_test = False, use_test_data = False, rescan = False):
     self._bootsetup = bootsetup
-    self.cfg = Config(bootloader, target_partition, is_test, use_test_data)
-    print """
-bootloader         = {bootloader}
-target partition   = {partition}
-MBR device         = {mbr}
-disks:{disks}
-partitions:{partitions}
-boot partitions:{boot_partitions}
-""".format(bootloader = self.cfg.cur_bootloader, partition = self.cfg.cur_boot_partition, mbr = self.cfg.cur_mbr_device, disks = "\n - " + "\n - ".join(map(" ".join, self.cfg.disks)), partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.partitions)), boot_partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.boot_partitions)))
+    self.cfg = Config(bootloader, target_partition, is_test, use_test_data, rescan, background = True)
+    # partitions stay mounted until BootSetup exits
+    self._mounts = MountSession(is_test)
     builder = gtk.Builder()
     for d in ('./resources', '../resources'):
       if os.path.exists(d + '/bootsetup.glade'):
@@ -82,6 +78,7 @@ boot partitions:{boot_partitions}
     self.PartitionListStore = builder.get_object("boot_partition_list_store")
     self.BootPartitionListStore = builder.get_object("boot_bootpartition_list_store")
     self.BootLabelListStore = builder.get_object("boot_label_list_store")
+    self.DiscoveryProgressBar = builder.get_object("discovery_progressbar")
     # Initialize the contextual help box
     self.context_intro = _("<b>BootSetup will install a new bootloader on your computer.</b> \n\
 \n\
@@ -96,9 +93,54 @@ a boot menu if several operating systems are available on the same computer.")
   def run(self):
     # indicates to gtk (and gdk) that we will use threads
     gtk.gdk.threads_init()
+    # disks, partitions and operating systems are discovered while the window is already shown
+    self.cfg.start_discovery(self.on_discovery_event)
     # start the main gtk loop
     gtk.main()
 
+  def on_discovery_event(self, event, *args):
+    """
+    Called from the discovery thread, the stores are only updated in the gtk thread.
+    """
+    self.update_gui_async(self._apply_discovery_event, event, *args)
+
+  def _apply_discovery_event(self, event, *args):
+    if event == 'disk':
+      self.DiskListStore.append(args[0])
+    elif event == 'partition':
+      self.PartitionListStore.append(args[0])
+    elif event == 'boot_partition':
+      if self.cfg.add_boot_partition(args[0]):
+        self.BootPartitionListStore.append(self._boot_partition_row(args[0]))
+    elif event == 'progress':
+      done, total = args
+      if total:
+        self.DiscoveryProgressBar.set_fraction(float(done) / total)
+        self.DiscoveryProgressBar.set_text(_("Searching for operating systems… ({done}/{total})").format(done = done, total = total))
+    elif event == 'error':
+      self._bootsetup.error_dialog(args[0])
+    elif event == 'done':
+      self.DiscoveryProgressBar.hide()
+      # keep what the user already chose while the discovery was running
+      for entry, attr in ((self.ComboBoxMbrEntry, 'cur_mbr_device'), (self.ComboBoxPartitionEntry, 'cur_boot_partition')):
+        if entry.get_text():
+          setattr(self.cfg, attr, entry.get_text())
+        else:
+          entry.set_text(getattr(self.cfg, attr))
+      self._print_config()
+    self.update_buttons()
+    return False # only once for gobject.idle_add
+
+  def _print_config(self):
+    print """
+bootloader         = {bootloader}
+target partition   = {partition}
+MBR device         = {mbr}
+disks:{disks}
+partitions:{partitions}
+boot partitions:{boot_partitions}
+""".format(bootloader = self.cfg.cur_bootloader, partition = self.cfg.cur_boot_partition, mbr = self.cfg.cur_mbr_device, disks = "\n - " + "\n - ".join(map(" ".join, self.cfg.disks)), partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.partitions)), boot_partitions = "\n - " + "\n - ".join(map(" ".join, self.cfg.boot_partitions)))
+
   def _add_combobox_cell_renderer(self, comboBox, modelPosition, start=False, expand=False, padding=0):
     cell = gtk.CellRendererText()
     cell.set_property('xalign', 0)
@@ -200,11 +242,7 @@ click on this button to install your bootloader."))
     for p in self.cfg.partitions: # for grub2
       self.PartitionListStore.append(p)
     for p in self.cfg.boot_partitions: # for lilo
-      p2 = list(p) # copy p
-      del p2[2] # discard boot type
-      p2[3] = re.sub(r'[()]', '', re.sub(r'_\(loader\)', '', re.sub(' ', '_', p2[3]))) # lilo does not like spaces and pretty print the label
-      p2.append('gtk-edit') # add a visual
-      self.BootPartitionListStore.append(p2)
+      self.BootPartitionListStore.append(self._boot_partition_row(p))
     self.ComboBoxMbrEntry.set_text(self.cfg.cur_mbr_device)
     self.ComboBoxPartitionEntry.set_text(self.cfg.cur_boot_partition)
     self.LabelCellRendererCombo.set_property("model", self.BootLabelListStore)
@@ -214,6 +252,13 @@ click on this button to install your bootloader."))
     print ' Done'
     sys.stdout.flush()
 
+  def _boot_partition_row(self, p):
+    p2 = list(p) # copy p
+    del p2[2] # discard boot type
+    p2[3] = re.sub(r'[()]', '', re.sub(r'_\(loader\)', '', re.sub(' ', '_', p2[3]))) # lilo does not like spaces and pretty print the label
+    p2.append('gtk-edit') # add a visual
+    return p2
+
   # What to do when BootSetup logo is clicked
   def on_about_button_clicked(self, widget, data=None):
     self.AboutDialog.show()
@@ -229,6 +274,7 @@ click on this button to install your bootloader."))
       del self._lilo
     if self._grub2:
       del self._grub2
+    self._mounts.close()
     print "Bye _o/"
     gtk.main_quit()
 
@@ -248,14 +294,14 @@ click on this button to install your bootloader."))
         self.cfg.cur_bootloader = 'lilo'
         if self._grub2:
           self._grub2 = None
-        self._lilo = Lilo(self.cfg.is_test)
+        self._lilo = Lilo(self.cfg.is_test, self._mounts)
         self.LiloPart.show()
         self.Grub2Part.hide()
       else:
         self.cfg.cur_bootloader = 'grub2'
         if self._lilo:
           self._lilo = None
-        self._grub2 = Grub2(self.cfg.is_test)
+        self._grub2 = Grub2(self.cfg.is_test, self._mounts)
         self.LiloPart.hide()
         self.Grub2Part.show()
       self.update_buttons()
@@ -397,46 +443,40 @@ click on this button to install your bootloader."))
   
   def on_grub2_edit_button_clicked(self, widget, data=None):
     partition = os.path.join("/dev", self.cfg.cur_boot_partition)
-    if sltl.isMounted(partition):
-      mp = sltl.getMountPoint(partition)
-      doumount = False
-    else:
-      mp = sltl.mountDevice(partition)
-      doumount = True
-    grub2cfg = os.path.join(mp, "etc/default/grub")
-    if os.path.exists(grub2cfg):
-      try:
-        sltl.execCall(['xdg-open', grub2cfg], shell=False, env=None)
-      except:
-        self._bootsetup.error_dialog(_("Sorry, BootSetup is unable to find a suitable text editor in your system. You will not be able to manually modify the Grub2 default configuration.\n"))
-    if doumount:
-      sltl.umountDevice(mp)
+    mp = self._mounts.acquire(partition)
+    if mp:
+      grub2cfg = os.path.join(mp, "etc/default/grub")
+      if os.path.exists(grub2cfg):
+        try:
+          sltl.execCall(['xdg-open', grub2cfg], shell=False, env=None)
+        except:
+          self._bootsetup.error_dialog(_("Sorry, BootSetup is unable to find a suitable text editor in your system. You will not be able to manually modify the Grub2 default configuration.\n"))
+      self._mounts.release(partition)
 
   def update_buttons(self):
     install_ok = False
     multiple = False
     grub2_edit_ok = False
-    if self.cfg.cur_mbr_device and os.path.exists("/dev/{0}".format(self.cfg.cur_mbr_device)) and sltl.getDiskInfo(self.cfg.cur_mbr_device):
-      if self.cfg.cur_bootloader == 'lilo' and not self._editing:
+    # only use the devices already discovered
+    known_disk = self.cfg.cur_mbr_device in [d[0] for d in self.cfg.disks]
+    known_partition = self.cfg.cur_boot_partition in [p[0] for p in self.cfg.partitions]
+    if known_disk and os.path.exists("/dev/{0}".format(self.cfg.cur_mbr_device)) and sltl.getDiskInfo(self.cfg.cur_mbr_device):
+      # lilo needs every operating system to be found
+      if self.cfg.cur_bootloader == 'lilo' and not self._editing and self.cfg.discovered:
         if len(self.BootPartitionListStore) > 1:
           multiple = True
         for bp in self.BootPartitionListStore:
           if bp[4] == "gtk-yes":
             install_ok = True
       elif self.cfg.cur_bootloader == 'grub2':
-        if self.cfg.cur_boot_partition and os.path.exists("/dev/{0}".format(self.cfg.cur_boot_partition)) and sltl.getPartitionInfo(self.cfg.cur_boot_partition):
+        if known_partition and os.path.exists("/dev/{0}".format(self.cfg.cur_boot_partition)) and sltl.getPartitionInfo(self.cfg.cur_boot_partition):
           install_ok = True
         if install_ok:
           partition = os.path.join("/dev", self.cfg.cur_boot_partition)
-          if sltl.isMounted(partition):
-            mp = sltl.getMountPoint(partition)
-            doumount = False
-          else:
-            mp = sltl.mountDevice(partition)
-            doumount = True
-          grub2_edit_ok = os.path.exists(os.path.join(mp, "etc/default/grub"))
-          if doumount:
-            sltl.umountDevice(mp)
+          mp = self._mounts.acquire(partition)
+          if mp:
+            grub2_edit_ok = os.path.exists(os.path.join(mp, "etc/default/grub"))
+            self._mounts.release(partition)
     self.RadioLilo.set_sensitive(not self._editing)
     self.RadioGrub2.set_sensitive(not self._editing)
     self.ComboBoxMbr.set_sensitive(not self._editing)
@@ -452,10 +492,17 @@ click on this button to install your bootloader."))
     if self.cfg.cur_bootloader == 'lilo':
       if not os.path.exists(self._lilo.getConfigurationPath()):
         self._create_lilo_config()
-      self._lilo.install()
+      ok = self._lilo.install()
+      errors = self._lilo.getInstallErrors()
     elif self.cfg.cur_bootloader == 'grub2':
-      self._grub2.install(self.cfg.cur_mbr_device, self.cfg.cur_boot_partition)
-    self.installation_done()
+      ok = self._grub2.install(self.cfg.cur_mbr_device, self.cfg.cur_boot_partition)
+      errors = self._grub2.getInstallErrors()
+    else:
+      return
+    if ok:
+      self.installation_done()
+    else:
+      self._bootsetup.error_dialog(_("The bootloader installation failed.") + "\n\n" + "\n".join(errors))
 
   def installation_done(self):
     print "Bootloader Installation Done."
@@ -14,6 +14,8 @@ import os
 import sys
 import codecs
 import salix_livetools_library as sltl
+from mountsession import *
+from plan import *
 
 class Grub2:
   
@@ -21,10 +23,16 @@ class Grub2:
   _prefix = None
   _tmp = None
   _bootInBootMounted = False
-  _procInBootMounted = False
+  _mounts = None
+  _bootPartition = None
   
-  def __init__(self, isTest):
+  def __init__(self, isTest, mountSession = None):
+    """
+    'mountSession' is the MountSession shared with the UI, if not specified the partition is unmounted after the installation.
+    """
     self.isTest = isTest
+    self._mounts = mountSession or MountSession(isTest, persistent = False)
+    self._installErrors = []
     self._prefix = "bootsetup.grub2-"
     self._tmp = tempfile.mkdtemp(prefix = self._prefix)
     sltl.mounting._tempMountDir = os.path.join(self._tmp, 'mounts')
@@ -53,98 +61,104 @@ class Grub2:
     Return the mount point
     """
     self.__debug("bootPartition = " + bootPartition)
-    if sltl.isMounted(bootPartition):
-      self.__debug("bootPartition already mounted")
-      return sltl.getMountPoint(bootPartition)
-    else:
-      self.__debug("bootPartition not mounted")
-      return sltl.mountDevice(bootPartition)
+    self._bootPartition = bootPartition
+    return self._mounts.acquire(bootPartition)
+
+  def _releaseBootPartition(self, bootPartition):
+    self.__debug("release main partition " + bootPartition)
+    self._mounts.release(bootPartition)
+    return True
 
   def _mountBootInBootPartition(self, mountPoint):
-    # assume that if the mount_point is /, any /boot directory is already accessible/mounted
-    if mountPoint != '/' and os.path.exists(os.path.join(mountPoint, 'etc/fstab')):
+    """
+    Mounts /boot if it is declared in the fstab of the partition. Nothing to mount is not an error.
+    """
+    self._bootInBootMounted = False
+    if os.path.exists(os.path.join(mountPoint, 'etc/fstab')):
       self.__debug("mp != / and etc/fstab exists, will try to mount /boot by chrooting")
       try:
         self.__debug("grep -q /boot {mp}/etc/fstab && chroot {mp} /sbin/mount /boot".format(mp = mountPoint))
-        if sltl.execCall("grep -q /boot {mp}/etc/fstab && chroot {mp} /sbin/mount /boot".format(mp = mount_point)):
-          self.__debug("/boot mounted in " + mp)
+        if sltl.execCall("grep -q /boot {mp}/etc/fstab && chroot {mp} /sbin/mount /boot".format(mp = mountPoint)) == 0:
+          self.__debug("/boot mounted in " + mountPoint)
           self._bootInBootMounted = True
       except:
         pass
+    return True
 
-  def _bindProcSysDev(self, mountPoint):
-    """
-    bind /proc /sys and /dev into the boot partition
-    """
-    if mountPoint != "/":
-      self.__debug("mount point ≠ / so mount /dev, /proc and /sys in " + mountPoint)
-      self._procInBootMounted = True
-      sltl.execCall('mount -o bind /dev {mp}/dev'.format(mp = mountPoint))
-      sltl.execCall('mount -o bind /proc {mp}/proc'.format(mp = mountPoint))
-      sltl.execCall('mount -o bind /sys {mp}/sys'.format(mp = mountPoint))
-
-  def _unbindProcSysDev(self, mountPoint):
-    """
-    unbind /proc /sys and /dev into the boot partition
-    """
-    if self._procInBootMounted:
-      self.__debug("mount point ≠ / so umount /dev, /proc and /sys in " + mountPoint)
-      sltl.execCall('umount {mp}/dev'.format(mp = mountPoint))
-      sltl.execCall('umount {mp}/proc'.format(mp = mountPoint))
-      sltl.execCall('umount {mp}/sys'.format(mp = mountPoint))
+  def _umountBootInBootPartition(self, mountPoint):
+    if self._bootInBootMounted:
+      self.__debug("/boot mounted in " + mountPoint + ", so umount it")
+      sltl.execCall("chroot {mp} /sbin/umount /boot".format(mp = mountPoint))
+      self._bootInBootMounted = False
+    return True
 
-  def _copyAndInstallGrub2(self, mountPoint, device):
-    if self.isTest:
-      self.__debug("/usr/sbin/grub-install --boot-directory {bootdir} --no-floppy {dev}".format(bootdir = os.path.join(mountPoint, "boot"), dev = device))
-      return True
-    else:
-      return sltl.execCall("/usr/sbin/grub-install --boot-directory {bootdir} --no-floppy {dev}".format(bootdir = os.path.join(mountPoint, "boot"), dev = device))
+  def _bind(self, source, target):
+    return sltl.execCall('mount -o bind {src} {dst}'.format(src = source, dst = target)) == 0
+
+  def _umount(self, target):
+    sltl.execCall('umount {dst}'.format(dst = target))
+    return True
+
+  def _installGrub2(self, mountPoint, device):
+    return sltl.execCall("/usr/sbin/grub-install --boot-directory {bootdir} --no-floppy {dev}".format(bootdir = os.path.join(mountPoint, "boot"), dev = device)) == 0
 
   def _installGrub2Config(self, mountPoint):
     if os.path.exists(os.path.join(mountPoint, 'etc/default/grub')) and os.path.exists(os.path.join(mountPoint, 'usr/sbin/update-grub')):
       self.__debug("grub2 package is installed on the target partition, so it will be used to generate the grub.cfg file")
       # assume everything is installed on the target partition, grub2 package included.
-      if self.isTest:
-        self.__debug("chroot {mp} /usr/sbin/update-grub".format(mp = mountPoint))
-      else:
-        sltl.execCall("chroot {mp} /usr/sbin/update-grub".format(mp = mountPoint))
+      return sltl.execCall("chroot {mp} /usr/sbin/update-grub".format(mp = mountPoint)) == 0
     else:
       self.__debug("grub2 not installed on the target partition, so grub_mkconfig will directly be used to generate the grub.cfg file")
       # tiny OS installed on that mount point, so we cannot chroot on it to install grub2 config.
-      if self.isTest:
-        self.__debug("/usr/sbin/grub-mkconfig -o {cfg}".format(cfg = os.path.join(mountPoint, "boot/grub/grub.cfg")))
-      else:
-        sltl.execCall("/usr/sbin/grub-mkconfig -o {cfg}".format(cfg = os.path.join(mountpoint, "boot/grub/grub.cfg")))
-
-  def _umountAll(self, mountPoint):
-    self.__debug("umountAll")
-    if mountPoint:
-      self.__debug("umounting main mount point " + mountPoint)
-      self._unbindProcSysDev(mountPoint)
-      if self._bootInBootMounted:
-        self.__debut("/boot mounted in " + mountPoint + ", so umount it")
-        sltl.execCall("chroot {mp} /sbin/umount /boot".format(mp = mountPoint))
-      if mountPoint != '/':
-        self.__debug("umain mount point ≠ '/' → umount " + mountPoint)
-        sltl.umountDevice(mountPoint)
-    self._bootInBootMounted = False
-    self._procInBootMounted = False
+      return sltl.execCall("/usr/sbin/grub-mkconfig -o {cfg}".format(cfg = os.path.join(mountPoint, "boot/grub/grub.cfg"))) == 0
 
-  def install(self, mbrDevice, bootPartition):
+  def planInstall(self, mbrDevice, bootPartition):
+    """
+    Returns the Plan of the installation of Grub2 on 'mbrDevice' from 'bootPartition', nothing is done before it is executed.
+    In test mode, grub-install and the generation of grub.cfg are only described.
+    """
     mbrDevice = os.path.join("/dev", mbrDevice)
     bootPartition = os.path.join("/dev", bootPartition)
     self.__debug("mbrDevice = " + mbrDevice)
     self.__debug("bootPartition = " + bootPartition)
+    plan = Plan(self.isTest)
+    mp = self._mounts.plannedMountPoint(bootPartition)
+    self.__debug("mp = " + unicode(mp))
+    mount = plan.add('mount', "Mount {0} on {1}".format(bootPartition, mp), lambda: self._mountBootPartition(bootPartition), args = {'device':bootPartition, 'mountPoint':mp}, failure = "Cannot mount {0}".format(bootPartition))
+    plan.add('release', "Release {0}".format(bootPartition), lambda: self._releaseBootPartition(bootPartition), args = {'device':bootPartition}, dependsOn = [mount], cleanup = True)
+    # assume that if the mount point is /, any /boot directory is already accessible/mounted
+    if mp != '/':
+      boot = plan.add('mount', "Mount /boot in {0} if it is in its fstab".format(mp), lambda: self._mountBootInBootPartition(mp), args = {'mountPoint':os.path.join(mp, 'boot')})
+      plan.add('umount', "Umount /boot from {0} if it has been mounted".format(mp), lambda: self._umountBootInBootPartition(mp), args = {'mountPoint':os.path.join(mp, 'boot')}, dependsOn = [boot], cleanup = True)
+      for d in ('dev', 'proc', 'sys'):
+        source = '/' + d
+        target = os.path.join(mp, d)
+        bind = plan.add('bind', "Bind {0} on {1}".format(source, target), lambda source = source, target = target: self._bind(source, target), args = {'source':source, 'mountPoint':target}, failure = "Cannot bind {0} on {1}".format(source, target))
+        plan.add('umount', "Umount {0}".format(target), lambda target = target: self._umount(target), args = {'mountPoint':target}, dependsOn = [bind], cleanup = True)
+    cmd = "/usr/sbin/grub-install --boot-directory {bootdir} --no-floppy {dev}".format(bootdir = os.path.join(mp, "boot"), dev = mbrDevice)
+    plan.add('exec', cmd, None if self.isTest else lambda: self._installGrub2(mp, mbrDevice), args = {'command':cmd}, failure = "Grub2 cannot be installed on this disk [{0}]".format(mbrDevice))
+    updateCmd = "chroot {mp} /usr/sbin/update-grub".format(mp = mp)
+    mkconfigCmd = "/usr/sbin/grub-mkconfig -o {cfg}".format(cfg = os.path.join(mp, "boot/grub/grub.cfg"))
+    plan.add('exec', "{0}, or {1} if grub2 is not installed in {2}".format(updateCmd, mkconfigCmd, mp), None if self.isTest else lambda: self._installGrub2Config(mp), args = {'commands':[updateCmd, mkconfigCmd]}, failure = "Cannot generate the Grub2 configuration")
+    return plan
+
+  def install(self, mbrDevice, bootPartition):
+    """
+    Installs Grub2 by executing its plan, returns True if it succeeded.
+    Errors are written on stderr and kept for getInstallErrors.
+    """
     self._bootInBootMounted = False
-    self._procInBootMounted = False
-    mp = None
-    try:
-      mp = self._mountBootPartition(bootPartition)
-      self.__debug("mp = " + unicode(mp))
-      self._mountBootInBootPartition(mp)
-      if self._copyAndInstallGrub2(mp, mbrDevice):
-        self._installGrub2Config(mp)
-      else:
-        sys.stderr.write("Grub2 cannot be installed on this disk [{0}]\n".format(mbrDevice))
-    finally:
-      self._umountAll(mp)
+    plan = self.planInstall(mbrDevice, bootPartition)
+    ok = plan.execute()
+    for line in plan.describe():
+      self.__debug(line)
+    self._installErrors = plan.errors()
+    for error in self._installErrors:
+      sys.stderr.write(error + "\n")
+    return ok
+
+  def getInstallErrors(self):
+    """
+    Returns the errors of the last install.
+    """
+    return self._installErrors
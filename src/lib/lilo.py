@@ -12,21 +12,37 @@ __license__ = 'GPL2+'
 import tempfile
 import shutil
 import os
+import re
+import sys
 import glob
 import codecs
 import salix_livetools_library as sltl
 import subprocess
-from operator import itemgetter
+from stat import *
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from mountsession import *
+from liloconfig import *
+from plan import *
 
 class Lilo:
   
   isTest = False
+  maxMountWorkers = 4
   _prefix = None
   _tmp = None
   _mbrDevice = None
   _bootPartition = None
   _partitions = None
   _bootsMounted = []
+  _bootsMountedIn = {}
+  _mounts = None
+  _inspected = {}
+  _bootFiles = {}
+  _config = None
+  _frameBufferConf = None
+  _initrdPrefixes = ('initrd.img', 'initramfs', 'initrd') # longest first
+  _initrdSuffixes = ('.gz', '.img', '.xz', '.lzma', '.lz4', '.bz2', '.zst')
   _cfgTemplate = """# LILO configuration file
 # Generated by BootSetup
 #
@@ -87,10 +103,20 @@ vga = {vga}
 # the operating system holding /etc/bootsetup/lilo.conf and ensure that
 # all partitions referenced in it are mounted on the appropriate
 # mountpoints.
+
 """
 
-  def __init__(self, isTest):
+  def __init__(self, isTest, mountSession = None):
+    """
+    'mountSession' is the MountSession shared with the UI, if not specified the partitions are unmounted after each operation.
+    """
     self.isTest = isTest
+    self._mounts = mountSession or MountSession(isTest, persistent = False)
+    self._bootFiles = {}
+    self._uuids = {}
+    self._installErrors = []
+    self._bootsMountedIn = {}
+    self._config = None
     self._prefix = "bootsetup.lilo-"
     self._tmp = tempfile.mkdtemp(prefix = self._prefix)
     sltl.mounting._tempMountDir = os.path.join(self._tmp, 'mounts')
@@ -126,17 +152,18 @@ vga = {vga}
     Return the mount point
     """
     self.__debug("bootPartition = " + self._bootPartition)
-    if sltl.isMounted(self._bootPartition):
-      self.__debug("bootPartition already mounted")
-      mp = sltl.getMountPoint(self._bootPartition)
-    else:
-      self.__debug("bootPartition not mounted")
-      mp = sltl.mountDevice(self._bootPartition)
+    mp = self._mounts.acquire(self._bootPartition)
     if mp:
-      self._mountBootInPartition(mp)
+      bootDev = self._mountBootInPartition(mp)
+      if bootDev:
+        self._bootsMounted.append(bootDev)
     return mp
 
   def _mountBootInPartition(self, mountPoint):
+    """
+    Mounts the /boot partition declared in the fstab of the partition mounted on 'mountPoint'.
+    Returns the /boot device to release, or None if nothing has been mounted.
+    """
     # assume that if the mount_point is /, any /boot directory is already accessible/mounted
     fstab = os.path.join(mountPoint, 'etc/fstab')
     bootdir = os.path.join(mountPoint, 'boot')
@@ -145,60 +172,89 @@ vga = {vga}
       try:
         self.__debug('set -- $(grep /boot {fstab}) && echo "$1,$3"'.format(fstab = fstab))
         (bootDev, bootType) = sltl.execGetOutput('set -- $(grep /boot {fstab}) && echo "$1,$3"'.format(fstab = fstab), shell = True)[0].split(',')
-        if bootDev and not os.path.ismount(bootdir):
-          mp = sltl.mountDevice(bootDev, fsType = bootType, mountPoint = bootdir)
+        if bootDev and (self._mounts.getMountPoint(bootDev) == bootdir or not os.path.ismount(bootdir)):
+          mp = self._mounts.acquire(bootDev, fsType = bootType, mountPoint = bootdir)
           if mp:
-            self._bootsMounted.append(mp)
             self.__debug("/boot mounted in " + mp)
+            return bootDev
       except:
         pass
+    return None
+
+  def _mountPartition(self, partition):
+    """
+    Mounts a linux partition and its /boot.
+    Returns (mount point, /boot device or None), the mount point is False if the partition cannot be mounted.
+    """
+    dev = os.path.join("/dev", partition[0])
+    self.__debug("mount partition " + dev)
+    try:
+      mp = self._mounts.acquire(dev)
+    except Exception as e:
+      self.__debug("mount partition " + dev + " failed: " + unicode(e))
+      mp = False
+    self.__debug("mount partition " + dev + " => " + unicode(mp))
+    bootDev = None
+    if mp and mp != self._mounts.getMountPoint(self._bootPartition): # its /boot is already mounted
+      bootDev = self._mountBootInPartition(mp)
+    return (mp, bootDev)
 
   def _mountPartitions(self, mountPointList):
     """
-    Fill a list of mount points for each partition
+    Fill a list of mount points for each partition, in the order of the partitions.
+    The partitions are mounted in parallel. If one of them cannot be mounted, the others are released and an exception is raised.
     """
     if self._partitions:
       partitionsToMount = [p for p in self._partitions if p[2] == "linux"]
       self.__debug("mount partitions: " + unicode(partitionsToMount))
-      for p in partitionsToMount:
-        dev = os.path.join("/dev", p[0])
-        self.__debug("mount partition " + dev)
-        if sltl.isMounted(dev):
-          mp = sltl.getMountPoint(dev)
-        else:
-          mp = sltl.mountDevice(dev)
-        self.__debug("mount partition " + dev + " => " + unicode(mp))
-        if mp:
-          mountPointList[p[0]] = mp
-          self._mountBootInPartition(mp)
-        else:
-          raise Exception("Cannot mount {d}".format(d = dev))
+      if not partitionsToMount:
+        return
+      pool = ThreadPool(max(1, min(self.maxMountWorkers, len(partitionsToMount))))
+      try:
+        results = pool.map(self._mountPartition, partitionsToMount)
+      finally:
+        pool.close()
+        pool.join()
+      failed = [p[0] for (p, (mp, bootDev)) in zip(partitionsToMount, results) if not mp]
+      if failed:
+        self.__debug("cannot mount {0}, rollback".format(unicode(failed)))
+        for (p, (mp, bootDev)) in zip(partitionsToMount, results):
+          if bootDev:
+            self._mounts.release(bootDev)
+        for (p, (mp, bootDev)) in zip(partitionsToMount, results):
+          if mp:
+            self._mounts.release(os.path.join("/dev", p[0]))
+        raise Exception("Cannot mount {d}".format(d = ", ".join([os.path.join("/dev", f) for f in failed])))
+      for (p, (mp, bootDev)) in zip(partitionsToMount, results):
+        mountPointList[p[0]] = mp
+        if bootDev:
+          self._bootsMounted.append(bootDev)
 
   def _umountAll(self, mountPoint, mountPointList):
+    """
+    Releases what has been mounted for the operation, nested /boot first.
+    """
     self.__debug("umountAll")
     if mountPoint:
-      for mp in self._bootsMounted:
-        self.__debug("umounting " + unicode(mp))
-        sltl.umountDevice(mp, deleteMountPoint = False)
+      for dev in self._bootsMounted:
+        self.__debug("release " + unicode(dev))
+        self._mounts.release(dev)
       self._bootsMounted = []
       if mountPointList:
-        self.__debug("umount other mount points: " + unicode(mountPointList))
-        for mp in mountPointList.values():
-          if mp == mountPoint:
-            continue # skip it, will be unmounted just next
-          self.__debug("umount " + unicode(mp))
-          sltl.umountDevice(mp)
-      if mountPoint != '/':
-        self.__debug("main mount point ≠ '/' → umount " + mountPoint)
-        sltl.umountDevice(mountPoint)
+        self.__debug("release other partitions: " + unicode(mountPointList.keys()))
+        for p in mountPointList.keys():
+          self._mounts.release(os.path.join("/dev", p))
+      self.__debug("release main partition " + self._bootPartition)
+      self._mounts.release(self._bootPartition)
 
   def _createLiloSections(self, mountPointList):
     """
-    Return a list of lilo section string for each partition.
+    Return a list of LiloSection for each partition.
     There could be more section than partitions if there are multiple kernels.
     """
     sections = []
     if self._partitions:
+      self._uuids = self._getUuids([os.path.join("/dev", p[0]) for p in self._partitions if p[2] == 'linux' and os.path.join("/dev", p[0]) not in self._bootFiles])
       for p in self._partitions:
         device = os.path.join("/dev", p[0])
         fs = p[1]
@@ -207,82 +263,176 @@ vga = {vga}
         if bootType == 'chain':
           sections.append(self._getChainLiloSection(device, label))
         elif bootType == 'linux':
-          mp = mountPointList[p[0]]
+          mp = mountPointList[p[0]] # None if the partition is inspected without being mounted
           sections.extend(self._getLinuxLiloSections(device, fs, mp, label))
         else:
-          sys.err.write("The boot type {type} is not supported.\n".format(type = bootType))
+          sys.stderr.write("The boot type {type} is not supported.\n".format(type = bootType))
     return sections
 
+  def _getUuids(self, devices):
+    """
+    Returns a dictionary of the filesystem UUID of the 'devices', read by only one batch of blkid commands.
+    """
+    results = sltl.execBatch([['/sbin/blkid', '-s', 'UUID', '-o', 'value', d] for d in devices], shell = False)
+    return dict([(d, lines[0]) for (d, (ret, lines)) in zip(devices, results) if ret == 0 and lines])
+
   def _getChainLiloSection(self, device, label):
     """
-    Returns a string for a chainloaded section
+    Returns a LiloOtherSection for a chainloaded section
     """
     self.__debug("Section 'chain' for " + device + " with label: " + label)
-    return """# {label} chain section
-  other = {device}
-  label = {label}
-""".format(device = device, label = label)
+    return LiloOtherSection(device, label, comment = "{label} chain section".format(label = label))
 
-  def _getLinuxLiloSections(self, device, fs, mp, label):
+  def _resolveFstabDevice(self, fstabDevice):
     """
-    Returns a list of string sections, one for each kernel+initrd
+    Returns the device path of the first field of a fstab line, or None if it cannot be found.
     """
-    sections = []
-    self.__debug("Section 'linux' for " + device + "/" + fs + ", mounted on " + mp + " with label: " + label)
-    kernelList = sorted(glob.glob("{mp}/boot/vmlinuz*".format(mp = mp)))
-    initrdList = sorted(glob.glob("{mp}/boot/initr*".format(mp = mp)))
-    for l in (kernelList, initrdList):
-      for el in l:
-        if os.path.isdir(el) or os.path.islink(el):
-          l.remove(el)
+    for tag, directory in (('UUID=', '/dev/disk/by-uuid'), ('LABEL=', '/dev/disk/by-label')):
+      if fstabDevice.startswith(tag):
+        path = os.path.join(directory, fstabDevice[len(tag):])
+        if os.path.exists(path):
+          return os.path.realpath(path)
+        return None
+    if fstabDevice.startswith('/dev/'):
+      return fstabDevice
+    return None
+
+  def _inspectBootFiles(self, device, fs):
+    """
+    Returns the lists of kernels and initrds of the unmounted 'device', read with sltl.listDirectory (no mount), as paths from its root.
+    A separate /boot partition found in its fstab is inspected the same way.
+    Returns None if the filesystems cannot be inspected.
+    """
+    if not sltl.canInspect(fs):
+      return None
+    bootDevice = device
+    bootFs = fs
+    bootDir = '/boot'
+    for line in sltl.readFile(device, '/etc/fstab'):
+      fields = line.split()
+      if len(fields) >= 3 and not fields[0].startswith('#') and fields[1] == '/boot':
+        bootDevice = self._resolveFstabDevice(fields[0])
+        bootFs = fields[2]
+        bootDir = '/'
+        break
+    if not bootDevice or not sltl.canInspect(bootFs):
+      return None
+    entries = sltl.listDirectory(bootDevice, bootDir)
+    if entries is None:
+      return None # cannot be read or no /boot directory, let a mount tell
+    # like for a mounted partition, directories and symbolic links are ignored
+    names = sorted([name for (name, mode) in entries if S_ISREG(mode)])
+    kernelList = ['/boot/' + n for n in names if n.startswith('vmlinuz')]
+    initrdList = ['/boot/' + n for n in names if n.startswith('initr')]
+    return (kernelList, initrdList)
+
+  def _getBootFiles(self, device, fs, mp):
+    """
+    Returns the (kernelList, initrdList, rootDevice) of the linux partition 'device' mounted on 'mp'.
+    They are kept for the next configurations as long as the partition stays mounted on 'mp', so that relabeling or reordering the partitions does not read them again.
+    If 'mp' is None, the partition is inspected without being mounted and the paths are given from its root.
+    """
+    cached = self._bootFiles.get(device)
+    if mp is not None and cached and cached['fs'] == fs and cached['mp'] == mp:
+      self.__debug("boot files of " + device + " already known")
+      return cached['files']
+    if mp is None:
+      (kernelList, initrdList) = self._inspected[device]
+    else:
+      # directories and symbolic links (like vmlinuz -> vmlinuz-x.y.z) are ignored
+      kernelList = [f for f in sorted(glob.glob("{mp}/boot/vmlinuz*".format(mp = mp))) if not os.path.isdir(f) and not os.path.islink(f)]
+      initrdList = [f for f in sorted(glob.glob("{mp}/boot/initr*".format(mp = mp))) if not os.path.isdir(f) and not os.path.islink(f)]
     self.__debug("kernelList: " + unicode(kernelList))
     self.__debug("initrdList: " + unicode(initrdList))
-    uuid = sltl.execGetOutput(['/sbin/blkid', '-s', 'UUID', '-o', 'value', device], shell = False)
+    if device in self._uuids:
+      uuid = [self._uuids[device]]
+    else:
+      uuid = sltl.execGetOutput(['/sbin/blkid', '-s', 'UUID', '-o', 'value', device], shell = False)
     if uuid:
       rootDevice = "/dev/disk/by-uuid/{uuid}".format(uuid = uuid[0])
     else:
       rootDevice = device
     self.__debug("rootDevice = " + rootDevice)
+    files = (kernelList, initrdList, rootDevice)
+    if mp is not None:
+      self._bootFiles[device] = {'fs':fs, 'mp':mp, 'files':files}
+    return files
+
+  def _getLinuxLiloSections(self, device, fs, mp, label):
+    """
+    Returns a list of LiloImageSection, one for each kernel+initrd
+    If 'mp' is None, the partition is inspected without being mounted and the paths are given from its root.
+    """
+    if mp is None:
+      self.__debug("Section 'linux' for " + device + "/" + fs + ", not mounted, with label: " + label)
+    else:
+      self.__debug("Section 'linux' for " + device + "/" + fs + ", mounted on " + mp + " with label: " + label)
+    (kernelList, initrdList, rootDevice) = self._getBootFiles(device, fs, mp)
+    sections = []
     for (k, i, l) in self._getKernelInitrdCouples(kernelList, initrdList, label):
       self.__debug("kernel, initrd, label found: " + unicode(k) + "," + unicode(i) + "," + unicode(l))
-      section = None
-      if i:
-        section = """# {label} Linux section
-  image = {image}
-  initrd = {initrd}
-  root = {root}
-""".format(image = k, initrd = i, root = rootDevice, label = l)
-      else:
-        section = """# {label} Linux section
-  image = {image}
-  root = {root}
-""".format(image = k, root = rootDevice, label = l)
+      append = None
       if fs == 'ext4':
-        section += '  append = "{append} "\n'.format(append = 'rootfstype=ext4')
-      section += "  read-only\n  label = {label}\n".format(label = l)
-      sections.append(section)
+        append = 'rootfstype=ext4 '
+      sections.append(LiloImageSection(k, l, root = rootDevice, initrd = i, append = append, comment = "{label} Linux section".format(label = l)))
     return sections
 
+  def _kernelRelease(self, kernel):
+    """
+    Returns the release of a kernel file: 'vmlinuz-3.10.17' => '3.10.17', 'vmlinuz' => ''.
+    """
+    return os.path.basename(kernel)[len('vmlinuz'):].lstrip('-.')
+
+  def _initrdRelease(self, initrd):
+    """
+    Returns the release of the kernel of an initrd file, or None if it is not an initrd:
+    'initrd-3.10.17.gz', 'initrd.img-3.10.17' and 'initramfs-3.10.17.img' => '3.10.17', 'initrd.gz' => ''.
+    """
+    name = os.path.basename(initrd)
+    stripped = True
+    while stripped:
+      stripped = False
+      for suffix in self._initrdSuffixes:
+        if name.endswith(suffix) and name != suffix:
+          name = name[:-len(suffix)]
+          stripped = True
+    for prefix in self._initrdPrefixes:
+      if name.startswith(prefix):
+        return name[len(prefix):].lstrip('-.')
+    return None
+
+  def _releaseKey(self, release):
+    """
+    Sort key of a kernel release: the version numbers first, so that 3.10.17 is newer than 3.9.5, then the rest of the release compared naturally.
+    """
+    m = re.search(r'\d+(?:\.\d+)*', release)
+    version = tuple([int(n) for n in m.group(0).split('.')]) if m else ()
+    tokens = tuple([int(t) if t.isdigit() else t for t in re.findall(r'\d+|[^\d.\-_]+', release)])
+    return (version, tokens)
+
   def _getKernelInitrdCouples(self, kernelList, initrdList, labelRef):
+    """
+    Returns the list of (kernel, initrd or None, label), newest kernel first.
+    Each kernel is paired with the initrd of exactly the same release, so that -5.1 never gets the initrd of -5.10.
+    The only kernel of a partition gets an initrd even if no release matches, like before.
+    With several kernels, the labels are numbered from labelRef, which is truncated to fit in the 15 characters of a LiLo label.
+    """
+    initrdPerRelease = {}
+    for initrd in initrdList:
+      release = self._initrdRelease(initrd)
+      if release is not None:
+        initrdPerRelease.setdefault(release, initrd)
+    kernels = sorted([(self._releaseKey(self._kernelRelease(k)), k) for k in kernelList], reverse = True)
     ret = []
-    if kernelList:
-      if len(kernelList) == 1:
-        initrd = None
-        if initrdList:
+    for (n, (key, kernel)) in enumerate(kernels):
+      initrd = initrdPerRelease.get(self._kernelRelease(kernel))
+      if len(kernels) == 1:
+        if not initrd and initrdList:
           initrd = initrdList[0] # assume the only initrd match the only kernel
-        ret.append([kernelList[0], initrd, labelRef])
+        label = labelRef
       else:
-        labelBase = labelRef[0:15-2] + "-"
-        n = 0
-        for kernel in kernelList:
-          n += 1
-          kernelSuffix = os.path.basename(kernel).replace("vmlinuz", "")
-          initrd = None
-          for i in initrdList:
-            if kernelSuffix in i: # find the matching initrd
-              initrd = i
-              break
-          ret.append((kernel, initrd, labelBase + unicode(n)))
+        label = labelRef[0:15-2] + "-" + unicode(n + 1)
+      ret.append((kernel, initrd, label))
     return ret
 
   def _getFrameBufferConf(self):
@@ -290,165 +440,71 @@ vga = {vga}
     Return the frame buffer configuration for this hardware.
     Format: (fb, label)
     """
-    try:
-      fbGeometry = sltl.execGetOutput("/usr/sbin/fbset | grep -w geometry")
-    except subprocess.CalledProcessorError:
-      self.__debug("Impossible to determine frame buffer mode, default to text.")
-      fbGeometry = None
     mode = None
     label = None
-    if fbGeometry:
-      vesaModes = [
-          (320, 200, 4, None),
-          (640, 400, 4, None),
-          (640, 480, 4, None),
-          (800, 500, 4, None),
-          (800, 600, 4, 770),
-          (1024, 640, 4, None),
-          (896, 672, 4, None),
-          (1152, 720, 4, None),
-          (1024, 768, 4, 772),
-          (1440, 900, 4, None),
-          (1280, 1024, 4, 774),
-          (1400, 1050, 4, None),
-          (1600, 1200, 4, None),
-          (1920, 1200, 4, None),
-          (320, 200, 8, None),
-          (640, 400, 8, 768),
-          (640, 480, 8, 769),
-          (800, 500, 8, 879),
-          (800, 600, 8, 771),
-          (1024, 640, 8, 874),
-          (896, 672, 8, 815),
-          (1152, 720, 8, 869),
-          (1024, 768, 8, 773),
-          (1440, 900, 8, 864),
-          (1280, 1024, 8, 775),
-          (1400, 1050, 8, 835),
-          (1600, 1200, 8, 796),
-          (1920, 1200, 8, 893),
-          (320, 200, 15, 781),
-          (640, 400, 15, 801),
-          (640, 480, 15, 784),
-          (800, 500, 15, 880),
-          (800, 600, 15, 787),
-          (1024, 640, 15, 875),
-          (896, 672, 15, 816),
-          (1152, 720, 15, 870),
-          (1024, 768, 15, 790),
-          (1440, 900, 15, 865),
-          (1280, 1024, 15, 793),
-          (1400, 1050, 15, None),
-          (1600, 1200, 15, 797),
-          (1920, 1200, 15, None),
-          (320, 200, 16, 782),
-          (640, 400, 16, 802),
-          (640, 480, 16, 785),
-          (800, 500, 16, 881),
-          (800, 600, 16, 788),
-          (1024, 640, 16, 876),
-          (896, 672, 16, 817),
-          (1152, 720, 16, 871),
-          (1024, 768, 16, 791),
-          (1440, 900, 16, 866),
-          (1280, 1024, 16, 794),
-          (1400, 1050, 16, 837),
-          (1600, 1200, 16, 798),
-          (1920, 1200, 16, None),
-          (320, 200, 24, 783),
-          (640, 400, 24, 803),
-          (640, 480, 24, 786),
-          (800, 500, 24, 882),
-          (800, 600, 24, 789),
-          (1024, 640, 24, 877),
-          (896, 672, 24, 818),
-          (1152, 720, 24, 872),
-          (1024, 768, 24, 792),
-          (1440, 900, 24, 867),
-          (1280, 1024, 24, 795),
-          (1400, 1050, 24, 838),
-          (1600, 1200, 24, 799),
-          (1920, 1200, 24, None),
-          (320, 200, 32, None),
-          (640, 400, 32, 804),
-          (640, 480, 32, 809),
-          (800, 500, 32, 883),
-          (800, 600, 32, 814),
-          (1024, 640, 32, 878),
-          (896, 672, 32, 819),
-          (1152, 720, 32, 873),
-          (1024, 768, 32, 824),
-          (1440, 900, 32, 868),
-          (1280, 1024, 32, 829),
-          (1400, 1050, 32, None),
-          (1600, 1200, 32, 834),
-          (1920, 1200, 32, None),
-        ]
-      values = fbGeometry[0].strip().split(' ')
-      self.__debug("FB Values: " + unicode(values))
-      xRes = int(values[1])
-      yRes = int(values[2])
-      deep = int(values[-1])
-      xMax = None
-      yMax = None
-      dMax = None
-      # order the vesa modes by vertical size desc, horizontal size desc, color depth desc.
-      for vesaMode in sorted(vesaModes, key = itemgetter(1, 0, 2), reverse = True):
-        (x, y, d, m) = vesaMode
-        if m:
-          self.__debug("trying {0} for y, {1} for x and {2} for d".format(y, x, d))
-          if y <= yRes and x <= xRes and d <= deep:
-            xMax = x
-            yMax = y
-            dMax = d
-            mode = m
-            break
-      if mode:
+    geometry = sltl.getFrameBufferGeometry()
+    if geometry:
+      self.__debug("FB geometry: " + unicode(geometry))
+      best = sltl.getBestVesaMode(*geometry)
+      if best:
+        (mode, xMax, yMax, dMax) = best
         self.__debug("Max mode found: {x}×{y}×{d}".format(x = xMax, y = yMax, d = dMax))
         label = "{x}x{y}x{d}".format(x = xMax, y = yMax, d = dMax)
+    else:
+      self.__debug("Impossible to determine frame buffer mode, default to text.")
     if not mode:
       mode = 'normal'
       label = 'text'
     return (mode, label)
 
+  def _buildConfiguration(self, mp, mountPointList, config = None):
+    """
+    Returns the LiloConfig of the configuration file.
+    If 'config' is specified, it is updated in place and returned: only the sections that changed are replaced.
+    """
+    if not self._frameBufferConf:
+      self._frameBufferConf = self._getFrameBufferConf()
+    (fb, fbLabel) = self._frameBufferConf
+    self.__debug("frame buffer mode = " + unicode(fb) + " " + unicode(fbLabel))
+    newConfig = LiloConfig.parse(self._cfgTemplate.format(boot = self._mbrDevice, mp = mp, vga = "{0} # {1}".format(fb, fbLabel)))
+    newConfig.sections = self._createLiloSections(mountPointList)
+    self.__debug("lilo sections: " + unicode([s.label for s in newConfig.sections]))
+    if config is None:
+      return newConfig
+    self.__debug("configuration changes: " + unicode(config.update(newConfig)))
+    return config
+
+  def _knownMountPoints(self):
+    """
+    Returns the mount points of the linux partitions if all their boot files are already known and they are still mounted there, else None.
+    In that case the configuration can be updated without mounting anything.
+    """
+    mountPointList = OrderedDict()
+    for p in [p for p in self._partitions if p[2] == "linux"]:
+      dev = os.path.join("/dev", p[0])
+      mp = self._mounts.getMountPoint(dev) or sltl.getMountPoint(dev)
+      cached = self._bootFiles.get(dev)
+      if not mp or not cached or cached['fs'] != p[1] or cached['mp'] != mp:
+        return None
+      mountPointList[p[0]] = mp
+    return mountPointList
+
   def createConfiguration(self, mbrDevice, bootPartition, partitions):
     """
     partitions format: [device, filesystem, boot type, label]
+    The configuration of the previous call is updated in place: partitions that are still mounted where they were read are not read again, so relabeling or reordering them does not mount anything.
     """
     self._mbrDevice = os.path.join("/dev", mbrDevice)
     self._bootPartition = os.path.join("/dev", bootPartition)
     self._partitions = partitions
     self._bootsMounted = []
     self.__debug("partitions: " + unicode(self._partitions))
-    mp = None
-    mpList = None
-    try:
-      mp = self._mountBootPartition()
-      if not mp:
-        raise Exception("Cannot mount the main boot partition.")
-      self.__debug("mp = " + unicode(mp))
-      mpList = {}
-      self._mountPartitions(mpList)
-      self.__debug("mount point lists: " + unicode(mpList))
-      liloSections = self._createLiloSections(mpList)
-      self.__debug("lilo sections: " + unicode(liloSections))
-      (fb, fbLabel) = self._getFrameBufferConf()
-      self.__debug("frame buffer mode = " + unicode(fb) + " " + unicode(fbLabel))
-      f = open(self.getConfigurationPath(), "w")
-      f.write(self._cfgTemplate.format(boot = self._mbrDevice, mp = mp, vga = "{0} # {1}".format(fb, fbLabel)))
-      for s in liloSections:
-        f.write(s)
-        f.write("\n")
-      f.close()
-    finally:
-      self._umountAll(mp, mpList)
-
-  def install(self):
-    """
-    Assuming that last configuration editing didn't modified mount point.
-    """
-    if self._mbrDevice:
-      self._bootsMounted = []
+    mp = self._mounts.getMountPoint(self._bootPartition) or sltl.getMountPoint(self._bootPartition)
+    mpList = self._knownMountPoints()
+    if mp and mpList is not None:
+      self.__debug("partitions already known, update the configuration in place")
+      self._config = self._buildConfiguration(mp, mpList, self._config)
+    else:
       mp = None
       mpList = None
       try:
@@ -456,22 +512,140 @@ vga = {vga}
         if not mp:
           raise Exception("Cannot mount the main boot partition.")
         self.__debug("mp = " + unicode(mp))
-        mpList = {}
+        mpList = OrderedDict()
         self._mountPartitions(mpList)
         self.__debug("mount point lists: " + unicode(mpList))
-        # copy the configuration to the boot_partition
-        try:
-          self.__debug("create etc/bootsetup directory in " + mp)
-          os.makedirs(os.path.join(mp, 'etc/bootsetup'))
-        except os.error:
-          pass
-        self.__debug("copy lilo.conf to etc/bootsetup")
-        shutil.copyfile(self.getConfigurationPath(), os.path.join(mp, '/etc/bootsetup/lilo.conf'))
-        # run lilo
-        if self.isTest:
-          self.__debug('/sbin/lilo -t -v -C {mp}/etc/bootsetup/lilo.conf'.format(mp = mp))
-          sltl.execCall('/sbin/lilo -t -v -C {mp}/etc/bootsetup/lilo.conf'.format(mp = mp))
-        else:
-          sltl.execCall('/sbin/lilo -C {mp}/etc/bootsetup/lilo.conf'.format(mp = mp))
+        self._config = self._buildConfiguration(mp, mpList, self._config)
       finally:
         self._umountAll(mp, mpList)
+    f = codecs.open(self.getConfigurationPath(), "w", "utf-8")
+    f.write(self._config.serialize())
+    f.close()
+
+  def previewConfiguration(self, mbrDevice, bootPartition, partitions):
+    """
+    Returns the configuration that createConfiguration would write, without side effect on the partitions.
+    Partitions already mounted are read where they are, ext2/3/4 ones are inspected read-only without being mounted and their paths are given from their root.
+    Others have to be mounted like for createConfiguration.
+    partitions format: [device, filesystem, boot type, label]
+    """
+    self._mbrDevice = os.path.join("/dev", mbrDevice)
+    self._bootPartition = os.path.join("/dev", bootPartition)
+    self._partitions = partitions
+    self._bootsMounted = []
+    self._inspected = {}
+    mpList = OrderedDict()
+    acquired = []
+    try:
+      for p in [p for p in partitions if p[2] == "linux"]:
+        dev = os.path.join("/dev", p[0])
+        mp = self._mounts.getMountPoint(dev) or sltl.getMountPoint(dev)
+        if not mp:
+          bootFiles = self._inspectBootFiles(dev, p[1])
+          if bootFiles is not None:
+            self._inspected[dev] = bootFiles
+        if not mp and dev not in self._inspected:
+          self.__debug("{0} cannot be inspected, mount it".format(dev))
+          (mp, bootDev) = self._mountPartition(p)
+          if not mp:
+            raise Exception("Cannot mount {d}".format(d = dev))
+          acquired.append(dev)
+          if bootDev:
+            self._bootsMounted.append(bootDev)
+        mpList[p[0]] = mp or None
+      self.__debug("mount point lists: " + unicode(mpList))
+      mp = self._mounts.getMountPoint(self._bootPartition) or sltl.getMountPoint(self._bootPartition) or ''
+      return self._buildConfiguration(mp, mpList).serialize()
+    finally:
+      for dev in self._bootsMounted:
+        self._mounts.release(dev)
+      self._bootsMounted = []
+      for dev in acquired:
+        self._mounts.release(dev)
+
+  def _releaseDevice(self, device):
+    self._mounts.release(device)
+    return True
+
+  def _mountBootIn(self, mountPoint):
+    """
+    Mounts the /boot of the partition mounted on 'mountPoint', if any. Nothing to mount is not an error.
+    """
+    self._bootsMountedIn[mountPoint] = self._mountBootInPartition(mountPoint)
+    return True
+
+  def _releaseBootIn(self, mountPoint):
+    bootDev = self._bootsMountedIn.pop(mountPoint, None)
+    if bootDev:
+      self._mounts.release(bootDev)
+    return True
+
+  def _makeDirs(self, path):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    return True
+
+  def _copyFile(self, source, destination):
+    shutil.copyfile(source, destination)
+    return True
+
+  def _addMountSteps(self, plan, device):
+    """
+    Adds to 'plan' the steps mounting 'device' and the /boot declared in its fstab, and the cleanup steps releasing them.
+    Returns the ids of the mount steps.
+    """
+    mp = self._mounts.plannedMountPoint(device)
+    mount = plan.add('mount', "Mount {0} on {1}".format(device, mp), lambda: self._mounts.acquire(device), args = {'device':device, 'mountPoint':mp}, dependsOn = [], failure = "Cannot mount {0}".format(device))
+    plan.add('release', "Release {0}".format(device), lambda: self._releaseDevice(device), args = {'device':device}, dependsOn = [mount], cleanup = True)
+    boot = plan.add('mount', "Mount /boot in {0} if it is in its fstab".format(mp), lambda: self._mountBootIn(mp), args = {'mountPoint':os.path.join(mp, 'boot')}, dependsOn = [mount])
+    plan.add('release', "Release /boot of {0} if it has been mounted".format(mp), lambda: self._releaseBootIn(mp), args = {'mountPoint':os.path.join(mp, 'boot')}, dependsOn = [boot], cleanup = True)
+    return [mount, boot]
+
+  def planInstall(self):
+    """
+    Returns the Plan of the installation of the last configuration, nothing is done before it is executed.
+    The partitions are mounted in parallel, then the configuration is copied in the boot partition and lilo is run, in test mode with -t.
+    """
+    plan = Plan(self.isTest, maxWorkers = self.maxMountWorkers)
+    if not self._mbrDevice:
+      return plan
+    mp = self._mounts.plannedMountPoint(self._bootPartition)
+    mounts = self._addMountSteps(plan, self._bootPartition)
+    for p in self._partitions or []:
+      dev = os.path.join("/dev", p[0])
+      if p[2] == "linux" and dev != self._bootPartition:
+        mounts.extend(self._addMountSteps(plan, dev))
+    cfgDir = os.path.join(mp, 'etc/bootsetup')
+    cfgPath = os.path.join(cfgDir, 'lilo.conf')
+    plan.add('mkdir', "Create " + cfgDir, lambda: self._makeDirs(cfgDir), args = {'path':cfgDir}, dependsOn = mounts)
+    plan.add('write', "Copy lilo.conf to " + cfgPath, lambda: self._copyFile(self.getConfigurationPath(), cfgPath), args = {'source':self.getConfigurationPath(), 'path':cfgPath})
+    if self.isTest:
+      cmd = '/sbin/lilo -t -v -C {cfg}'.format(cfg = cfgPath)
+    else:
+      cmd = '/sbin/lilo -C {cfg}'.format(cfg = cfgPath)
+    plan.add('exec', cmd, lambda: sltl.execCall(cmd) == 0, args = {'command':cmd}, failure = "LiLo cannot be installed on this disk [{0}]".format(self._mbrDevice))
+    return plan
+
+  def install(self):
+    """
+    Installs the last configuration by executing its plan, returns True if it succeeded.
+    Errors are written on stderr and kept for getInstallErrors.
+    Assuming that last configuration editing didn't modified mount point.
+    """
+    if not self._mbrDevice:
+      self._installErrors = ["No LiLo configuration to install."]
+      return False
+    plan = self.planInstall()
+    ok = plan.execute()
+    for line in plan.describe():
+      self.__debug(line)
+    self._installErrors = plan.errors()
+    for error in self._installErrors:
+      sys.stderr.write(error + "\n")
+    return ok
+
+  def getInstallErrors(self):
+    """
+    Returns the errors of the last install.
+    """
+    return self._installErrors
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+LiLo configuration model for BootSetup.
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import re
+
+# key [= value] [# comment], the value being a word or a double quoted string
+_optionLine = re.compile(r'^\s*([^\s=#"]+)\s*(?:=\s*("(?:[^"\\]|\\.)*"|[^\s#"]+))?\s*(#.*)?$')
+
+def _quote(value):
+  if value == '' or re.search(r'[\s#"]', value):
+    return '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+  return value
+
+def _unquote(value):
+  if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+    return re.sub(r'\\(.)', r'\1', value[1:-1])
+  return value
+
+class LiloSection:
+  """
+  A section of a lilo.conf file: the global section or an image/other section.
+  The section is a list of items, each item being an option or a line that is not an option (comment, blank line).
+  Items read from a file keep their text, so a section that is not modified is written back as it was read.
+  The 'header' are the comment lines just before the section, like '# Salix Linux section'.
+  """
+
+  kind = None
+  indent = ''
+  header = []
+  items = []
+
+  def __init__(self):
+    self.header = []
+    self.items = []
+
+  def _find(self, key):
+    for item in self.items:
+      if item['key'] == key:
+        return item
+    return None
+
+  def has(self, key):
+    return self._find(key) is not None
+
+  def get(self, key, default = None):
+    """
+    Returns the unquoted value of the option 'key', True if it is a flag like 'read-only', or 'default' if it is not set.
+    """
+    item = self._find(key)
+    if item is None:
+      return default
+    elif item['value'] is None:
+      return True
+    else:
+      return _unquote(item['value'])
+
+  def set(self, key, value = True, comment = None):
+    """
+    Sets the option 'key' to 'value', or as a flag if 'value' is True.
+    An existing option keeps its place, a new one is added at the end of the section.
+    """
+    value = None if value is True else _quote(unicode(value))
+    if comment and not comment.startswith('#'):
+      comment = '# ' + comment
+    item = self._find(key)
+    if item is None:
+      self.items.append({'key':key, 'value':value, 'comment':comment, 'raw':None})
+    elif (item['value'], item['comment']) != (value, comment):
+      item.update({'value':value, 'comment':comment, 'raw':None})
+
+  def remove(self, key):
+    self.items = [item for item in self.items if item['key'] != key]
+
+  def addLine(self, line):
+    """
+    Adds a line that is not an option, like a comment or a blank line.
+    """
+    self.items.append({'key':None, 'value':None, 'comment':None, 'raw':line})
+
+  def options(self):
+    """
+    Returns the list of (key, value, comment) of the options of the section, in order.
+    """
+    return [(item['key'], item['value'], item['comment']) for item in self.items if item['key']]
+
+  @property
+  def target(self):
+    """
+    The image or the device of the section, which identifies it in the configuration.
+    """
+    return self.kind and self.get(self.kind)
+
+  @property
+  def label(self):
+    return self.get('label')
+
+  def setLabel(self, label):
+    """
+    Changes the label of the section, and in the header comments that refer to the previous one.
+    """
+    old = self.label
+    self.set('label', label)
+    if old and old != label:
+      prefix = '# {0} '.format(old)
+      self.header = ['# {0} '.format(label) + line[len(prefix):] if line.startswith(prefix) else line for line in self.header]
+
+  def _formatItem(self, item):
+    if item['raw'] is not None:
+      return item['raw']
+    line = self.indent + item['key']
+    if item['value'] is not None:
+      line += ' = ' + item['value']
+    if item['comment']:
+      line += ' ' + item['comment']
+    return line
+
+  def lines(self):
+    return list(self.header) + [self._formatItem(item) for item in self.items]
+
+class LiloImageSection(LiloSection):
+  """
+  A section booting a linux kernel.
+  """
+
+  kind = 'image'
+  indent = '  '
+
+  def __init__(self, image = None, label = None, root = None, initrd = None, append = None, readOnly = True, comment = None):
+    LiloSection.__init__(self)
+    if comment:
+      self.header.append('# ' + comment)
+    if image:
+      self.set('image', image)
+      if initrd:
+        self.set('initrd', initrd)
+      if root:
+        self.set('root', root)
+      if append:
+        self.set('append', append)
+      if readOnly:
+        self.set('read-only')
+      if label:
+        self.set('label', label)
+      self.addLine('')
+
+class LiloOtherSection(LiloSection):
+  """
+  A section chain loading the boot sector of another partition.
+  """
+
+  kind = 'other'
+  indent = '  '
+
+  def __init__(self, device = None, label = None, comment = None):
+    LiloSection.__init__(self)
+    if comment:
+      self.header.append('# ' + comment)
+    if device:
+      self.set('other', device)
+      if label:
+        self.set('label', label)
+      self.addLine('')
+
+class LiloConfig:
+  """
+  A lilo.conf file: its global section followed by the image and other sections.
+  It can be parsed from and written to a lilo.conf, compared to another configuration and updated in place, so that only the sections that changed are rewritten.
+  """
+
+  globals = None
+  sections = []
+
+  def __init__(self):
+    self.globals = LiloSection()
+    self.sections = []
+
+  @classmethod
+  def parse(cls, text):
+    """
+    Returns the LiloConfig of the content of a lilo.conf file.
+    The comment lines just before a section are its header, the other lines that are not options stay where they are.
+    """
+    config = cls()
+    current = config.globals
+    pending = []
+    for line in text.splitlines():
+      m = _optionLine.match(line)
+      if not line.strip() or line.lstrip().startswith('#') or not m:
+        pending.append(line)
+        continue
+      (key, value, comment) = m.groups()
+      if key in (LiloImageSection.kind, LiloOtherSection.kind):
+        section = LiloImageSection() if key == LiloImageSection.kind else LiloOtherSection()
+        header = []
+        while pending and pending[-1].lstrip().startswith('#'):
+          header.insert(0, pending.pop())
+        for l in pending:
+          current.addLine(l)
+        section.header = header
+        config.sections.append(section)
+        current = section
+      else:
+        for l in pending:
+          current.addLine(l)
+      pending = []
+      current.items.append({'key':key, 'value':value, 'comment':comment, 'raw':line})
+    for l in pending:
+      current.addLine(l)
+    return config
+
+  def serialize(self):
+    """
+    Returns the content of the lilo.conf file.
+    """
+    lines = self.globals.lines()
+    for section in self.sections:
+      lines.extend(section.lines())
+    return "\n".join(lines) + "\n"
+
+  def __unicode__(self):
+    return self.serialize()
+
+  def findSection(self, target):
+    for section in self.sections:
+      if section.target == target:
+        return section
+    return None
+
+  def diff(self, other):
+    """
+    Returns the list of changes from this configuration to 'other', as (change, key) tuples:
+      - ('global', option) for a global option added, removed or modified,
+      - ('added', target), ('removed', target), ('changed', target) or ('moved', target) for a section, identified by its image or device.
+    """
+    changes = []
+    mine = dict([(o[0], o) for o in self.globals.options()])
+    theirs = dict([(o[0], o) for o in other.globals.options()])
+    for key in sorted(set(mine.keys()) | set(theirs.keys())):
+      if mine.get(key) != theirs.get(key):
+        changes.append(('global', key))
+    targets = [s.target for s in self.sections]
+    otherTargets = [s.target for s in other.sections]
+    for target in targets:
+      if target not in otherTargets:
+        changes.append(('removed', target))
+    common = [t for t in targets if t in otherTargets]
+    otherCommon = [t for t in otherTargets if t in targets]
+    for (index, target) in enumerate(otherTargets):
+      if target not in targets:
+        changes.append(('added', target))
+        continue
+      if self.findSection(target).options() != other.findSection(target).options():
+        changes.append(('changed', target))
+      if common.index(target) != otherCommon.index(target):
+        changes.append(('moved', target))
+    return changes
+
+  def update(self, other):
+    """
+    Updates this configuration in place to match 'other' and returns the changes, see diff.
+    The sections that did not change are kept as they are, changed ones are replaced by the ones of 'other'.
+    """
+    changes = self.diff(other)
+    changedTargets = set([key for (change, key) in changes if change in ('added', 'changed')])
+    for (change, key) in changes:
+      if change == 'global':
+        item = other.globals._find(key)
+        if item is None:
+          self.globals.remove(key)
+        elif self.globals._find(key) is None:
+          self.globals.items.append(dict(item))
+        else:
+          self.globals._find(key).update(item)
+    self.sections = [section if section.target in changedTargets else self.findSection(section.target) for section in other.sections]
+    return changes
+
+# Unit test
+if __name__ == '__main__':
+  from salix_livetools_library.assertPlus import *
+  text = """# LILO configuration file
+# Generated by BootSetup
+#
+# Start LILO global section
+append = "vt.default_utf8=1 splash=\\"silent\\""
+boot = /dev/sda
+lba32
+compact
+timeout = 50 # tenths of second
+change-rules
+  reset
+vga = normal
+# End LILO global section
+
+# Salix Linux section
+image = /boot/vmlinuz
+  initrd = /boot/initrd.gz
+  root = /dev/sda1
+  label = Salix
+  read-only
+
+# Windows section
+other = /dev/sda2
+  label = Windows
+"""
+  config = LiloConfig.parse(text)
+  assertEquals(text, config.serialize())
+  assertEquals('vt.default_utf8=1 splash="silent"', config.globals.get('append'))
+  assertEquals(True, config.globals.get('lba32'))
+  assertEquals('50', config.globals.get('timeout'))
+  assertEquals(None, config.globals.get('prompt'))
+  assertEquals(['/boot/vmlinuz', '/dev/sda2'], [s.target for s in config.sections])
+  assertEquals(['Salix', 'Windows'], [s.label for s in config.sections])
+  assertEquals(['# Salix Linux section'], config.sections[0].header)
+  assertEquals(True, config.sections[0].get('read-only'))
+  assertEquals([], config.diff(LiloConfig.parse(text)))
+  # relabel
+  other = LiloConfig.parse(text)
+  other.findSection('/dev/sda2').setLabel('Win7')
+  assertEquals([('changed', '/dev/sda2')], config.diff(other))
+  assertEquals(['# Win7 section', 'other = /dev/sda2', '  label = Win7'], other.findSection('/dev/sda2').lines())
+  # reorder
+  other = LiloConfig.parse(text)
+  other.sections.reverse()
+  assertEquals([('moved', '/dev/sda2'), ('moved', '/boot/vmlinuz')], config.diff(other))
+  # add and remove
+  other = LiloConfig.parse(text)
+  other.sections.remove(other.findSection('/dev/sda2'))
+  other.sections.append(LiloImageSection('/boot/vmlinuz-huge', 'Huge', '/dev/sda1', comment = 'Huge section'))
+  assertEquals([('removed', '/dev/sda2'), ('added', '/boot/vmlinuz-huge')], config.diff(other))
+  # update: the global option and the new section are written, the untouched section is kept as it was read
+  other.globals.set('timeout', 100)
+  salixLines = config.findSection('/boot/vmlinuz').lines()
+  assertEquals([('global', 'timeout'), ('removed', '/dev/sda2'), ('added', '/boot/vmlinuz-huge')], config.update(other))
+  assertEquals(salixLines, config.findSection('/boot/vmlinuz').lines())
+  assertEquals(text.split('\n# Windows section\n')[0].replace('timeout = 50 # tenths of second', 'timeout = 100') + """
+# Huge section
+  image = /boot/vmlinuz-huge
+  root = /dev/sda1
+  read-only
+  label = Huge
+
+""", config.serialize())
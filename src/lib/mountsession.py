@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Mount session for BootSetup.
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import atexit
+import codecs
+import weakref
+import tempfile
+from threading import Lock
+import salix_livetools_library as sltl
+
+_openSessions = weakref.WeakSet()
+
+def _closeSessions():
+  """
+  Closes, at exit, the sessions that are still alive.
+  """
+  for session in list(_openSessions):
+    session.close()
+
+atexit.register(_closeSessions)
+
+class MountSession:
+  """
+  Keeps track of the partitions mounted by BootSetup, with a reference count for each of them.
+  A partition which is already mounted is reused and never unmounted.
+  If the session is persistent, the partitions it mounted stay mounted when they are released and are only unmounted by close, which is called at exit, or when the session is garbage collected, at the latest.
+  close also removes the temporary directory of the automatic mount points.
+  Else they are unmounted as soon as they are not referenced anymore.
+  Different devices can be acquired in parallel from several threads.
+  """
+
+  isTest = False
+  persistent = True
+  _dir = None
+  _mounts = {}
+  _order = []
+
+  def __init__(self, isTest, persistent = True):
+    self.isTest = isTest
+    self.persistent = persistent
+    self._dir = None
+    self._mounts = {}
+    self._order = []
+    self._lock = Lock()
+    self._deviceLocks = {}
+    _openSessions.add(self)
+
+  def __del__(self):
+    if self._order or self._dir: # even with nothing mounted, the directory of the mount points could have been created
+      self.close()
+
+  def __debug(self, msg):
+    if self.isTest:
+      print "Debug: " + msg
+      with codecs.open("bootsetup.log", "a+", "utf-8") as fdebug:
+        fdebug.write("Debug: {0}\n".format(msg))
+
+  def _key(self, device):
+    if device.startswith('/'):
+      return os.path.realpath(device)
+    else:
+      return device # UUID=… or LABEL=… from a fstab
+
+  def _autoMountPoint(self, device):
+    if not self._dir:
+      self._dir = tempfile.mkdtemp(prefix = "bootsetup.mounts-")
+    return os.path.join(self._dir, os.path.basename(device))
+
+  def getMountPoint(self, device):
+    """
+    Returns the mount point of 'device' if it is referenced in this session, else None.
+    """
+    with self._lock:
+      entry = self._mounts.get(self._key(device))
+      return entry and entry['mountPoint'] or None
+
+  def plannedMountPoint(self, device):
+    """
+    Returns the mount point that acquire would return for 'device', without mounting it.
+    """
+    mp = self.getMountPoint(device) or (device.startswith('/') and sltl.getMountPoint(device))
+    if mp:
+      return mp
+    with self._lock:
+      return self._autoMountPoint(device)
+
+  def _deviceLock(self, key):
+    """
+    Only one thread at a time mounts or unmounts a device, the others can run in parallel.
+    """
+    with self._lock:
+      return self._deviceLocks.setdefault(key, Lock())
+
+  def acquire(self, device, fsType = None, mountPoint = None):
+    """
+    Returns the mount point of 'device', mounting it if needed, or False if it cannot be mounted.
+    If 'mountPoint' is not specified, a directory of the session is used.
+    Each successful call should be balanced with a call to release.
+    """
+    key = self._key(device)
+    with self._deviceLock(key):
+      with self._lock:
+        entry = self._mounts.get(key)
+        if entry and entry['owned'] and not os.path.ismount(entry['mountPoint']):
+          self.__debug("{0} is not mounted anymore on {1}".format(device, entry['mountPoint']))
+          del self._mounts[key]
+          self._order.remove(key)
+          entry = None
+        if entry:
+          entry['count'] += 1
+          return entry['mountPoint']
+        if not mountPoint:
+          mountPoint = self._autoMountPoint(device)
+          auto = True
+        else:
+          auto = False
+      mp = device.startswith('/') and sltl.getMountPoint(device)
+      if mp:
+        self.__debug("{0} already mounted on {1}, reuse it".format(device, mp))
+        entry = {'device':device, 'mountPoint':mp, 'owned':False, 'auto':False, 'count':1}
+      else:
+        mp = sltl.mountDevice(device, fsType = fsType, mountPoint = mountPoint)
+        if not mp:
+          self.__debug("cannot mount {0}".format(device))
+          if auto:
+            self._removeMountPoint(mountPoint)
+          return False
+        self.__debug("{0} mounted on {1}".format(device, mp))
+        entry = {'device':device, 'mountPoint':mp, 'owned':True, 'auto':auto, 'count':1}
+      with self._lock:
+        self._mounts[key] = entry
+        self._order.append(key)
+      return mp
+
+  def release(self, device):
+    """
+    Releases a reference to 'device'.
+    A non-persistent session unmounts it once it is not referenced anymore.
+    """
+    key = self._key(device)
+    with self._deviceLock(key):
+      with self._lock:
+        entry = self._mounts.get(key)
+        if not entry:
+          return
+        entry['count'] = max(0, entry['count'] - 1)
+        if entry['count'] > 0 or self.persistent:
+          return
+        del self._mounts[key]
+        self._order.remove(key)
+      self._umount(entry)
+
+  def _removeMountPoint(self, mountPoint):
+    try:
+      os.rmdir(mountPoint)
+    except OSError:
+      pass
+
+  def _umount(self, entry):
+    if entry['owned']:
+      self.__debug("umount {0} from {1}".format(entry['device'], entry['mountPoint']))
+      if sltl.umountDevice(entry['mountPoint'], deleteMountPoint = False) and entry['auto']:
+        self._removeMountPoint(entry['mountPoint'])
+
+  def close(self):
+    """
+    Unmounts every partition mounted by this session, the last mounted first so that nested mounts go before their parent.
+    """
+    with self._lock:
+      entries = [self._mounts[key] for key in reversed(self._order)]
+      self._mounts = {}
+      self._order = []
+    for entry in entries:
+      self._umount(entry)
+    with self._lock:
+      if self._dir:
+        self._removeMountPoint(self._dir)
+        self._dir = None
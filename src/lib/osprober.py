@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Native os-prober for BootSetup.
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import glob
+import codecs
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+from time import time
+import salix_livetools_library as sltl
+
+class OsProber:
+  """
+  Probes the partitions for operating systems, using the os-prober tests, but every partition in parallel.
+  os-prober itself probes the partitions one after another and mounts them on a shared directory, so it cannot be run in parallel.
+  Here each partition is mounted read-only on its own directory, then the 'mounted' tests of os-prober are run on it.
+  """
+
+  isTest = False
+  maxWorkers = 4
+  timings = {}
+  _probesDir = '/usr/lib/os-probes'
+  _mountedTest = '50mounted-tests' # replaced by the mount done here
+  _skippedFsTypes = (False, '', 'Extended', 'swap', 'LVM2_member', 'linux_raid_member', 'crypto_LUKS')
+
+  def __init__(self, isTest, maxWorkers = None):
+    self.isTest = isTest
+    if maxWorkers:
+      self.maxWorkers = maxWorkers
+    self.timings = {}
+
+  def __debug(self, msg):
+    if self.isTest:
+      print "Debug: " + msg
+      with codecs.open("bootsetup.log", "a+", "utf-8") as fdebug:
+        fdebug.write("Debug: {0}\n".format(msg))
+
+  def isAvailable(self):
+    """
+    Returns True if the os-prober tests are installed, else /usr/sbin/os-prober should be used.
+    """
+    return os.path.isdir(os.path.join(self._probesDir, 'mounted'))
+
+  def _listTests(self, subDir = None):
+    if subDir:
+      pattern = os.path.join(self._probesDir, subDir, '*')
+    else:
+      pattern = os.path.join(self._probesDir, '*')
+    return [t for t in sorted(glob.glob(pattern)) if os.path.isfile(t) and os.access(t, os.X_OK) and os.path.basename(t) != self._mountedTest]
+
+  def _runTests(self, tests, args):
+    """
+    Like os-prober, the first test that succeeds gives the result.
+    """
+    for test in tests:
+      try:
+        return sltl.execGetOutput([test] + args, shell = False)
+      except subprocess.CalledProcessError:
+        pass
+      except OSError:
+        pass
+    return []
+
+  def probeRunningSystem(self, device, fstype):
+    """
+    Returns the probe lines of the running system, mounted on '/' from 'device', which os-prober does not probe.
+    Only the linux distribution test is used.
+    """
+    return self._runTests([os.path.join(self._probesDir, 'mounted', '90linux-distro')], [device, '/', fstype])
+
+  def _probePartition(self, partition):
+    """
+    Returns the probe lines for 'partition', which is a row of Config.partitions.
+    """
+    start = time()
+    device = os.path.join('/dev', partition[0])
+    fstype = partition[1]
+    probes = []
+    try:
+      probes = self._runTests(self._tests, [device])
+      if not probes and fstype not in self._skippedFsTypes:
+        mp = sltl.getMountPoint(device)
+        if mp == '/':
+          pass # like os-prober, do not probe the running system
+        elif mp:
+          probes = self._runTests(self._mountedTests, [device, mp, fstype])
+        else:
+          mp = os.path.join(self._mountDir, partition[0])
+          os.mkdir(mp)
+          try:
+            if sltl.execCall(['mount', '-o', 'ro', '-t', fstype, device, mp], shell = False) == 0:
+              try:
+                probes = self._runTests(self._mountedTests, [device, mp, fstype])
+              finally:
+                sltl.execCall(['umount', mp], shell = False)
+          finally:
+            try:
+              os.rmdir(mp)
+            except OSError:
+              pass # still mounted, never remove its content
+    finally:
+      self.timings[partition[0]] = time() - start
+    return probes
+
+  def iprobe(self, partitions):
+    """
+    Generator of (partition, probes) tuples, in the same order as 'partitions', each one yielded as soon as it is probed.
+    'partitions' is a list of rows of Config.partitions: [device, fstype, description].
+    'probes' are the os-prober formatted lines (device:os:label:boottype) for that partition.
+    The time taken for each partition is stored in 'timings', keyed by device.
+    """
+    self.timings = {}
+    if not partitions:
+      return
+    self._tests = self._listTests()
+    self._mountedTests = self._listTests('mounted')
+    for init in self._listTests('init'):
+      sltl.execCall([init], shell = False)
+    self._mountDir = tempfile.mkdtemp(prefix = "bootsetup.osprober-")
+    pool = ThreadPool(max(1, min(self.maxWorkers, len(partitions))))
+    try:
+      for p, probes in zip(partitions, pool.imap(self._probePartition, partitions)):
+        self.__debug("probe of {0} took {1:.2f}s".format(p[0], self.timings.get(p[0], 0)))
+        yield (p, probes)
+    finally:
+      pool.close()
+      pool.join()
+      sltl.invalidateMountTable()
+      try:
+        os.rmdir(self._mountDir)
+      except OSError:
+        pass
+
+  def probe(self, partitions):
+    """
+    Returns the os-prober formatted lines (device:os:label:boottype) for the given partitions, in the same order.
+    See iprobe.
+    """
+    return [line for (p, probes) in self.iprobe(partitions) for line in probes]
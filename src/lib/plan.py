@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Execution plan for BootSetup.
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import json
+import traceback
+from time import time
+from multiprocessing.pool import ThreadPool
+
+class Plan:
+  """
+  Ordered list of the steps of an installation: mount, bind, write, exec…, each one depending on previous steps.
+  The plan is built without touching anything, so it can be printed or serialized to JSON, then executed.
+  A step without action is only described, like the commands that are not run in test mode.
+  Cleanup steps (umount, release…) are run after the other steps, in reverse order, if the steps they depend on succeeded.
+  Steps whose dependencies are all done are run together, in parallel if maxWorkers > 1.
+  """
+
+  isTest = False
+  maxWorkers = 1
+  steps = []
+
+  def __init__(self, isTest, maxWorkers = 1):
+    self.isTest = isTest
+    self.maxWorkers = maxWorkers
+    self.steps = []
+    self._actions = {}
+    self._results = {}
+
+  def add(self, kind, description, action = None, args = None, dependsOn = None, cleanup = False, failure = None):
+    """
+    Adds a step and returns its id.
+    'kind' is the type of step: mount, bind, umount, release, mkdir, write, exec…
+    'action' is the function run by the step. The step fails if it raises an exception or returns a false value, in which case 'failure' is the error.
+    'args' is a dictionary describing what the step works on, for the JSON output.
+    'dependsOn' is the list of ids of the steps that must be done before, by default the previous non cleanup step.
+    """
+    if dependsOn is None:
+      previous = [s['id'] for s in self.steps if not s['cleanup']]
+      dependsOn = previous[-1:]
+    step = {
+        'id':len(self.steps),
+        'kind':kind,
+        'description':description,
+        'args':args or {},
+        'dependsOn':list(dependsOn),
+        'cleanup':cleanup,
+        'runnable':action is not None,
+        'status':'pending',
+        'duration':None,
+        'error':None,
+      }
+    self.steps.append(step)
+    self._actions[step['id']] = (action, failure or description + ": failed")
+    return step['id']
+
+  def result(self, stepId):
+    """
+    Returns what the action of the step returned, None if it has not been run.
+    """
+    return self._results.get(stepId)
+
+  def describe(self):
+    """
+    Returns the plan as a list of printable lines.
+    """
+    lines = []
+    for step in self.steps:
+      line = "{0:>3}. [{1}] {2}".format(step['id'], step['kind'], step['description'])
+      if step['dependsOn']:
+        line += " (after {0})".format(", ".join([unicode(d) for d in step['dependsOn']]))
+      if not step['runnable']:
+        line += " (not run)"
+      if step['status'] != 'pending':
+        line += " => {0}".format(step['status'])
+        if step['duration'] is not None:
+          line += " in {0:.3f}s".format(step['duration'])
+        if step['error']:
+          line += ": {0}".format(step['error'])
+      lines.append(line)
+    return lines
+
+  def toJson(self):
+    return json.dumps({'test':self.isTest, 'steps':self.steps}, indent = 2, sort_keys = True)
+
+  def errors(self):
+    """
+    Returns the errors of the failed steps, in the order of the plan.
+    """
+    return [step['error'] for step in self.steps if step['status'] == 'failed']
+
+  def _run(self, step):
+    (action, failure) = self._actions[step['id']]
+    if not action:
+      step['status'] = 'described'
+      return
+    start = time()
+    try:
+      res = action()
+      if res:
+        step['status'] = 'done'
+      else:
+        step['status'] = 'failed'
+        step['error'] = failure
+    except Exception as e:
+      step['status'] = 'failed'
+      step['error'] = unicode(e) or traceback.format_exc()
+      res = None
+    step['duration'] = time() - start
+    self._results[step['id']] = res
+
+  def _ready(self, step):
+    """
+    Returns True if the step can be run, False if it must be skipped, None if it must wait.
+    """
+    statuses = [self.steps[d]['status'] for d in step['dependsOn']]
+    if [s for s in statuses if s in ('failed', 'skipped')]:
+      return False
+    if [s for s in statuses if s == 'pending']:
+      return None
+    return True
+
+  def execute(self, dryRun = False):
+    """
+    Runs the steps and returns True if none failed.
+    In dry run, nothing is run and every step is marked as planned.
+    A failed step skips the steps depending on it, but the cleanup steps are still run for what has been done.
+    """
+    if dryRun:
+      for step in self.steps:
+        step['status'] = 'planned'
+      return True
+    main = [step for step in self.steps if not step['cleanup']]
+    pool = None
+    if self.maxWorkers > 1:
+      pool = ThreadPool(self.maxWorkers)
+    try:
+      pending = list(main)
+      while pending:
+        wave = []
+        for step in pending:
+          ready = self._ready(step)
+          if ready is False:
+            step['status'] = 'skipped'
+          elif ready:
+            wave.append(step)
+        pending = [step for step in pending if step['status'] == 'pending' and step not in wave]
+        if not wave:
+          if pending: # dependencies on cleanup or later steps, cannot be satisfied
+            for step in pending:
+              step['status'] = 'skipped'
+          break
+        if pool and len(wave) > 1:
+          pool.map(self._run, wave)
+        else:
+          for step in wave:
+            self._run(step)
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+      for step in reversed([step for step in self.steps if step['cleanup']]):
+        if [d for d in step['dependsOn'] if self.steps[d]['status'] != 'done']:
+          step['status'] = 'skipped'
+        else:
+          self._run(step)
+    return not self.errors()
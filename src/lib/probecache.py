@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Persistent cache of the partitions probes for BootSetup.
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import json
+import codecs
+import struct
+import tempfile
+import salix_livetools_library as sltl
+
+class ProbeCache:
+  """
+  Keeps the os-prober results of the partitions from one BootSetup run to another.
+  Each partition is keyed by its identity: partition table ID of its disk, partition and filesystem UUIDs, size and a generation read from the superblock, like the last write time of ext filesystems.
+  A partition whose identity changed is probed again, unchanged ones are reused.
+  """
+
+  _path = '/var/cache/bootsetup/probes.json'
+  _version = 2
+  _entries = {}
+  _used = set()
+
+  def __init__(self, path = None):
+    if path:
+      self._path = path
+    self._entries = {}
+    self._used = set()
+    self.load()
+
+  def load(self):
+    try:
+      with codecs.open(self._path, 'r', 'utf-8') as f:
+        data = json.load(f)
+      if data.get('version') == self._version:
+        self._entries = data.get('partitions', {})
+    except (IOError, ValueError):
+      self._entries = {}
+
+  def save(self):
+    """
+    Writes the cache, only keeping the partitions seen during this run.
+    The cache is written to a new file then renamed, so that an interrupted run leaves the previous one.
+    Errors are ignored: the cache is only an optimization, the filesystem could be read-only on a Live system.
+    """
+    entries = dict([(k, v) for (k, v) in self._entries.items() if k in self._used])
+    try:
+      if not os.path.isdir(os.path.dirname(self._path)):
+        os.makedirs(os.path.dirname(self._path), 0o755)
+      (fd, tmp) = tempfile.mkstemp(prefix = '.' + os.path.basename(self._path) + '.', dir = os.path.dirname(self._path))
+      try:
+        with codecs.getwriter('utf-8')(os.fdopen(fd, 'w')) as f:
+          json.dump({'version':self._version, 'partitions':entries}, f)
+          f.flush()
+          os.fsync(f.fileno())
+        os.rename(tmp, self._path)
+      except:
+        if os.path.exists(tmp):
+          os.remove(tmp)
+        raise
+    except (IOError, OSError):
+      pass
+
+  def clear(self):
+    self._entries = {}
+
+  def _read(self, device, offset, fmt):
+    """
+    Returns the values unpacked with 'fmt' at 'offset' of 'device', or None if it cannot be read.
+    """
+    try:
+      with open(device, 'rb') as f:
+        f.seek(offset)
+        return struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+    except (IOError, struct.error):
+      return None
+
+  def _readExtGeneration(self, device):
+    """
+    s_wtime of the ext2/3/4 superblock: 1024 bytes offset, then 0x30 bytes.
+    """
+    return self._read(device, 1024 + 0x30, b'<I')
+
+  def _readBtrfsGeneration(self, device):
+    """
+    generation of the btrfs superblock, increased by each transaction: 64 KiB offset, then 0x48 bytes.
+    """
+    return self._read(device, 0x10000 + 0x48, b'<Q')
+
+  def _readXfsGeneration(self, device):
+    """
+    xfs has no write time: sb_icount, sb_ifree and sb_fdblocks, updated in the superblock at unmount.
+    """
+    return self._read(device, 0x80, b'>QQQ')
+
+  def _readNtfsGeneration(self, device):
+    """
+    $LogFile sequence number of the $Volume record (the fourth of the MFT), changed by each mount.
+    The boot sector has the MFT cluster at 0x30 and the clusters per MFT record at 0x40, negative for a size of 2^-n bytes.
+    """
+    boot = self._read(device, 0x0B, b'<HB')
+    mftCluster = self._read(device, 0x30, b'<Q')
+    clustersPerRecord = self._read(device, 0x40, b'<b')
+    if not (boot and mftCluster and clustersPerRecord):
+      return None
+    (bytesPerSector, sectorsPerCluster) = boot
+    if sectorsPerCluster > 0x80:
+      sectorsPerCluster = 1 << (256 - sectorsPerCluster)
+    clusterSize = bytesPerSector * sectorsPerCluster
+    if clustersPerRecord[0] > 0:
+      recordSize = clustersPerRecord[0] * clusterSize
+    else:
+      recordSize = 1 << -clustersPerRecord[0]
+    return self._read(device, mftCluster[0] * clusterSize + 3 * recordSize + 8, b'<Q')
+
+  def _readVfatGeneration(self, device):
+    """
+    Free clusters count and next free cluster of the FAT32 FSInfo sector, updated at unmount.
+    FAT12/16 have nothing like it: False.
+    """
+    boot = self._read(device, 0x0B, b'<H')
+    info = self._read(device, 48, b'<H')
+    fat32 = self._read(device, 82, b'5s')
+    if not (boot and info and fat32):
+      return None
+    if fat32[0] != b'FAT32' or not info[0]:
+      return False
+    fsinfo = self._read(device, info[0] * boot[0], b'<4s480x4sII')
+    if not fsinfo or fsinfo[0:2] != (b'RRaA', b'rrAa'):
+      return False
+    return fsinfo[2:]
+
+  _generations = {
+      'ext2':_readExtGeneration,
+      'ext3':_readExtGeneration,
+      'ext4':_readExtGeneration,
+      'btrfs':_readBtrfsGeneration,
+      'xfs':_readXfsGeneration,
+      'ntfs':_readNtfsGeneration,
+      'vfat':_readVfatGeneration,
+    }
+
+  def identity(self, partition, fstype):
+    """
+    Returns the identity key of the partition (without /dev/) or None if it cannot be identified.
+    A filesystem is only identified if a generation, changed by its writes, can be read from its superblock: else an OS installed or upgraded on it would stay unnoticed.
+    This is also the case if the superblock cannot be read.
+    """
+    disks, partitions = sltl.getInventory()
+    record = partitions.get(partition)
+    if not record:
+      return None
+    fsTags = sltl.scanFilesystems()
+    partTags = fsTags.get(partition, {})
+    diskTags = fsTags.get(record.disk, {})
+    if not (record.uuid or partTags.get('PARTUUID')):
+      return None
+    if fstype not in self._generations:
+      return None # an install or upgrade would not be noticed
+    generation = self._generations[fstype](self, os.path.join('/dev', partition))
+    if generation is None or generation is False:
+      return None
+    generation = '-'.join([unicode(g) for g in generation])
+    return '/'.join([unicode(v or '') for v in (diskTags.get('PTUUID'), partTags.get('PARTUUID'), record.uuid, record.size, fstype, generation)])
+
+  def get(self, identity):
+    """
+    Returns the cached entry (dictionary with a 'probes' key) or None.
+    The file system and description are not cached, they are taken from the inventory which is always fresh.
+    The probes do not contain the device, which could have been renamed: only 'os:label:boottype'.
+    """
+    if identity and identity in self._entries:
+      self._used.add(identity)
+      return self._entries[identity]
+    return None
+
+  def set(self, identity, probes):
+    if identity:
+      self._used.add(identity)
+      self._entries[identity] = {'probes':probes}
+
+# Unit test
+if __name__ == '__main__':
+  from salix_livetools_library.assertPlus import *
+  import shutil
+  tmp = tempfile.mkdtemp()
+  def image(name, chunks, size = 0x20000):
+    path = os.path.join(tmp, name)
+    data = bytearray(size)
+    for (offset, raw) in chunks:
+      data[offset:offset + len(raw)] = raw
+    open(path, 'wb').write(bytes(data))
+    return path
+  try:
+    cache = ProbeCache(os.path.join(tmp, 'cache', 'probes.json'))
+    assertEquals((0x52A5E0F1,), cache._readExtGeneration(image('ext4', [(1024 + 0x30, struct.pack(b'<I', 0x52A5E0F1))])))
+    assertEquals((7,), cache._readBtrfsGeneration(image('btrfs', [(0x10048, struct.pack(b'<Q', 7))])))
+    # ntfs: 512 bytes per sector, 8 sectors per cluster, MFT at cluster 2, $MFTMirr at cluster 0x1000, 1 KiB records
+    ntfs = image('ntfs', [(3, b'NTFS    '), (0x0B, struct.pack(b'<HB', 512, 8)), (0x30, struct.pack(b'<QQ', 2, 0x1000)), (0x40, struct.pack(b'<b', -10)), (2 * 4096 + 3 * 1024 + 8, struct.pack(b'<Q', 0x1111))])
+    assertEquals((0x1111,), cache._readNtfsGeneration(ntfs))
+    assertEquals(None, cache._readNtfsGeneration(os.path.join(tmp, 'missing')))
+    fat32 = image('fat32', [(0x0B, struct.pack(b'<H', 512)), (48, struct.pack(b'<H', 1)), (82, b'FAT32   '), (512, b'RRaA'), (512 + 484, b'rrAa'), (512 + 488, struct.pack(b'<II', 1000, 42))])
+    assertEquals((1000, 42), cache._readVfatGeneration(fat32))
+    assertEquals(False, cache._readVfatGeneration(image('fat16', [(0x0B, struct.pack(b'<H', 512)), (54, b'FAT16   ')])))
+    # only the partitions used during the run are saved, and the cache is replaced as a whole
+    cache.set('a', ['Slackware:Salix:linux'])
+    cache.save()
+    cache = ProbeCache(cache._path)
+    assertEquals({'probes':['Slackware:Salix:linux']}, cache.get('a'))
+    cache.save()
+    assertEquals({'probes':['Slackware:Salix:linux']}, ProbeCache(cache._path).get('a'))
+    ProbeCache(cache._path).save()
+    assertEquals(None, ProbeCache(cache._path).get('a'))
+    assertEquals(['probes.json'], os.listdir(os.path.dirname(cache._path)))
+  finally:
+    shutil.rmtree(tmp)
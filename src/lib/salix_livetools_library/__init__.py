@@ -3,22 +3,79 @@
 # vim: set et ai sta sw=2 ts=2 tw=0:
 """
 Salix Live Installer library used by both the GUI and the Ncurses installers.
+A module of the library is only loaded when one of its names is used for the first time, so importing the library costs nothing.
+'from salix_livetools_library import *' still loads every module.
 """
 from __future__ import unicode_literals
 
 __copyright__ = 'Copyright 2011-2013, Salix OS'
 __license__ = 'GPL2+'
-from bootloader import *
-from chroot import *
-from disk import *
-from execute import *
-from freesize import *
-from fs import *
-from fstab import *
-from kernel import *
-from keyboard import *
-from language import *
-from mounting import *
-from salt import *
-from timezone import *
-from user import *
+import sys
+import types
+import importlib
+
+# (module, public names), in the order of the former star imports: a name not listed here is looked for in every module
+_exports = [
+    ('bootloader', ['isBootsetupAvailable', 'runBootsetup']),
+    ('chroot', ['execChroot']),
+    ('disk', ['DiskRecord', 'PartitionRecord', 'getDiskInfo', 'getDisks', 'getInventory', 'getPartitionInfo', 'getPartitions', 'getSwapPartitions']),
+    ('execute', ['ExecTimeoutError', 'ShellWorkerRunner', 'SubprocessRunner', 'checkRoot', 'execBatch', 'execCall', 'execCheck', 'execGetOutput', 'getExecStats', 'getRunner', 'resetExecStats', 'setRunner']),
+    ('filecopy', ['CopyProgress', 'copyFile', 'copyTree', 'getCopyMethods', 'prefetchTree', 'scanTree']),
+    ('freesize', ['getBlockSize', 'getHumanSize', 'getSizes', 'getUsedSize']),
+    ('framebuffer', ['getBestVesaMode', 'getFrameBufferGeometry']),
+    ('fs', ['getDiskPartitionTable', 'getFsLabel', 'getFsType', 'makeFs', 'scanFilesystems']),
+    ('fsinspect', ['canInspect', 'listDirectory', 'readFile']),
+    ('fstab', ['addFsTabEntry', 'createFsTab']),
+    ('kernel', ['getKernelParamValue', 'hasKernelParam']),
+    ('keyboard', ['findCurrentKeymap', 'isIbusEnabledByDefault', 'isNumLockEnabledByDefault', 'listAvailableKeymaps', 'setDefaultKeymap', 'setIbusDefault', 'setNumLockDefault']),
+    ('language', ['getCurrentLocale', 'getDefaultLocale', 'listAvailableLocales', 'setDefaultLocale']),
+    ('mounting', ['getMountPoint', 'getTempMountDir', 'isMounted', 'mountDevice', 'umountDevice']),
+    ('mounttable', ['MountEntry', 'findMountEntry', 'findMountEntryByMountPoint', 'getMountTable', 'invalidateMountTable']),
+    ('salt', ['SaLTEnvironment', 'SaLTModule', 'SaLTModuleSize', 'getSaLTBaseDir', 'getSaLTEnvironment', 'getSaLTIdentFile', 'getSaLTLiveMountPoint', 'getSaLTModulePath', 'getSaLTRootDir', 'getSaLTVersion', 'installSaLTModule', 'installSaLTModules', 'isSaLTLiveCloneEnv', 'isSaLTLiveEnv', 'isSaLTVersionAtLeast', 'listSaLTModules', 'refreshSaLTEnvironment']),
+    ('superblock', ['PartitionEntry', 'PartitionTable', 'getPartitionTable', 'isExtendedBootRecord', 'probeDevice']),
+    ('timezone', ['getDefaultTimeZone', 'isNTPEnabledByDefault', 'listTZCities', 'listTZContinents', 'listTimeZones', 'setDefaultTimeZone', 'setNTPDefault']),
+    ('user', ['changePasswordSystemUser', 'checkPasswordSystemUser', 'createSystemUser', 'deleteSystemUser', 'listRegularSystemUsers']),
+  ]
+_modules = [module for (module, names) in _exports]
+_moduleOf = dict([(name, module) for (module, names) in _exports for name in names])
+
+class _LazyPackage(types.ModuleType):
+  """
+  Stands for this package in sys.modules.
+  A missing attribute is taken from the module that defines it, which is imported then, and kept for the next uses.
+  """
+
+  def __init__(self, package):
+    types.ModuleType.__init__(self, package.__name__, package.__doc__)
+    self.__dict__.update(package.__dict__)
+    self._package = package # the globals of a destroyed module are set to None
+
+  def _import(self, module):
+    return importlib.import_module(self.__name__ + '.' + module)
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    if name in _modules:
+      return self._import(name)
+    if name in _moduleOf:
+      candidates = [_moduleOf[name]]
+    else:
+      candidates = _modules
+    for module in candidates:
+      m = self._import(module)
+      if hasattr(m, name):
+        value = getattr(m, name)
+        setattr(self, name, value)
+        return value
+    raise AttributeError(name)
+
+  @property
+  def __all__(self):
+    names = []
+    for module in _modules:
+      m = self._import(module)
+      names.extend([n for n in dir(m) if not n.startswith('_') and n not in names and not isinstance(getattr(m, n), types.ModuleType)])
+    return names
+
+sys.modules[__name__] = _LazyPackage(sys.modules[__name__])
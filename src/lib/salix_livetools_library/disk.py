@@ -5,7 +5,9 @@
 Get information from the system disks and partitions.
 For now it only handles (S/P)ATA disks and partitions, RAID and LVM are not supported yet.
 /proc and /sys should be mounted to retrieve information.
+All information is taken from an inventory built in one pass (see getInventory).
 Functions:
+  - getInventory
   - getDisks
   - getDiskInfo
   - getPartitions
@@ -19,21 +21,81 @@ __license__ = 'GPL2+'
 from execute import *
 from fs import *
 from freesize import *
-import glob
+from collections import namedtuple
 import re
 import os
 from stat import *
 
+DiskRecord = namedtuple('DiskRecord', ['device', 'model', 'size', 'sizeHuman', 'removable', 'partitions', 'partitionTable'])
+PartitionRecord = namedtuple('PartitionRecord', ['device', 'disk', 'fstype', 'label', 'uuid', 'size', 'sizeHuman', 'number', 'partType', 'flags'])
+_inventory = None
+_sysSectorSize = 512 # unit of the sizes in sysfs, whatever the logical block size of the disk
+
+def _readSysValue(path, default = None):
+  try:
+    return open(path, 'r').read().strip()
+  except IOError:
+    return default
+
+def _isSupportedDisk(device):
+  return re.match(r'^sd[^0-9]+$', device) is not None
+
+def getInventory(refresh = False):
+  """
+  Returns the inventory of the disks and partitions as a tuple (disks, partitions):
+    - disks: list of DiskRecord (device, model, size, sizeHuman, removable, partitions, partitionTable) of every whole disk, in /proc/partitions order.
+      Its partitions are ordered by number, partitionTable is 'dos', 'gpt' or None.
+    - partitions: dictionary of PartitionRecord (device, disk, fstype, label, uuid, size, sizeHuman, number, partType, flags) keyed by partition device.
+      partType and flags come from the partition table (see superblock.getPartitionTable), they are None and an empty set if it cannot be read.
+  Devices are not prefixed with '/dev/'.
+  The partition table of each disk is read once, in-process, and shared with scanFilesystems (see fs.getDiskPartitionTable).
+  The filesystems are probed in-process from their superblocks, blkid being only called once for the unknown ones (see scanFilesystems), the rest is read from /proc and /sys.
+  The inventory is cached, use 'refresh' to build it again, after a partitioning change for example.
+  """
+  global _inventory
+  if _inventory is None or refresh:
+    fsTags = scanFilesystems(refresh)
+    names = [l.split()[-1] for l in open('/proc/partitions', 'r').read().splitlines()[2:] if l.strip()]
+    disks = []
+    partitions = {}
+    for diskDevice in [n for n in names if os.path.isdir('/sys/block/{0}'.format(n))]:
+      sysDir = '/sys/block/{0}'.format(diskDevice)
+      size = int(_readSysValue('{0}/size'.format(sysDir), 0)) * _sysSectorSize
+      table = getDiskPartitionTable(diskDevice)
+      entries = dict([(entry.number, entry) for entry in (table and table.entries or [])])
+      numbers = {}
+      for n in names:
+        if n != diskDevice and os.path.exists('{0}/{1}/partition'.format(sysDir, n)):
+          numbers[n] = int(_readSysValue('{0}/{1}/partition'.format(sysDir, n), 0))
+      parts = sorted(numbers, key = lambda n: numbers[n])
+      for partDevice in parts:
+        entry = entries.get(numbers[partDevice])
+        tags = fsTags.get(partDevice, {})
+        fstype = tags.get('TYPE', False)
+        if not fstype:
+          if entry:
+            fstype = 'extended' in entry.flags and 'Extended'
+          else:
+            fstype = getFsType(partDevice) # detects extended partitions
+        partSize = int(_readSysValue('{0}/{1}/size'.format(sysDir, partDevice), 0)) * _sysSectorSize
+        partitions[partDevice] = PartitionRecord(partDevice, diskDevice, fstype, tags.get('LABEL', ''), tags.get('UUID'), partSize, getHumanSize(partSize),
+            numbers[partDevice], entry and entry.type, entry and entry.flags or frozenset())
+      disks.append(DiskRecord(diskDevice, _readSysValue('{0}/device/model'.format(sysDir), ''), size, getHumanSize(size), _readSysValue('{0}/removable'.format(sysDir)) == '1', tuple(parts), table and table.type))
+    _inventory = (disks, partitions)
+  return _inventory
+
+def _getDiskRecord(diskDevice):
+  for disk in getInventory()[0]:
+    if disk.device == diskDevice:
+      return disk
+  return None
+
 def getDisks():
   """
   Returns the disks devices (without /dev/) connected to the computer. 
   RAID and LVM are not supported yet.
   """
-  ret = []
-  for l in open('/proc/partitions', 'r').read().splitlines():
-    if re.search(r' sd[^0-9]+$', l):
-      ret.append(re.sub(r'.*(sd.*)', r'\1', l))
-  return ret
+  return [disk.device for disk in getInventory()[0] if _isSupportedDisk(disk.device)]
 
 def getDiskInfo(diskDevice):
   """
@@ -45,30 +107,29 @@ def getDiskInfo(diskDevice):
   diskDevice should no be prefixed with '/dev/'
   """
   if S_ISBLK(os.stat('/dev/{0}'.format(diskDevice)).st_mode):
-    modelName = open('/sys/block/{0}/device/model'.format(diskDevice), 'r').read().strip()
-    blockSize = int(open('/sys/block/{0}/queue/logical_block_size'.format(diskDevice), 'r').read().strip())
-    size = int(open('/sys/block/{0}/size'.format(diskDevice), 'r').read().strip()) * blockSize
-    sizeHuman = getHumanSize(size)
-    try:
-      removable = int(open('/sys/block/{0}/removable'.format(diskDevice), 'r').read().strip()) == 1
-    except:
-      removable = False
-    return {'model':modelName, 'size':size, 'sizeHuman':sizeHuman, 'removable':removable}
-  else:
-    return None
+    disk = _getDiskRecord(diskDevice)
+    if not disk:
+      getInventory(True) # could have been plugged after the inventory was built
+      disk = _getDiskRecord(diskDevice)
+    if disk:
+      return {'model':disk.model, 'size':disk.size, 'sizeHuman':disk.sizeHuman, 'removable':disk.removable}
+  return None
 
 def getPartitions(diskDevice, skipExtended = True, skipSwap = True):
   """
-  Returns partitions matching exclusion filters.
+  Returns partitions matching exclusion filters, ordered by partition number.
   """
   if S_ISBLK(os.stat('/dev/{0}'.format(diskDevice)).st_mode):
-    parts = [p.replace('/sys/block/{0}/'.format(diskDevice), '') for p in glob.glob('/sys/block/{0}/{0}*'.format(diskDevice))]
+    disk = _getDiskRecord(diskDevice)
+    if not disk:
+      return []
+    partitions = getInventory()[1]
     fsexclude = [False]
     if skipExtended:
       fsexclude.append('Extended')
     if skipSwap:
       fsexclude.append('swap')
-    return [part for part in parts if getFsType(part) not in fsexclude]
+    return [part for part in disk.partitions if partitions[part].fstype not in fsexclude]
   else:
     return None
 
@@ -76,10 +137,10 @@ def getSwapPartitions():
   """
   Returns partition devices with Linux Swap type.
   """
+  disks, partitions = getInventory()
   ret = []
-  for diskDevice in getDisks():
-    parts = [p.replace('/sys/block/{0}/'.format(diskDevice), '') for p in glob.glob('/sys/block/{0}/{0}*'.format(diskDevice))]
-    ret.extend([part for part in parts if getFsType(part) == 'swap'])
+  for disk in [d for d in disks if _isSupportedDisk(d.device)]:
+    ret.extend([part for part in disk.partitions if partitions[part].fstype == 'swap'])
   return ret
 
 def getPartitionInfo(partitionDevice):
@@ -89,16 +150,16 @@ def getPartitionInfo(partitionDevice):
     - label
     - size
     - sizeHuman
+    - number: partition number
+    - type: partition type, type GUID for a gpt table, '0x83' like for a dos one
+    - flags: set of 'boot', 'esp', 'bios_grub', 'extended', 'logical'
   """
   checkRoot()
   if S_ISBLK(os.stat('/dev/{0}'.format(partitionDevice)).st_mode):
-    fstype = getFsType(partitionDevice)
-    label = getFsLabel(partitionDevice)
-    diskDevice = re.sub('[0-9]*', '', partitionDevice)
-    blockSize = int(open('/sys/block/{0}/queue/logical_block_size'.format(diskDevice), 'r').read().strip())
-    size = int(open('/sys/block/{0}/{1}/size'.format(diskDevice, partitionDevice), 'r').read().strip()) * blockSize
-    sizeHuman = getHumanSize(size)
-    return {'fstype':fstype, 'label':label, 'size':size, 'sizeHuman':sizeHuman}
+    part = getInventory()[1].get(partitionDevice)
+    if not part:
+      return None
+    return {'fstype':part.fstype, 'label':part.label, 'size':part.size, 'sizeHuman':part.sizeHuman, 'number':part.number, 'type':part.partType, 'flags':part.flags}
   else:
     return None
 
@@ -106,6 +167,10 @@ def getPartitionInfo(partitionDevice):
 if __name__ == '__main__':
   from assertPlus import *
   checkRoot()
+  disks, partitions = getInventory()
+  assertTrue(len(disks) > 0)
+  assertEquals(disks, getInventory()[0]) # cached
+  assertTrue(getInventory(True)[0] is not disks) # rebuilt
   disks = getDisks()
   assertTrue(len(disks) > 0)
   assertEquals('sda', disks[0])
@@ -121,3 +186,6 @@ if __name__ == '__main__':
   assertTrue(partInfo['label'] != '')
   assertTrue(partInfo['size'] > 0)
   assertTrue('B' in partInfo['sizeHuman'])
+  assertEquals(1, partInfo['number'])
+  numbers = [getPartitionInfo(p)['number'] for p in getPartitions('sda', False, False)]
+  assertEquals(sorted(numbers), numbers)
@@ -6,7 +6,16 @@ Functions to execute native commands and get their output:
   - execCall
   - execCheck
   - execGetOutput
+  - execBatch
   - checkRoot
+Commands are run by a runner, which could be changed:
+  - SubprocessRunner: spawns a new process for each command (default).
+  - ShellWorkerRunner: reuses a long-lived /bin/sh for the commands whose output is read, opt-in with setRunner.
+  - getRunner
+  - setRunner
+Statistics about the executed commands:
+  - getExecStats
+  - resetExecStats
 """
 from __future__ import unicode_literals
 
@@ -15,61 +24,316 @@ __license__ = 'GPL2+'
 import subprocess
 import sys
 import os
+import pipes
+import select
+import signal
+import binascii
+from threading import Lock, Timer
+from time import time
 
-def execCall(cmd, shell = True, env = {'LANG' : 'en_US'}):
+_defaultEnv = {'LANG' : 'en_US'}
+_devNull = None
+_statsLock = Lock()
+_stats = None
+_runner = None
+
+class ExecTimeoutError(subprocess.CalledProcessError):
+  """
+  Raised when a command did not finish in the allowed time. The command has been killed.
+  """
+  def __init__(self, cmd, timeout):
+    subprocess.CalledProcessError.__init__(self, -signal.SIGKILL, cmd)
+    self.timeout = timeout
+  def __str__(self):
+    return "Command '{0}' timed out after {1} seconds".format(self.cmd, self.timeout)
+
+def _getDevNull():
+  global _devNull
+  if _devNull is None:
+    _devNull = open(os.devnull, 'r+b')
+  return _devNull
+
+def _commandName(cmd):
+  if isinstance(cmd, list):
+    name = cmd and cmd[0] or ''
+  else:
+    name = (cmd.split() or [''])[0]
+  return os.path.basename(name)
+
+def resetExecStats():
+  """
+  Resets the statistics returned by getExecStats.
+  """
+  global _stats
+  with _statsLock:
+    _stats = {'spawns':0, 'calls':0, 'time':0.0, 'commands':{}}
+
+def _recordSpawn():
+  with _statsLock:
+    _stats['spawns'] += 1
+
+def _recordCall(cmd, duration):
+  with _statsLock:
+    _stats['calls'] += 1
+    _stats['time'] += duration
+    cmdStats = _stats['commands'].setdefault(_commandName(cmd), {'calls':0, 'time':0.0})
+    cmdStats['calls'] += 1
+    cmdStats['time'] += duration
+
+def getExecStats():
+  """
+  Returns a dictionary with the statistics of the executed commands since the last reset:
+    - spawns: number of processes spawned by the runners (a batch or a reused shell worker counts only once).
+    - calls: number of executed commands.
+    - time: total wall time spent in commands, in seconds.
+    - commands: dictionary, keyed by command name, of dictionaries with 'calls' and 'time' keys.
+  """
+  with _statsLock:
+    ret = dict(_stats)
+    ret['commands'] = dict([(k, dict(v)) for (k, v) in _stats['commands'].items()])
+  return ret
+
+class SubprocessRunner:
+  """
+  Runs each command in its own process, /bin/sh being used if 'shell' is True.
+  """
+
+  def _popen(self, cmd, shell, env, timeout, **kwargs):
+    if shell and isinstance(cmd, list):
+      cmd = ' '.join(cmd)
+    if timeout:
+      kwargs['preexec_fn'] = os.setsid # to be able to kill the whole process group
+    p = subprocess.Popen(cmd, shell = shell, env = env, **kwargs)
+    _recordSpawn()
+    return p
+
+  def _wait(self, p, cmd, timeout, communicate = False):
+    timedOut = []
+    timer = None
+    if timeout:
+      def kill():
+        timedOut.append(True)
+        try:
+          os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+          pass
+      timer = Timer(timeout, kill)
+      timer.start()
+    try:
+      if communicate:
+        output = p.communicate()[0]
+      else:
+        output = None
+        p.wait()
+    finally:
+      if timer:
+        timer.cancel()
+    if timedOut:
+      raise ExecTimeoutError(cmd, timeout)
+    return output
+
+  def call(self, cmd, shell, env, timeout = None):
+    start = time()
+    try:
+      p = self._popen(cmd, shell, env, timeout)
+      self._wait(p, cmd, timeout)
+      return p.returncode
+    finally:
+      _recordCall(cmd, time() - start)
+
+  def getOutput(self, cmd, withError, shell, env, timeout = None):
+    start = time()
+    try:
+      if withError:
+        stdErr = subprocess.STDOUT
+      else:
+        stdErr = _getDevNull()
+      p = self._popen(cmd, shell, env, timeout, stdout = subprocess.PIPE, stderr = stdErr)
+      output = self._wait(p, cmd, timeout, communicate = True)
+    finally:
+      _recordCall(cmd, time() - start)
+    if p.returncode == 0:
+      return output.splitlines()
+    else:
+      raise subprocess.CalledProcessError(returncode = p.returncode, cmd = cmd)
+
+  def batch(self, cmds, withError, shell, timeout = None):
+    """
+    The commands are all run by one short-lived shell, see ShellWorkerRunner.
+    """
+    if not cmds:
+      return []
+    worker = ShellWorkerRunner()
+    try:
+      return worker.batch(cmds, withError, shell, timeout)
+    finally:
+      worker.stop()
+
+  def stop(self):
+    pass
+
+class ShellWorkerRunner(SubprocessRunner):
+  """
+  Reuses a long-lived /bin/sh process to run the commands whose output is read (execGetOutput and execBatch).
+  Each command is run in a sub-shell with its standard input redirected from /dev/null, so it cannot disturb the worker.
+  Commands with a specific environment, or whose output is not read (execCall and execCheck, which could be interactive), still get their own process.
+  It is not the default runner, it has to be installed with setRunner, by a program that runs many short commands one after the other. Its limits:
+    - the commands are run one at a time, so the ones executed from several threads, like the os-prober tests, are serialized,
+    - the worker keeps the current directory it had when it started, a later os.chdir does not reach it,
+    - a command that times out kills the worker, which is started again for the next command.
+  execBatch does not need it to run its commands in one process: the default runner starts one short-lived shell for each batch.
+  """
+
+  def __init__(self, env = _defaultEnv):
+    self._env = env
+    self._p = None
+    self._marker = None
+    self._buffer = b''
+    self._lock = Lock()
+
+  def _start(self):
+    self._marker = '__sltl_{0}__'.format(binascii.hexlify(os.urandom(8)).decode('ascii')).encode('ascii')
+    self._p = subprocess.Popen(['/bin/sh'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = _getDevNull(), env = self._env, close_fds = True, preexec_fn = os.setsid)
+    _recordSpawn()
+
+  def stop(self):
+    """
+    Stops the worker, a new one will be started if needed.
+    """
+    if self._p:
+      try:
+        os.killpg(self._p.pid, signal.SIGKILL)
+      except OSError:
+        pass
+      self._p.wait()
+      self._p = None
+
+  def _wrap(self, cmd, withError, shell):
+    def toBytes(s):
+      if isinstance(s, unicode):
+        return s.encode('utf-8')
+      return s
+    if isinstance(cmd, list):
+      if shell:
+        cmd = b' '.join([toBytes(c) for c in cmd])
+      else:
+        cmd = b' '.join([pipes.quote(toBytes(c)) for c in cmd])
+    if withError:
+      redirect = b'2>&1'
+    else:
+      redirect = b'2>/dev/null'
+    return b"( {cmd}\n) </dev/null {redirect}; printf '\\n%s %d\\n' {marker} $?\n".format(cmd = toBytes(cmd), redirect = redirect, marker = self._marker)
+
+  def _readResult(self, cmd, timeout):
+    """
+    Reads the output of the next command, until its marker line is found.
+    """
+    fd = self._p.stdout.fileno()
+    tag = b'\n' + self._marker + b' '
+    start = time()
+    while True:
+      pos = self._buffer.find(tag)
+      if pos >= 0:
+        end = self._buffer.find(b'\n', pos + len(tag))
+        if end >= 0:
+          result = (int(self._buffer[pos + len(tag):end]), self._buffer[:pos].splitlines())
+          self._buffer = self._buffer[end + 1:]
+          return result
+      if timeout:
+        remaining = timeout - (time() - start)
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+          self.stop()
+          raise ExecTimeoutError(cmd, timeout)
+      chunk = os.read(fd, 65536)
+      if not chunk:
+        self.stop()
+        raise subprocess.CalledProcessError(returncode = -1, cmd = cmd)
+      self._buffer += chunk
+
+  def batch(self, cmds, withError, shell, timeout = None):
+    """
+    All commands are sent in only one round-trip to the worker.
+    """
+    with self._lock:
+      if not self._p or self._p.poll() is not None:
+        self._start()
+      self._buffer = b''
+      self._p.stdin.write(b''.join([self._wrap(cmd, withError, shell) for cmd in cmds]))
+      self._p.stdin.flush()
+      ret = []
+      for cmd in cmds:
+        start = time()
+        try:
+          ret.append(self._readResult(cmd, timeout))
+        finally:
+          _recordCall(cmd, time() - start)
+      return ret
+
+  def getOutput(self, cmd, withError, shell, env, timeout = None):
+    if env != self._env:
+      return SubprocessRunner.getOutput(self, cmd, withError, shell, env, timeout)
+    returncode, lines = self.batch([cmd], withError, shell, timeout)[0]
+    if returncode == 0:
+      return lines
+    else:
+      raise subprocess.CalledProcessError(returncode = returncode, cmd = cmd)
+
+def getRunner():
+  """
+  Returns the runner used to execute the commands.
+  """
+  return _runner
+
+def setRunner(runner):
+  """
+  Changes the runner used to execute the commands and returns the previous one.
+  The previous runner is stopped.
+  """
+  global _runner
+  previous = _runner
+  _runner = runner
+  if previous and previous is not runner:
+    previous.stop()
+  return previous
+
+def execCall(cmd, shell = True, env = _defaultEnv, timeout = None):
   """
   Executes a command and return the exit code.
   The command is executed by default in a /bin/sh shell with en_US locale.
   The output of the command is not read. With some commands, it may hang if the output is not read when run in a shell.
   For this type of command, it is preferable to use execGetOutput even the return value is not read, or to use shell = False.
+  If 'timeout' (in seconds) is specified, the command is killed after this time and an ExecTimeoutError is raised.
   """
-  if shell and isinstance(cmd, list):
-    cmd = ' '.join(cmd)
-  return subprocess.call(cmd, shell = shell, env = env)
+  return _runner.call(cmd, shell, env, timeout)
 
-def execCheck(cmd, shell = True, env = {'LANG' : 'en_US'}):
+def execCheck(cmd, shell = True, env = _defaultEnv, timeout = None):
   """
   Executes a command and return 0 if Ok or a subprocess.CalledProcessorError exception in case of error.
   The command is executed by default in a /bin/sh shell with en_US locale.
+  If 'timeout' (in seconds) is specified, the command is killed after this time and an ExecTimeoutError is raised.
   """
-  if shell and isinstance(cmd, list):
-    cmd = ' '.join(cmd)
-  return subprocess.check_call(cmd, shell = shell, env = env)
+  ret = _runner.call(cmd, shell, env, timeout)
+  if ret != 0:
+    raise subprocess.CalledProcessError(returncode = ret, cmd = cmd)
+  return ret
 
-def execGetOutput(cmd, withError = False, shell = True, env = {'LANG' : 'en_US'}):
+def execGetOutput(cmd, withError = False, shell = True, env = _defaultEnv, timeout = None):
   """
   Executes a command and return its output in a list, line by line.
   In case of error, it returns a subprocess.CalledProcessorError exception.
   The command is executed by default in a /bin/sh shell with en_US locale.
+  If 'timeout' (in seconds) is specified, the command is killed after this time and an ExecTimeoutError is raised.
   """
-  DEVNULL = open(os.devnull, 'wb')
-  stdErr = DEVNULL
-  if withError:
-    stdErr = subprocess.STDOUT
-  if sys.version_info[0] > 2 or (sys.version_info[0] == 2 and sys.version_info[1] >= 7): # ver >= 2.7
-    if shell and isinstance(cmd, list):
-      cmd = ' '.join(cmd)
-    return subprocess.check_output(cmd, stderr = stdErr, shell = shell, env = env).splitlines()
-  else:
-    wrappedCmd = []
-    if shell:
-      wrappedCmd.append('sh')
-      wrappedCmd.append('-c')
-      if isinstance(cmd, list):
-        wrappedCmd.append(' '.join(cmd))
-      else:
-        wrappedCmd.append(cmd)
-    else:
-      if isinstance(cmd, list):
-        wrappedCmd = cmd
-      else:
-        wrappedCmd.append(cmd)
-    p = subprocess.Popen(wrappedCmd, stdout = subprocess.PIPE, stderr = stdErr)
-    output = p.communicate()[0]
-    if p.returncode == 0:
-      return output.splitlines()
-    else:
-      raise subprocess.CalledProcessError(returncode = p.returncode, cmd = cmd)
+  return _runner.getOutput(cmd, withError, shell, env, timeout)
+
+def execBatch(cmds, withError = False, shell = True, timeout = None):
+  """
+  Executes many read-only commands and returns a list of (exitCode, outputLines), one for each command, in the same order.
+  All the commands are sent to one shell in only one round-trip: a new one with the default SubprocessRunner, or the long-lived one of a ShellWorkerRunner if it has been installed with setRunner.
+  The commands are executed with en_US locale and should not read their standard input.
+  'timeout' (in seconds) is applied to each command.
+  """
+  return _runner.batch(cmds, withError, shell, timeout)
 
 def checkRoot():
   """
@@ -78,6 +342,9 @@ def checkRoot():
   if os.getuid() != 0:
     raise Exception('You need root permissions.')
 
+resetExecStats()
+setRunner(SubprocessRunner())
+
 # Unit test
 if __name__ == '__main__':
   from assertPlus import *
@@ -88,4 +355,17 @@ if __name__ == '__main__':
   assertException(subprocess.CalledProcessError, lambda: execCheck("xyz"))
   assertEquals(0, execCheck("ls"))
   assertEquals(os.getcwd(), execGetOutput("pwd")[0].strip())
+  assertException(ExecTimeoutError, lambda: execGetOutput("sleep 5", timeout = 0.5))
   assertException(Exception, lambda: checkRoot())
+  resetExecStats()
+  setRunner(ShellWorkerRunner())
+  assertEquals(os.getcwd(), execGetOutput("pwd")[0].strip())
+  assertEquals(['a b'], execGetOutput(['echo', 'a b'], shell = False))
+  assertEquals(['no new line'], execGetOutput("printf 'no new line'"))
+  assertException(subprocess.CalledProcessError, lambda: execGetOutput("xyz"))
+  assertEquals([(0, ['1']), (1, []), (0, ['3', '4'])], execBatch(['echo 1', 'false', 'echo 3; echo 4']))
+  assertEquals(1, getExecStats()['spawns']) # only the worker
+  assertEquals(7, getExecStats()['calls'])
+  assertException(ExecTimeoutError, lambda: execGetOutput("sleep 5", timeout = 0.5))
+  assertEquals(['ok'], execGetOutput("echo ok")) # a new worker is started
+  setRunner(SubprocessRunner())
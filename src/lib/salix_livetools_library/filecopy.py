@@ -0,0 +1,763 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Copy of files and directory trees in process, as 'cp --preserve -r -f --remove-destination' does, reporting the progress as it goes.
+The data is copied by the kernel when possible (copy_file_range, then sendfile), else through a buffer, and the holes of sparse files are kept.
+A tree is walked once, then its files can be copied by several threads.
+Functions:
+  - copyFile
+  - copyTree
+  - scanTree
+  - prefetchTree
+  - getCopyMethods
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2011-2013, Salix OS'
+__license__ = 'GPL2+'
+import os
+import errno
+import json
+import ctypes
+import hashlib
+import ctypes.util
+from stat import *
+from time import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+_defaultBufferSize = 1024 * 1024
+_SEEK_DATA = 3
+_SEEK_HOLE = 4
+_POSIX_FADV_WILLNEED = 3
+# errors telling that a kernel copy is not possible between these two files, the next method is then tried
+_unsupportedErrors = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP, errno.EOVERFLOW)
+_libc = None
+_libcFunctions = {}
+# libc functions: symbols, the 64-bit offset variant first for 32-bit systems, return type and argument types
+_prototypes = {
+    'copy_file_range':(('copy_file_range',), ctypes.c_ssize_t, [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]),
+    'sendfile':(('sendfile64', 'sendfile'), ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]),
+    'posix_fadvise':(('posix_fadvise64', 'posix_fadvise'), ctypes.c_int, [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]),
+  }
+
+def _getLibc():
+  global _libc
+  if _libc is None:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno = True)
+  return _libc
+
+def _getLibcFunction(name):
+  """
+  Returns the libc function 'name' with its prototype declared, or None if it is not available.
+  """
+  if name not in _libcFunctions:
+    (symbols, restype, argtypes) = _prototypes[name]
+    libc = _getLibc()
+    function = None
+    for symbol in symbols:
+      if hasattr(libc, symbol):
+        function = getattr(libc, symbol)
+        function.restype = restype
+        function.argtypes = argtypes
+        break
+    _libcFunctions[name] = function
+  return _libcFunctions[name]
+
+def getCopyMethods():
+  """
+  Returns the copy methods available, fastest first: copy_file_range, sendfile, read.
+  """
+  return [m for m in ('copy_file_range', 'sendfile') if _getLibcFunction(m)] + ['read']
+
+class CopyProgress(float):
+  """
+  Fraction (0 ≤ x ≤ 1) of the bytes copied, so that it can be used as a number, with the details as attributes:
+    - bytesCopied, bytesTotal
+    - filesCopied, filesTotal
+    - filesSkipped: files found already copied in the manifest, counted in filesCopied too
+    - elapsed: seconds since the start of the copy
+    - throughput: bytes per second since the start of the copy
+    - eta: estimated number of seconds to the end of the copy, None if not known yet
+    - canceled: True if the callback stopped the copy
+    - errors: messages of the files which could not be copied
+  """
+  def __new__(cls, fraction, **stats):
+    p = float.__new__(cls, fraction)
+    p.__dict__.update(stats)
+    return p
+
+class _CopyCanceled(Exception):
+  pass
+
+class _Progress:
+  """
+  Counts what has been copied and calls the callback at most every 'interval' seconds, and at the end.
+  The copy is canceled if the callback returns a false value.
+  When the copy is threaded, the workers only count and the calling thread calls the callback.
+  """
+
+  def __init__(self, bytesTotal, filesTotal, callback, callbackArgs, interval):
+    self.bytesTotal = bytesTotal
+    self.filesTotal = filesTotal
+    self.bytesCopied = 0
+    self.filesCopied = 0
+    self.filesSkipped = 0
+    self.errors = []
+    self.canceled = False
+    self._callback = callback
+    self._callbackArgs = callbackArgs
+    self._interval = interval
+    self.threaded = False
+    self._lock = Lock()
+    self._start = time()
+    self._last = self._start
+
+  def current(self):
+    elapsed = time() - self._start
+    throughput = self.bytesCopied / elapsed if elapsed > 0 else 0.0
+    remaining = max(0, self.bytesTotal - self.bytesCopied)
+    if not remaining:
+      eta = 0.0
+    elif throughput:
+      eta = remaining / throughput
+    else:
+      eta = None
+    if self.bytesTotal:
+      fraction = min(1.0, float(self.bytesCopied) / self.bytesTotal)
+    else:
+      fraction = 1.0
+    return CopyProgress(fraction, bytesCopied = self.bytesCopied, bytesTotal = self.bytesTotal,
+        filesCopied = self.filesCopied, filesTotal = self.filesTotal, filesSkipped = self.filesSkipped, elapsed = elapsed,
+        throughput = throughput, eta = eta, canceled = self.canceled, errors = list(self.errors))
+
+  def _notify(self):
+    self._last = time()
+    if self._callback and not self._callback(self.current(), *self._callbackArgs):
+      self.canceled = True
+      raise _CopyCanceled()
+
+  def hasCallback(self):
+    return self._callback is not None
+
+  def nextCall(self):
+    """
+    Returns the number of seconds before the callback is due.
+    """
+    return max(0.01, self._last + self._interval - time())
+
+  def notifyIfDue(self):
+    if self._callback and time() - self._last >= self._interval:
+      self._notify()
+
+  def check(self):
+    """
+    Stops a copy which has been canceled.
+    """
+    if self.canceled:
+      raise _CopyCanceled()
+
+  def addBytes(self, n):
+    with self._lock:
+      self.bytesCopied += n
+    if self.threaded: # the calling thread calls the callback
+      self.check()
+    else:
+      self.notifyIfDue()
+
+  def addFile(self, skipped = False):
+    with self._lock:
+      self.filesCopied += 1
+      if skipped:
+        self.filesSkipped += 1
+    if self.threaded:
+      self.check()
+    else:
+      self.notifyIfDue()
+
+def _fsPath(path):
+  if isinstance(path, unicode):
+    return path.encode('utf-8') # file names are bytes, whatever their encoding
+  return path
+
+def scanTree(path):
+  """
+  Returns the (bytes, files) that copyTree would copy from 'path': the size of the regular files and the number of entries, 'path' excluded.
+  """
+  path = _fsPath(path)
+  size = 0
+  files = 0
+  stack = [path]
+  while stack:
+    p = stack.pop()
+    try:
+      st = os.lstat(p)
+    except OSError:
+      continue
+    if p != path:
+      files += 1
+    if S_ISDIR(st.st_mode):
+      try:
+        stack.extend([os.path.join(p, name) for name in os.listdir(p)])
+      except OSError:
+        pass
+    elif S_ISREG(st.st_mode):
+      size += st.st_size
+  return (size, files)
+
+def prefetchTree(path, maxBytes = None, stopEvent = None):
+  """
+  Asks the kernel to read ahead the regular files under 'path' (posix_fadvise WILLNEED), so that a following copy finds them in memory.
+  Stops after 'maxBytes' bytes, or as soon as the threading.Event 'stopEvent' is set.
+  Returns the number of bytes asked for, 0 if read ahead is not available.
+  """
+  fadvise = _getLibcFunction('posix_fadvise')
+  if not fadvise:
+    return 0
+  path = _fsPath(path)
+  size = 0
+  stack = [path]
+  while stack and not (stopEvent and stopEvent.is_set()):
+    p = stack.pop()
+    try:
+      st = os.lstat(p)
+      if S_ISDIR(st.st_mode):
+        stack.extend(reversed([os.path.join(p, name) for name in sorted(os.listdir(p))])) # in the order of the copy
+      elif S_ISREG(st.st_mode) and st.st_size:
+        if maxBytes is not None and size + st.st_size > maxBytes:
+          break
+        fd = os.open(p, os.O_RDONLY)
+        try:
+          fadvise(fd, 0, 0, _POSIX_FADV_WILLNEED)
+        finally:
+          os.close(fd)
+        size += st.st_size
+    except OSError:
+      pass
+  return size
+
+def _extents(fd, size):
+  """
+  Returns the list of (start, end) of the data of a file, without its holes. 'end' is None for 'up to the end of file'.
+  """
+  extents = []
+  offset = 0
+  try:
+    while offset < size:
+      try:
+        start = os.lseek(fd, offset, _SEEK_DATA)
+      except OSError as e:
+        if e.errno == errno.ENXIO: # only a hole up to the end
+          break
+        raise
+      end = os.lseek(fd, start, _SEEK_HOLE)
+      extents.append((start, end))
+      offset = end
+  except OSError: # holes are not supported by this filesystem
+    return [(0, None)]
+  finally:
+    os.lseek(fd, 0, os.SEEK_SET)
+  return extents
+
+def _copyExtentRange(fdIn, fdOut, start, end, bufferSize, progress):
+  copyFileRange = _getLibcFunction('copy_file_range')
+  offIn = ctypes.c_int64(start)
+  offOut = ctypes.c_int64(start)
+  while end is None or offIn.value < end:
+    count = bufferSize if end is None else min(bufferSize, end - offIn.value)
+    n = copyFileRange(fdIn, ctypes.byref(offIn), fdOut, ctypes.byref(offOut), count, 0)
+    if n < 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    if n == 0:
+      break
+    progress.addBytes(n)
+  return offIn.value
+
+def _copyExtentSendfile(fdIn, fdOut, start, end, bufferSize, progress):
+  sendfile = _getLibcFunction('sendfile')
+  offIn = ctypes.c_int64(start)
+  os.lseek(fdOut, start, os.SEEK_SET)
+  while end is None or offIn.value < end:
+    count = bufferSize if end is None else min(bufferSize, end - offIn.value)
+    n = sendfile(fdOut, fdIn, ctypes.byref(offIn), count)
+    if n < 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    if n == 0:
+      break
+    progress.addBytes(n)
+  return offIn.value
+
+def _copyExtentRead(fdIn, fdOut, start, end, bufferSize, progress):
+  offset = start
+  os.lseek(fdIn, start, os.SEEK_SET)
+  os.lseek(fdOut, start, os.SEEK_SET)
+  while end is None or offset < end:
+    count = bufferSize if end is None else min(bufferSize, end - offset)
+    data = os.read(fdIn, count)
+    if not data:
+      break
+    written = 0
+    while written < len(data):
+      written += os.write(fdOut, data[written:])
+    offset += len(data)
+    progress.addBytes(len(data))
+  return offset
+
+_copyExtentFunctions = {
+    'copy_file_range':_copyExtentRange,
+    'sendfile':_copyExtentSendfile,
+    'read':_copyExtentRead,
+  }
+
+def _copyData(fdIn, fdOut, size, sparse, bufferSize, methods, progress):
+  """
+  Copies the data with the first method that works for these files, and returns the size of the copy.
+  A method is only abandoned before it copied anything, so no byte is counted twice.
+  """
+  if sparse:
+    extents = _extents(fdIn, size)
+  else:
+    extents = [(0, None)]
+  length = 0
+  methods = list(methods)
+  for (start, end) in extents:
+    if start > length:
+      progress.addBytes(start - length) # a hole is copied as soon as it is skipped
+    while True:
+      try:
+        length = max(length, _copyExtentFunctions[methods[0]](fdIn, fdOut, start, end, bufferSize, progress))
+        break
+      except OSError as e:
+        if e.errno in _unsupportedErrors and len(methods) > 1 and os.lseek(fdOut, 0, os.SEEK_END) <= start:
+          methods.pop(0)
+        else:
+          raise
+  if sparse and length < size:
+    os.ftruncate(fdOut, size) # trailing hole
+    progress.addBytes(size - length)
+    length = size
+  return length
+
+def _preserve(path, st):
+  """
+  Preserves the ownership, the mode and the times, as 'cp --preserve' does.
+  The ownership is only changed if allowed, and a symbolic link only gets its ownership.
+  """
+  try:
+    os.lchown(path, st.st_uid, st.st_gid)
+  except OSError as e:
+    if e.errno not in (errno.EPERM, errno.EINVAL):
+      raise
+  if not S_ISLNK(st.st_mode):
+    os.chmod(path, S_IMODE(st.st_mode))
+    os.utime(path, (st.st_atime, st.st_mtime))
+
+def _removeDestination(path):
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return
+  if S_ISDIR(st.st_mode):
+    raise OSError(errno.EISDIR, "cannot overwrite directory '{0}' with non-directory".format(path))
+  os.unlink(path)
+
+class _FileManifest:
+  """
+  Per file manifest of a copy: one JSON line per regular file copied, appended as soon as the file is complete, so that it survives an interruption.
+  A line has the relative path, the size and mtime of the source, the mtime of the copy and the checksum of the data if asked for.
+  A later line for the same path replaces the previous one, a line with 'removed' forgets it.
+  """
+
+  def __init__(self, path, checksum):
+    self.path = path
+    self.checksum = checksum
+    self.entries = {}
+    self._lock = Lock()
+    try:
+      with open(path, 'rb') as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError: # the last line was being written
+            continue
+          if entry.get('removed'):
+            self.entries.pop(entry['path'], None)
+          else:
+            self.entries[entry['path']] = entry
+    except IOError:
+      pass
+    self._file = open(path, 'ab')
+
+  def _append(self, entry):
+    with self._lock:
+      self._file.write(json.dumps(entry, sort_keys = True).encode('utf-8') + b'\n')
+      self._file.flush()
+
+  def record(self, rel, st, dstSt, digest):
+    entry = {'path':rel, 'size':st.st_size, 'mtime':st.st_mtime, 'dstMtime':dstSt.st_mtime}
+    if digest:
+      entry[self.checksum] = digest
+    self.entries[rel] = entry
+    self._append(entry)
+
+  def forget(self, rel):
+    if self.entries.pop(rel, None):
+      self._append({'path':rel, 'removed':True})
+
+  def isCopied(self, rel, st, dst):
+    """
+    Returns True if the file has been copied from a source of the same size and mtime, and if its copy has not changed since.
+    """
+    entry = self.entries.get(rel)
+    if not entry or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+      return False
+    if self.checksum and self.checksum not in entry:
+      return False
+    try:
+      dstSt = os.lstat(dst)
+    except OSError:
+      return False
+    return S_ISREG(dstSt.st_mode) and dstSt.st_size == st.st_size and dstSt.st_mtime == entry['dstMtime']
+
+  def close(self):
+    self._file.close()
+
+def _fileDigest(path, checksum, bufferSize):
+  h = hashlib.new(checksum)
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(bufferSize)
+      if not data:
+        break
+      h.update(data)
+  return h.hexdigest()
+
+class _Copy:
+  """
+  Copy of a list of entries, walked once: the directories are created first, then the other files are copied, by a pool of threads if 'workers' > 1.
+  The hard links inside the copy are made last, and the metadata of the directories are set at the very end, deepest first, so that nothing changes them anymore.
+  With a manifest, the regular files already copied are skipped, and the copy can be verified at the end.
+  """
+
+  def __init__(self, progress, bufferSize, methods, preserve, links, workers, manifest = None, verify = False):
+    self.progress = progress
+    self.bufferSize = bufferSize
+    self.methods = methods or getCopyMethods()
+    self.preserve = preserve
+    self.links = links
+    self.workers = workers
+    self.dirs = []
+    self.files = []
+    self.hardLinks = []
+    self.manifest = manifest
+    self.verify = verify
+    self.root = None
+    self._firstLinks = {}
+
+  def _error(self, path, e):
+    self.progress.errors.append("{0}: {1}".format(path.decode('utf-8', 'replace'), getattr(e, 'strerror', None) or e))
+
+  def add(self, src, dst, st):
+    if S_ISDIR(st.st_mode):
+      self.dirs.append((src, dst, st))
+    elif self.links and S_ISREG(st.st_mode) and st.st_nlink > 1:
+      key = (st.st_dev, st.st_ino)
+      if key in self._firstLinks:
+        self.hardLinks.append((src, dst, st, self._firstLinks[key]))
+      else:
+        self._firstLinks[key] = dst
+        self.files.append((src, dst, st))
+    else:
+      self.files.append((src, dst, st))
+
+  def walk(self, src, dst, st):
+    """
+    Adds the directory 'src' and everything under it, to be copied into 'dst'.
+    """
+    if self.root is None:
+      self.root = src
+    self.add(src, dst, st)
+    try:
+      names = sorted(os.listdir(src))
+    except OSError as e:
+      self._error(src, e)
+      return
+    for name in names:
+      s = os.path.join(src, name)
+      d = os.path.join(dst, name)
+      try:
+        entrySt = os.lstat(s)
+      except OSError as e:
+        self._error(s, e)
+        continue
+      if S_ISDIR(entrySt.st_mode):
+        self.walk(s, d, entrySt)
+      else:
+        self.add(s, d, entrySt)
+
+  def _makeDirectory(self, src, dst, st):
+    try:
+      dstSt = os.lstat(dst)
+    except OSError:
+      dstSt = None
+    if dstSt and not S_ISDIR(dstSt.st_mode):
+      raise OSError(errno.ENOTDIR, "cannot overwrite non-directory '{0}' with directory".format(dst))
+    if not dstSt:
+      os.mkdir(dst, S_IMODE(st.st_mode) | S_IRWXU)
+
+  def _copyFile(self, src, dst, st):
+    if S_ISREG(st.st_mode):
+      _removeDestination(dst)
+      fdIn = os.open(src, os.O_RDONLY)
+      try:
+        fdOut = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, S_IMODE(st.st_mode) | S_IWUSR)
+        try:
+          _copyData(fdIn, fdOut, st.st_size, st.st_blocks * 512 < st.st_size, self.bufferSize, self.methods, self.progress)
+        finally:
+          os.close(fdOut)
+      finally:
+        os.close(fdIn)
+    elif S_ISLNK(st.st_mode):
+      _removeDestination(dst)
+      os.symlink(os.readlink(src), dst)
+    elif S_ISCHR(st.st_mode) or S_ISBLK(st.st_mode) or S_ISFIFO(st.st_mode) or S_ISSOCK(st.st_mode):
+      _removeDestination(dst)
+      os.mknod(dst, st.st_mode, st.st_rdev)
+    else:
+      raise OSError(errno.EINVAL, "unknown file type of '{0}'".format(src))
+    if self.preserve:
+      _preserve(dst, st)
+
+  def _relativePath(self, src):
+    return src[len(self.root):].lstrip(b'/').decode('utf-8', 'replace')
+
+  def _copyFileTask(self, entry):
+    (src, dst, st) = entry
+    try:
+      self.progress.check()
+      if self.manifest and S_ISREG(st.st_mode) and self.manifest.isCopied(self._relativePath(src), st, dst):
+        self.progress.addBytes(st.st_size)
+        self.progress.addFile(skipped = True)
+        return
+      try:
+        self._copyFile(src, dst, st)
+        if self.manifest and S_ISREG(st.st_mode):
+          digest = self.manifest.checksum and _fileDigest(src, self.manifest.checksum, self.bufferSize)
+          self.manifest.record(self._relativePath(src), st, os.lstat(dst), digest)
+      except (OSError, IOError) as e:
+        self._error(src, e)
+      self.progress.addFile()
+    except _CopyCanceled:
+      pass
+
+  def _verifyTask(self, entry):
+    """
+    Checks that the copy of a regular file has the size and the checksum of the manifest. A bad copy is forgotten, to be copied again next time.
+    """
+    (src, dst, st) = entry[0:3]
+    if not S_ISREG(st.st_mode):
+      return
+    rel = self._relativePath(src)
+    try:
+      self.progress.check()
+      entry = self.manifest.entries.get(rel)
+      dstSt = os.lstat(dst)
+      if not entry or dstSt.st_size != st.st_size:
+        raise IOError(errno.EIO, "verification failed, the size differs")
+      if self.manifest.checksum and _fileDigest(dst, self.manifest.checksum, self.bufferSize) != entry.get(self.manifest.checksum):
+        raise IOError(errno.EIO, "verification failed, the {0} differs".format(self.manifest.checksum))
+    except (OSError, IOError) as e:
+      self.manifest.forget(rel)
+      self._error(dst, e)
+    except _CopyCanceled:
+      pass
+
+  def _map(self, function, entries):
+    """
+    Runs 'function' on every entry, in the pool of workers if there is more than one.
+    """
+    if self.workers > 1 and len(entries) > 1:
+      self.progress.threaded = True
+      pool = ThreadPool(min(self.workers, len(entries)))
+      try:
+        result = pool.map_async(function, entries, chunksize = max(1, len(entries) // (self.workers * 16)))
+        if not self.progress.hasCallback():
+          result.wait() # a wait with a timeout polls
+        while not result.ready():
+          result.wait(self.progress.nextCall())
+          try:
+            self.progress.notifyIfDue()
+          except _CopyCanceled:
+            break
+      finally:
+        pool.close()
+        pool.join()
+        self.progress.threaded = False
+    else:
+      for entry in entries:
+        function(entry)
+        self.progress.check()
+    self.progress.check()
+
+  def run(self):
+    for (src, dst, st) in self.dirs:
+      try:
+        self._makeDirectory(src, dst, st)
+      except OSError as e:
+        self._error(src, e)
+      if src != self.dirs[0][0]:
+        self.progress.addFile()
+    self._map(self._copyFileTask, self.files)
+    for (src, dst, st, first) in self.hardLinks:
+      try:
+        _removeDestination(dst)
+        os.link(first, dst)
+      except OSError as e:
+        self._error(src, e)
+      self.progress.addBytes(st.st_size)
+      self.progress.addFile()
+    if self.manifest and self.verify:
+      self._map(self._verifyTask, self.files)
+    if self.preserve:
+      for (src, dst, st) in reversed(self.dirs):
+        try:
+          _preserve(dst, st)
+        except OSError as e:
+          self._error(src, e)
+
+def _progressFor(total, callback, callbackArgs, interval):
+  if total is None:
+    return _Progress(0, 0, callback, callbackArgs, interval)
+  (bytesTotal, filesTotal) = total
+  return _Progress(bytesTotal, filesTotal, callback, callbackArgs, interval)
+
+def _run(copy):
+  progress = copy.progress
+  try:
+    copy.run()
+  except _CopyCanceled:
+    pass
+  finally:
+    if copy.manifest:
+      copy.manifest.close()
+  if not progress.canceled and progress._callback:
+    progress._notify() # the last one, for 100%
+  return progress.current()
+
+def copyFile(src, dst, callback = None, callbackArgs = (), interval = 1, bufferSize = _defaultBufferSize, methods = None, preserve = True):
+  """
+  Copies the file 'src' to 'dst', replacing it.
+  'callback' is called at most every 'interval' seconds, and at the end, with a CopyProgress as first argument and all values of 'callbackArgs' as next arguments. The copy is stopped if it returns a false value.
+  'methods' is the list of copy methods to try in order, by default getCopyMethods().
+  Returns the final CopyProgress.
+  """
+  src = _fsPath(src)
+  dst = _fsPath(dst)
+  st = os.lstat(src)
+  progress = _progressFor((S_ISREG(st.st_mode) and st.st_size or 0, 1), callback, callbackArgs, interval)
+  copy = _Copy(progress, bufferSize, methods, preserve, False, 1)
+  copy.add(src, dst, st)
+  return _run(copy)
+
+def copyTree(src, dst, callback = None, callbackArgs = (), interval = 1, bufferSize = _defaultBufferSize, methods = None, preserve = True, total = None, workers = 1, links = False, manifest = None, checksum = None, verify = False):
+  """
+  Copies the content of the directory 'src' into the directory 'dst', as 'cp --preserve -r -f --remove-destination src/. dst/' does.
+  'callback' is called at most every 'interval' seconds, and at the end, with a CopyProgress as first argument and all values of 'callbackArgs' as next arguments. The copy is stopped if it returns a false value.
+  'total' is the (bytes, files) to copy, as returned by scanTree which is called if it is not given.
+  'methods' is the list of copy methods to try in order, by default getCopyMethods().
+  If 'workers' > 1, that many files are copied in parallel. The callback is still called from the calling thread.
+  If 'links' is True, the files linked together in 'src' are linked together in 'dst' too, as 'cp --preserve=links' does.
+  'manifest' is the path of a per file manifest of the copy, which makes it resumable: the regular files it lists as copied from the same source and unchanged since are skipped.
+  'checksum' is the name of a hashlib algorithm, like 'sha1', to record the checksum of the files in the manifest.
+  If 'verify' is True, the copies are checked at the end against the manifest, and the bad ones are reported as errors and forgotten.
+  The files that cannot be copied are listed in the errors of the result.
+  Returns the final CopyProgress.
+  """
+  src = _fsPath(src)
+  dst = _fsPath(dst)
+  st = os.stat(src)
+  if not S_ISDIR(st.st_mode):
+    raise IOError(errno.ENOTDIR, "'{0}' is not a directory".format(src))
+  if total is None:
+    total = scanTree(src)
+  progress = _progressFor(total, callback, callbackArgs, interval)
+  fileManifest = manifest and _FileManifest(_fsPath(manifest), checksum)
+  copy = _Copy(progress, bufferSize, methods, preserve, links, workers, fileManifest, verify)
+  copy.walk(src, dst, st)
+  return _run(copy)
+
+# Unit test
+if __name__ == '__main__':
+  from assertPlus import *
+  import shutil
+  import tempfile
+  tmp = tempfile.mkdtemp()
+  src = os.path.join(tmp, 'src')
+  os.makedirs(os.path.join(src, 'a', 'b'))
+  data = os.urandom(300000)
+  open(os.path.join(src, 'a', 'f'), 'wb').write(data)
+  os.chmod(os.path.join(src, 'a', 'f'), 0o640)
+  os.symlink('a/f', os.path.join(src, 'link'))
+  with open(os.path.join(src, 'sparse'), 'wb') as f:
+    f.seek(10 * 1024 * 1024)
+    f.write(b'end')
+  os.utime(os.path.join(src, 'a'), (1000000000, 1000000000))
+  assertEquals((300000 + 10 * 1024 * 1024 + 3, 5), scanTree(src))
+  assertTrue('read' in getCopyMethods())
+  assertEquals(300000, prefetchTree(src, 400000))
+  for method in getCopyMethods():
+    dst = os.path.join(tmp, 'dst-' + method)
+    os.mkdir(dst)
+    calls = []
+    res = copyTree(src, dst, lambda p: calls.append(p) or True, interval = 0, bufferSize = 65536, methods = [method])
+    assertEquals(1.0, res)
+    assertEquals(5, res.filesCopied)
+    assertEquals([], res.errors)
+    assertTrue(len(calls) > 5)
+    assertEquals(1.0, calls[-1])
+    assertEquals(data, open(os.path.join(dst, 'a', 'f'), 'rb').read())
+    assertEquals(0o640, S_IMODE(os.stat(os.path.join(dst, 'a', 'f')).st_mode))
+    assertEquals(1000000000, int(os.stat(os.path.join(dst, 'a')).st_mtime))
+    assertEquals('a/f', os.readlink(os.path.join(dst, 'link')))
+    sparse = os.stat(os.path.join(dst, 'sparse'))
+    assertEquals(10 * 1024 * 1024 + 3, sparse.st_size)
+    assertTrue(sparse.st_blocks * 512 < 1024 * 1024)
+  os.link(os.path.join(src, 'a', 'f'), os.path.join(src, 'a', 'b', 'hardlink'))
+  for i in range(20):
+    open(os.path.join(src, 'a', 'b', 'f{0}'.format(i)), 'wb').write(data[i:])
+  dst = os.path.join(tmp, 'dst-parallel')
+  os.mkdir(dst)
+  res = copyTree(src, dst, lambda p: True, interval = 0, bufferSize = 65536, workers = 4, links = True)
+  assertEquals(1.0, res)
+  assertEquals(26, res.filesCopied)
+  assertEquals([], res.errors)
+  assertEquals(os.stat(os.path.join(dst, 'a', 'f')).st_ino, os.stat(os.path.join(dst, 'a', 'b', 'hardlink')).st_ino)
+  assertEquals(data[19:], open(os.path.join(dst, 'a', 'b', 'f19'), 'rb').read())
+  assertEquals(1000000000, int(os.stat(os.path.join(dst, 'a')).st_mtime))
+  dst = os.path.join(tmp, 'dst-manifest')
+  os.mkdir(dst)
+  manifest = os.path.join(tmp, 'manifest')
+  res = copyTree(src, dst, manifest = manifest, checksum = 'sha1', verify = True, workers = 4, links = True)
+  assertEquals(([], 0), (res.errors, res.filesSkipped))
+  open(os.path.join(dst, 'a', 'b', 'f3'), 'ab').write(b'changed')
+  res = copyTree(src, dst, manifest = manifest, checksum = 'sha1', verify = True, links = True)
+  assertEquals(([], 21), (res.errors, res.filesSkipped)) # all the regular files but f3 and the hard link
+  assertEquals(data[3:], open(os.path.join(dst, 'a', 'b', 'f3'), 'rb').read())
+  with open(os.path.join(dst, 'a', 'b', 'f4'), 'r+b') as f:
+    f.write(b'corrupted') # same size and mtime, only the checksum can see it
+  os.utime(os.path.join(dst, 'a', 'b', 'f4'), (os.stat(os.path.join(src, 'a', 'b', 'f4')).st_atime, os.stat(os.path.join(src, 'a', 'b', 'f4')).st_mtime))
+  res = copyTree(src, dst, manifest = manifest, checksum = 'sha1', verify = True, links = True)
+  assertEquals(1, len(res.errors))
+  res = copyTree(src, dst, manifest = manifest, checksum = 'sha1', verify = True, links = True)
+  assertEquals(([], 21), (res.errors, res.filesSkipped))
+  assertEquals(data[4:], open(os.path.join(dst, 'a', 'b', 'f4'), 'rb').read())
+  dst = os.path.join(tmp, 'dst-canceled')
+  os.mkdir(dst)
+  res = copyTree(src, dst, lambda p: False, interval = 0, bufferSize = 65536)
+  assertTrue(res.canceled)
+  assertTrue(res < 1)
+  res = copyTree(src, dst, lambda p: False, interval = 0, bufferSize = 65536, workers = 4)
+  assertTrue(res.canceled)
+  assertTrue(res < 1)
+  shutil.rmtree(tmp)
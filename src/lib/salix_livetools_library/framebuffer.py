@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Frame buffer geometry and VESA video modes, as used by the vga option of LiLo.
+The table of the VESA modes is indexed once, when the module is loaded.
+Functions:
+  - getFrameBufferGeometry
+  - getBestVesaMode
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2011-2013, Salix OS'
+__license__ = 'GPL2+'
+import os
+
+_frameBufferDir = '/sys/class/graphics/fb0'
+# (x resolution, y resolution, color depth, VESA mode number or None if the mode has no number)
+_vesaModes = [
+    (320, 200, 4, None),
+    (640, 400, 4, None),
+    (640, 480, 4, None),
+    (800, 500, 4, None),
+    (800, 600, 4, 770),
+    (1024, 640, 4, None),
+    (896, 672, 4, None),
+    (1152, 720, 4, None),
+    (1024, 768, 4, 772),
+    (1440, 900, 4, None),
+    (1280, 1024, 4, 774),
+    (1400, 1050, 4, None),
+    (1600, 1200, 4, None),
+    (1920, 1200, 4, None),
+    (320, 200, 8, None),
+    (640, 400, 8, 768),
+    (640, 480, 8, 769),
+    (800, 500, 8, 879),
+    (800, 600, 8, 771),
+    (1024, 640, 8, 874),
+    (896, 672, 8, 815),
+    (1152, 720, 8, 869),
+    (1024, 768, 8, 773),
+    (1440, 900, 8, 864),
+    (1280, 1024, 8, 775),
+    (1400, 1050, 8, 835),
+    (1600, 1200, 8, 796),
+    (1920, 1200, 8, 893),
+    (320, 200, 15, 781),
+    (640, 400, 15, 801),
+    (640, 480, 15, 784),
+    (800, 500, 15, 880),
+    (800, 600, 15, 787),
+    (1024, 640, 15, 875),
+    (896, 672, 15, 816),
+    (1152, 720, 15, 870),
+    (1024, 768, 15, 790),
+    (1440, 900, 15, 865),
+    (1280, 1024, 15, 793),
+    (1400, 1050, 15, None),
+    (1600, 1200, 15, 797),
+    (1920, 1200, 15, None),
+    (320, 200, 16, 782),
+    (640, 400, 16, 802),
+    (640, 480, 16, 785),
+    (800, 500, 16, 881),
+    (800, 600, 16, 788),
+    (1024, 640, 16, 876),
+    (896, 672, 16, 817),
+    (1152, 720, 16, 871),
+    (1024, 768, 16, 791),
+    (1440, 900, 16, 866),
+    (1280, 1024, 16, 794),
+    (1400, 1050, 16, 837),
+    (1600, 1200, 16, 798),
+    (1920, 1200, 16, None),
+    (320, 200, 24, 783),
+    (640, 400, 24, 803),
+    (640, 480, 24, 786),
+    (800, 500, 24, 882),
+    (800, 600, 24, 789),
+    (1024, 640, 24, 877),
+    (896, 672, 24, 818),
+    (1152, 720, 24, 872),
+    (1024, 768, 24, 792),
+    (1440, 900, 24, 867),
+    (1280, 1024, 24, 795),
+    (1400, 1050, 24, 838),
+    (1600, 1200, 24, 799),
+    (1920, 1200, 24, None),
+    (320, 200, 32, None),
+    (640, 400, 32, 804),
+    (640, 480, 32, 809),
+    (800, 500, 32, 883),
+    (800, 600, 32, 814),
+    (1024, 640, 32, 878),
+    (896, 672, 32, 819),
+    (1152, 720, 32, 873),
+    (1024, 768, 32, 824),
+    (1440, 900, 32, 868),
+    (1280, 1024, 32, 829),
+    (1400, 1050, 32, None),
+    (1600, 1200, 32, 834),
+    (1920, 1200, 32, None),
+  ]
+
+def _indexVesaModes(modes):
+  """
+  Returns the list of (y, x, [(depth, mode), …]) of the numbered modes, ordered by vertical size desc, horizontal size desc, and each depth list by color depth desc.
+  """
+  depthsPerResolution = {}
+  for (x, y, d, m) in modes:
+    if m:
+      depthsPerResolution.setdefault((y, x), []).append((d, m))
+  return [(y, x, sorted(depthsPerResolution[(y, x)], reverse = True)) for (y, x) in sorted(depthsPerResolution.keys(), reverse = True)]
+
+_vesaIndex = _indexVesaModes(_vesaModes)
+
+def _readSysValue(path):
+  try:
+    with open(path) as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+def getFrameBufferGeometry(frameBufferDir = _frameBufferDir):
+  """
+  Returns the (x resolution, y resolution, color depth) of the frame buffer, read from sysfs, or None if there is no frame buffer.
+  """
+  size = _readSysValue(os.path.join(frameBufferDir, 'virtual_size'))
+  depth = _readSysValue(os.path.join(frameBufferDir, 'bits_per_pixel'))
+  try:
+    (x, y) = size.split(',')
+    return (int(x), int(y), int(depth))
+  except (AttributeError, TypeError, ValueError):
+    return None
+
+def getBestVesaMode(xRes, yRes, depth):
+  """
+  Returns the (mode, x, y, depth) of the biggest VESA mode that fits in the given geometry, preferring the vertical size, then the horizontal size, then the color depth.
+  Returns None if no mode fits.
+  """
+  for (y, x, depths) in _vesaIndex:
+    if y <= yRes and x <= xRes:
+      for (d, m) in depths:
+        if d <= depth:
+          return (m, x, y, d)
+  return None
+
+# Unit test
+if __name__ == '__main__':
+  from assertPlus import *
+  import shutil
+  import tempfile
+  assertEquals((791, 1024, 768, 16), getBestVesaMode(1024, 768, 16))
+  assertEquals((824, 1024, 768, 32), getBestVesaMode(1280, 800, 32))
+  assertEquals((834, 1600, 1200, 32), getBestVesaMode(1680, 1200, 32))
+  assertEquals((893, 1920, 1200, 8), getBestVesaMode(1920, 1200, 32)) # 1920×1200 only has a mode number in 8 bits
+  assertEquals((770, 800, 600, 4), getBestVesaMode(800, 600, 4))
+  assertEquals(None, getBestVesaMode(300, 200, 32))
+  tmp = tempfile.mkdtemp()
+  assertEquals(None, getFrameBufferGeometry(tmp))
+  open(os.path.join(tmp, 'virtual_size'), 'w').write('1024,768\n')
+  open(os.path.join(tmp, 'bits_per_pixel'), 'w').write('32\n')
+  assertEquals((1024, 768, 32), getFrameBufferGeometry(tmp))
+  shutil.rmtree(tmp)
@@ -3,6 +3,7 @@
 # vim: set et ai sta sw=2 ts=2 tw=0:
 """
 Calculate some size and free size of folders and mount points.
+Everything is read from stat, statvfs, sysfs or ioctls, no command is run.
 Functions:
   - getHumanSize
   - getBlockSize
@@ -13,25 +14,15 @@ from __future__ import unicode_literals
 
 __copyright__ = 'Copyright 2011-2013, Salix OS'
 __license__ = 'GPL2+'
-import re
 import os
+import fcntl
+import struct
 from stat import *
-from execute import *
+from multiprocessing.pool import ThreadPool
+from mounttable import findMountEntry
 
-def _getMountPoint(device):
-  """
-  Finds the mount point of 'device' or None if not mounted
-  Copied from 'mounting' module to break circular dependencies
-  """
-  mountpoint = None
-  for line in execGetOutput('mount', shell = False):
-    p, _, mp, _ = line.split(' ', 3) # 3 splits max, _ is discarded
-    if os.path.islink(p):
-      p = os.path.realpath(p)
-    if p == device:
-      mountpoint = mp
-      break
-  return mountpoint
+_sectorSize = 512 # unit of st_blocks and of the size of a block device in sysfs
+_BLKBSZGET = (2 << 30) | (struct.calcsize(b'L') << 16) | (0x12 << 8) | 112 # _IOR(0x12, 112, size_t)
 
 def getHumanSize(size):
   """
@@ -45,16 +36,41 @@ def getHumanSize(size):
     sizeHuman = sizeHuman / 1024
   return "{0:.1f}{1}".format(sizeHuman, units[unit])
 
+def _deviceSysDir(path):
+  """
+  Returns the sysfs directory of the block device 'path', found by its major:minor so that /dev/mapper/… or /dev/disk/by-… also work.
+  """
+  rdev = os.stat(path).st_rdev
+  sysDir = '/sys/dev/block/{0}:{1}'.format(os.major(rdev), os.minor(rdev))
+  if os.path.isdir(sysDir):
+    return sysDir
+  return '/sys/class/block/{0}'.format(os.path.basename(os.path.realpath(path)))
+
+def _readSysInt(path):
+  try:
+    with open(path, 'r') as f:
+      return int(f.read().strip())
+  except (IOError, ValueError):
+    return None
+
 def getBlockSize(path):
   """
   Returns the block size of the underlying filesystem denoted by 'path'.
+  For a block device, it is the soft block size of the kernel (BLKBSZGET, as 'blockdev --getbsz'), or the logical block size read in sysfs if the device cannot be opened.
   """
   if S_ISBLK(os.stat(path).st_mode):
-    lines = execGetOutput(['/sbin/blockdev', '--getbsz', path], shell = False)
-    if lines:
-      blockSize = int(lines[0])
-    else:
-      blockSize = None
+    blockSize = None
+    try:
+      fd = os.open(path, os.O_RDONLY)
+      try:
+        blockSize = struct.unpack(b'i', fcntl.ioctl(fd, _BLKBSZGET, b'\0' * 4))[0]
+      finally:
+        os.close(fd)
+    except (IOError, OSError):
+      sysDir = _deviceSysDir(path)
+      blockSize = _readSysInt(os.path.join(sysDir, 'queue', 'logical_block_size'))
+      if blockSize is None: # a partition, the queue is in the directory of its disk
+        blockSize = _readSysInt(os.path.join(os.path.realpath(sysDir), '..', 'queue', 'logical_block_size'))
   else:
     st = os.statvfs(path)
     blockSize = st.f_frsize
@@ -72,16 +88,13 @@ def getSizes(path, withHuman = True):
   + all of them with the corresponding 'Human' suffix.
   """
   if S_ISBLK(os.stat(path).st_mode):
-    mountpoint = _getMountPoint(path)
-    if mountpoint:
+    entry = findMountEntry(path)
+    if entry:
       # mounted, so will use mountpoint to get information about different sizes
-      path = mountpoint
+      path = entry.mountPoint
     else:
       # not mounted, so only the full size could be get
-      diskDevice = re.sub(r'^.*/([^/]+?)[0-9]*$', r'\1', path)
-      device = re.sub(r'^.*/([^/]+)$', r'\1', path)
-      blockSize = int(open('/sys/block/{0}/queue/logical_block_size'.format(diskDevice), 'r').read().strip())
-      size = int(open('/sys/class/block/{0}/size'.format(device), 'r').read().strip()) * blockSize
+      size = _readSysInt(os.path.join(_deviceSysDir(path), 'size')) * _sectorSize
       return {
           'size':size, 'sizeHuman':getHumanSize(size),
           'free':None, 'freeHuman':None,
@@ -112,22 +125,74 @@ def getSizes(path, withHuman = True):
         'uuUsed':uuUsed, 'uuUsedHuman':None
       }
 
-def getUsedSize(path, blocksize = None, withHuman = True):
+def _walk(path, blocksize):
+  """
+  Walks the tree under 'path' without following symbolic links nor crossing anything but directories.
+  Returns (size, {(device, inode):size}), the second part being the inodes with several links, to count only once.
+  With 'blocksize', only regular files are counted, each link on its own, their used space rounded up to 'blocksize'.
+  Unreadable files and directories are ignored, as du does.
+  """
+  size = 0
+  linked = {}
+  stack = [path]
+  while stack:
+    p = stack.pop()
+    try:
+      st = os.lstat(p)
+    except OSError:
+      continue
+    isDir = S_ISDIR(st.st_mode)
+    if isDir:
+      try:
+        stack.extend([os.path.join(p, name) for name in os.listdir(p)])
+      except OSError:
+        pass
+    if blocksize:
+      if S_ISREG(st.st_mode):
+        size += (st.st_blocks * _sectorSize + blocksize - 1) // blocksize * blocksize
+    elif st.st_nlink > 1 and not isDir:
+      linked[(st.st_dev, st.st_ino)] = st.st_blocks * _sectorSize
+    else:
+      size += st.st_blocks * _sectorSize
+  return (size, linked)
+
+def _walkTask(args):
+  return _walk(*args)
+
+def getUsedSize(path, blocksize = None, withHuman = True, workers = 1):
   """
   Returns the size of the space used by files and folders under 'path'.
   If 'blocksize' is specified, mimic the space that will be used if the blocksize of the underlying filesystem where the one specified.
   This could be useful if used to transfer files from one directory to another when the target filesystem use another blocksize.
+  The same values as 'du -s -B 1' (and as 'du -l -B blocksize' on the regular files) are computed, without running any command.
+  If 'workers' > 1, the sub-directories of 'path' are walked in parallel.
   Returns a tuple with (size, sizeHuman)
   """
-  if blocksize:
-    cmd = """echo $((($(find '{0}' -type f -print0 | du -l -B {1} --files0-from=- | cut -f1 | tr "\\n" "+")0)*{1}))""".format(path, blocksize)
-    lines = execGetOutput(cmd, shell = True)
-    size = lines[-1]
+  if isinstance(path, unicode):
+    path = path.encode('utf-8') # file names are bytes, whatever their encoding
+  if workers > 1 and os.path.isdir(path) and not os.path.islink(path):
+    try:
+      names = os.listdir(path)
+    except OSError:
+      names = []
+    tasks = [(os.path.join(path, name), blocksize) for name in names]
+    pool = ThreadPool(max(1, min(workers, len(tasks))))
+    try:
+      results = pool.map(_walkTask, tasks)
+    finally:
+      pool.close()
+      pool.join()
+    st = os.lstat(path)
+    if not blocksize:
+      results.append((st.st_blocks * _sectorSize, {}))
   else:
-    cmd = ['/bin/du', '-c', '-s', '-B', '1', path]
-    lines = execGetOutput(cmd, shell = False)
-    size, _ = lines[-1].split()
-  size = int(size)
+    results = [_walk(path, blocksize)]
+  size = 0
+  linked = {}
+  for (s, l) in results:
+    size += s
+    linked.update(l)
+  size += sum(linked.values())
   if withHuman:
     return {'size':size, 'sizeHuman':getHumanSize(size)}
   else:
@@ -172,3 +237,17 @@ if __name__ == '__main__':
   print stats2
   assertTrue(stats2['size'] > 0)
   assertTrue(stats2['size'] > stats1['size'])
+  print 'getUsedSize with hard links'
+  import shutil
+  import tempfile
+  tmp = tempfile.mkdtemp()
+  os.mkdir(os.path.join(tmp, 'a'))
+  open(os.path.join(tmp, 'a', 'f'), 'w').write(b'x' * 100000)
+  stats1 = getUsedSize(tmp, withHuman = False)
+  os.link(os.path.join(tmp, 'a', 'f'), os.path.join(tmp, 'g'))
+  stats2 = getUsedSize(tmp, withHuman = False)
+  print stats2
+  assertEquals(stats1, stats2)
+  assertEquals(stats2, getUsedSize(tmp, withHuman = False, workers = 4))
+  assertEquals(2 * 524288, getUsedSize(tmp, 524288)['size'])
+  shutil.rmtree(tmp)
@@ -6,6 +6,8 @@ Get information about filesystem, create them, ...
 For now it only handles (S/P)ATA disks and partitions. RAID and LVM are not supported.
 /proc and /sys should be mounted for getting information
 Functions:
+  - scanFilesystems
+  - getDiskPartitionTable
   - getFsType
   - getFsLabel
   - makeFs
@@ -16,9 +18,152 @@ __copyright__ = 'Copyright 2011-2013, Salix OS'
 __license__ = 'GPL2+'
 from execute import *
 from freesize import getSizes
+from superblock import probeDevice, getPartitionTable, isExtendedBootRecord
 import os
 from stat import *
 import re
+from multiprocessing.pool import ThreadPool
+
+_fsTags = None
+_partitionTables = {}
+
+def _unescapeBlkidValue(value):
+  """
+  blkid export format escapes unsafe characters with a backslash.
+  """
+  return re.sub(r'\\(.)', r'\1', value)
+
+def _isExtendedPartition(partitionDevice):
+  """
+  The kernel only exposes the first one or two sectors of an extended partition, this is enough to detect it without forking 'file'.
+  """
+  try:
+    if not os.path.exists('/sys/class/block/{0}/partition'.format(partitionDevice)):
+      return False
+    return int(open('/sys/class/block/{0}/size'.format(partitionDevice), 'r').read().strip()) <= 2
+  except (IOError, ValueError):
+    return False
+
+def getDiskPartitionTable(diskDevice):
+  """
+  Returns the partition table of the disk (see superblock.getPartitionTable), None if it has none or cannot be read.
+  diskDevice should no be prefixed with '/dev/'.
+  It is read once, with the logical sector size of the disk, and kept until scanFilesystems is refreshed.
+  """
+  if diskDevice not in _partitionTables:
+    try:
+      sectorSize = int(open('/sys/block/{0}/queue/logical_block_size'.format(diskDevice), 'r').read().strip())
+    except (IOError, ValueError):
+      sectorSize = 512
+    _partitionTables[diskDevice] = getPartitionTable('/dev/{0}'.format(diskDevice), sectorSize = sectorSize)
+  return _partitionTables[diskDevice]
+
+def _partitionUuid(partitionDevice):
+  """
+  Returns the PARTUUID of the partition, as blkid computes it from the partition table of its disk.
+  """
+  try:
+    number = int(open('/sys/class/block/{0}/partition'.format(partitionDevice), 'r').read().strip())
+    diskDevice = os.path.basename(os.path.dirname(os.path.realpath('/sys/class/block/{0}'.format(partitionDevice))))
+  except (IOError, OSError, ValueError):
+    return None
+  table = getDiskPartitionTable(diskDevice)
+  if not table:
+    return None
+  for entry in table.entries:
+    if entry.number == number:
+      return entry.uuid
+  if table.type == 'dos':
+    return '{0}-{1:02x}'.format(table.uuid, number) # logical partition
+  return None
+
+def _probeDevice(device):
+  """
+  The partition table of a whole disk is the cached one, read with its sector size.
+  """
+  if os.path.isdir('/sys/block/{0}'.format(device)):
+    return probeDevice('/dev/{0}'.format(device), table = getDiskPartitionTable(device))
+  return probeDevice('/dev/{0}'.format(device))
+
+def _probeDevices(devices):
+  """
+  Returns a dictionary of the tags of the devices, read in-process from their superblocks.
+  A device that cannot be read, whose signature is unknown or which is a md RAID member, a LVM physical volume or a LUKS volume has None.
+  """
+  if not devices:
+    return {}
+  pool = ThreadPool(min(len(devices), 8)) # mostly waiting for the disks
+  try:
+    results = pool.map(_probeDevice, devices)
+  finally:
+    pool.close()
+    pool.join()
+  tags = dict([(device, res or None) for (device, res) in zip(devices, results)])
+  for (device, res) in tags.items():
+    if res and 'TYPE' in res:
+      partUuid = _partitionUuid(device)
+      if partUuid:
+        res['PARTUUID'] = partUuid
+  return tags
+
+def scanFilesystems(refresh = False):
+  """
+  Returns a dictionary, keyed by device (without /dev/), of the blkid tags (TYPE, LABEL, UUID, ...) of every block device listed in /proc/partitions.
+  A device without any recognized signature has an empty dictionary.
+  The superblocks are read in-process (see superblock.probeDevice), only the devices that cannot be read or are not recognized are probed by one blkid call.
+  The result is cached, use 'refresh' to probe again, the partition tables are read again too.
+  """
+  global _fsTags
+  if _fsTags is None or refresh:
+    _partitionTables.clear()
+    devices = [l.split()[-1] for l in open('/proc/partitions', 'r').read().splitlines()[2:] if l.strip()]
+    tags = _probeDevices(devices)
+    unknown = [d for d in devices if tags[d] is None]
+    for device in unknown:
+      tags[device] = {}
+    if unknown:
+      try:
+        lines = execGetOutput(['/sbin/blkid', '-c', '/dev/null', '-o', 'export'] + ['/dev/{0}'.format(d) for d in unknown], shell = False)
+      except subprocess.CalledProcessError:
+        lines = [] # blkid returns 2 if nothing has been found
+      device = None
+      for line in lines:
+        line = line.strip()
+        if not line:
+          device = None
+        elif '=' in line:
+          key, value = line.split('=', 1)
+          value = _unescapeBlkidValue(value)
+          if key == 'DEVNAME':
+            device = re.sub(r'^/dev/', '', value)
+            tags[device] = {}
+          elif device:
+            tags[device][key] = value
+    _fsTags = tags
+  return _fsTags
+
+def _getCachedFsTags(partitionDevice):
+  """
+  Returns the blkid tags of the block device or None if it is not known by the cache.
+  """
+  return scanFilesystems().get(partitionDevice)
+
+def _probeFile(path):
+  """
+  Returns the tags of the superblock of 'path', with TYPE set to 'Extended' for an extended boot record.
+  Returns None if it cannot be read or is not recognized.
+  """
+  tags = probeDevice(path)
+  if not tags:
+    return None
+  if 'TYPE' not in tags:
+    try:
+      with open(path, 'rb') as f:
+        if isExtendedBootRecord(f.read(512)):
+          tags['TYPE'] = 'Extended'
+    except IOError:
+      pass
+  return tags
 
 def getFsType(partitionDevice):
   """
@@ -26,15 +171,25 @@ def getFsType(partitionDevice):
   'partitionDevice' should no be prefixed with '/dev/' if it's a block device.
   It can be a full path if the partition is contained in a file.
   Returns 'Extended' if the partition is an extended partition and has no filesystem.
+  Block devices are served from the scanFilesystems cache, files are probed in-process first.
   """
   if os.path.exists('/dev/{0}'.format(partitionDevice)) and S_ISBLK(os.stat('/dev/{0}'.format(partitionDevice)).st_mode):
     path = '/dev/{0}'.format(partitionDevice)
+    tags = _getCachedFsTags(partitionDevice)
+    if tags is not None:
+      fstype = tags.get('TYPE', False)
+      if not fstype and _isExtendedPartition(partitionDevice):
+        fstype = 'Extended'
+      return fstype
   elif os.path.isfile(partitionDevice):
     path = partitionDevice
   else:
     fstype = False
     path = False
   if path:
+    tags = _probeFile(path)
+    if tags is not None:
+      return tags.get('TYPE', False)
     try:
       fstype = execGetOutput(['/sbin/blkid', '-s', 'TYPE', '-o', 'value', path], shell = False)
       if fstype:
@@ -58,15 +213,22 @@ def getFsLabel(partitionDevice):
   Returns the label for that partition (if any).
   'partitionDevice' should no be prefixed with '/dev/' if it is a block device.
   It can be a full path if the partition is contained in a file.
+  Block devices are served from the scanFilesystems cache, files are probed in-process first.
   """
   if os.path.exists('/dev/{0}'.format(partitionDevice)) and S_ISBLK(os.stat('/dev/{0}'.format(partitionDevice)).st_mode):
     path = '/dev/{0}'.format(partitionDevice)
+    tags = _getCachedFsTags(partitionDevice)
+    if tags is not None:
+      return tags.get('LABEL', '')
   elif os.path.isfile(partitionDevice):
     path = partitionDevice
   else:
     label = False
     path = False
   if path:
+    tags = _probeFile(path)
+    if tags is not None:
+      return tags.get('LABEL', '')
     try:
       label = execGetOutput(['/sbin/blkid', '-s', 'LABEL', '-o', 'value', path], shell = False)
       if label:
@@ -85,6 +247,7 @@ def makeFs(partitionDevice, fsType, label=None, force=False, options=None):
   Use 'force=True' if you want to force the creation of the filesystem and if 'partitionDevice' is a full path to a file (not a block device).
   Use 'options' to force these options on the creation process (use a list)
   """
+  global _fsTags
   if force and os.path.exists(partitionDevice):
     path = partitionDevice
   else:
@@ -93,6 +256,7 @@ def makeFs(partitionDevice, fsType, label=None, force=False, options=None):
       raise IOError('{0} does not exist'.format(path))
     if not S_ISBLK(os.stat(path).st_mode):
       raise IOError('{0} is not a block device'.format(path))
+    _fsTags = None # the cached signatures will be outdated
   if fsType not in ('ext2', 'ext3', 'ext4', 'xfs', 'reiserfs', 'jfs', 'btrfs', 'ntfs', 'fat16', 'fat32', 'swap'):
     raise Exception('{0} is not a recognized filesystem.'.format(fsType))
   if fsType in ('ext2', 'ext3', 'ext4'):
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Read-only inspection of a filesystem without mounting it.
+Only ext2/3/4 filesystems can be inspected, using debugfs which opens the device read-only.
+Functions:
+  - canInspect
+  - listDirectory
+  - readFile
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2011-2013, Salix OS'
+__license__ = 'GPL2+'
+from execute import *
+import os
+import re
+import subprocess
+
+_debugfs = '/sbin/debugfs'
+_inspectableFsTypes = ('ext2', 'ext3', 'ext4')
+# ls -p: /inode/mode/uid/gid/name/size/
+_lsLine = re.compile(r'^/(\d+)/([0-7]+)/\d+/\d+/(.*)/(\d*)/$')
+
+def canInspect(fsType):
+  """
+  Returns True if a filesystem of type 'fsType' can be inspected without being mounted.
+  """
+  return fsType in _inspectableFsTypes and os.path.exists(_debugfs)
+
+def _debugfsRequest(device, request):
+  """
+  Runs a debugfs request on 'device' opened read-only (-c does not even read the bitmaps).
+  Returns the output lines or None if debugfs cannot be run.
+  """
+  try:
+    return execGetOutput([_debugfs, '-c', '-R', request, device], shell = False)
+  except (subprocess.CalledProcessError, OSError):
+    return None
+
+def listDirectory(device, path):
+  """
+  Returns the list of (name, mode) of the entries in the directory 'path' of the filesystem on 'device', '.' and '..' excluded.
+  'mode' is the st_mode of the entry, use the stat module to know its type.
+  Returns None if the directory cannot be read.
+  """
+  lines = _debugfsRequest(device, 'ls -p "{0}"'.format(path))
+  if lines is None:
+    return None
+  entries = []
+  found = False
+  for line in lines:
+    m = _lsLine.match(line.strip())
+    if m:
+      found = True
+      name = m.group(3)
+      if name not in ('.', '..'):
+        entries.append((name, int(m.group(2), 8)))
+  if not found: # not even '.', so the directory does not exist
+    return None
+  return entries
+
+def readFile(device, path):
+  """
+  Returns the content of the file 'path' of the filesystem on 'device' as a list of lines.
+  An empty list is returned if the file does not exist or cannot be read.
+  """
+  lines = _debugfsRequest(device, 'cat "{0}"'.format(path))
+  return lines or []
+
+# Unit test
+if __name__ == '__main__':
+  from assertPlus import *
+  from stat import *
+  import shutil
+  import tempfile
+  tmp = tempfile.mkdtemp()
+  os.makedirs(os.path.join(tmp, 'boot/grub'))
+  os.makedirs(os.path.join(tmp, 'etc'))
+  open(os.path.join(tmp, 'boot/vmlinuz-3.10.17'), 'w').write('kernel')
+  os.symlink('vmlinuz-3.10.17', os.path.join(tmp, 'boot/vmlinuz'))
+  open(os.path.join(tmp, 'etc/fstab'), 'w').write('/dev/sda1 / ext4 defaults 1 1\n')
+  execCall(['/bin/dd', 'if=/dev/zero', 'of=ext4.fs', 'bs=1M', 'count=10'], shell = False)
+  execCall(['/sbin/mkfs.ext4', '-q', '-F', '-d', tmp, 'ext4.fs'], shell = False)
+  shutil.rmtree(tmp)
+  assertTrue(canInspect('ext4'))
+  assertFalse(canInspect('ntfs'))
+  entries = dict(listDirectory('ext4.fs', '/boot'))
+  assertEquals(['grub', 'vmlinuz', 'vmlinuz-3.10.17'], sorted(entries.keys()))
+  assertTrue(S_ISDIR(entries['grub']))
+  assertTrue(S_ISLNK(entries['vmlinuz']))
+  assertTrue(S_ISREG(entries['vmlinuz-3.10.17']))
+  assertEquals(None, listDirectory('ext4.fs', '/nonexistant'))
+  assertEquals(['/dev/sda1 / ext4 defaults 1 1'], readFile('ext4.fs', '/etc/fstab'))
+  assertEquals([], readFile('ext4.fs', '/nonexistant'))
+  os.unlink('ext4.fs')
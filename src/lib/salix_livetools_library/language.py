@@ -32,10 +32,13 @@ def listAvailableLocales(mountPoint = None):
   libdir = 'lib'
   if os.path.isdir('{0}/usr/lib64/locale'.format(mountPoint)):
     libdir = 'lib64'
-  for path in sorted(glob.glob('{0}/usr/{1}/locale/*.utf8'.format(mountPoint, libdir))):
+  paths = sorted(glob.glob('{0}/usr/{1}/locale/*.utf8'.format(mountPoint, libdir)))
+  titles = execBatch(["strings {0}/LC_IDENTIFICATION | grep -i 'locale for'".format(path) for path in paths])
+  for (path, (ret, lines)) in zip(paths, titles):
+    if ret != 0 or not lines:
+      raise subprocess.CalledProcessError(returncode = ret, cmd = 'strings {0}/LC_IDENTIFICATION'.format(path))
     locale = os.path.basename(path).rsplit('.', 1)[0]
-    title = execGetOutput("strings {0}/LC_IDENTIFICATION | grep -i 'locale for'".format(path))[0]
-    locales.append((locale, title))
+    locales.append((locale, lines[0]))
   return locales
 
 def getCurrentLocale():
@@ -15,6 +15,7 @@ __copyright__ = 'Copyright 2011-2013, Salix OS'
 __license__ = 'GPL2+'
 from execute import *
 from fs import getFsType
+from mounttable import *
 import os
 from stat import *
 import re
@@ -27,23 +28,19 @@ def getTempMountDir():
 def getMountPoint(device):
   """
   Find the mount point to this 'device' or None if not mounted.
+  The mount table index is used, so /proc/self/mountinfo is only parsed when it has changed.
   """
-  mountpoint = None
-  path = os.path.abspath(device)
-  for line in execGetOutput(['/bin/mount'], shell = False):
-    p, _, mp, _ = line.split(' ', 3) # 3 splits max, _ is discarded
-    if os.path.islink(p):
-      p = os.path.realpath(p)
-    if p == path:
-      mountpoint = mp
-      break
-  return mountpoint
+  entry = findMountEntry(device)
+  if entry:
+    return entry.mountPoint
+  else:
+    return None
 
 def isMounted(device):
   """
   Same as os.path.ismount(path) but using a block device.
   """
-  if getMountPoint(device):
+  if findMountEntry(device):
     return True
   else:
     return False
@@ -83,6 +80,7 @@ def mountDevice(device, fsType = None, mountPoint = None):
     except os.error:
       pass
   ret = execCall(['mount', '-t', fsType, device, mountPoint], shell = False)
+  invalidateMountTable()
   if ret != 0 and autoMP:
     _deleteMountPoint(mountPoint)
   else:
@@ -104,6 +102,7 @@ def umountDevice(deviceOrPath, tryLazyUmount = True, deleteMountPoint = True):
     ret = execCall(['umount', mountPoint], shell = False)
     if ret != 0:
        ret = execCall(['umount', '-l', mountPoint], shell = False)
+    invalidateMountTable()
     if ret == 0 and deleteMountPoint:
       _deleteMountPoint(mountPoint)
     return ret == 0
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Index of the mounted filesystems, parsed from /proc/self/mountinfo.
+The table is kept in memory and only parsed again when the kernel signals a change of the mount table (using poll) or when it is explicitly invalidated.
+Functions:
+  - getMountTable
+  - invalidateMountTable
+  - findMountEntry
+  - findMountEntryByMountPoint
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2011-2013, Salix OS'
+__license__ = 'GPL2+'
+from collections import namedtuple
+from threading import Lock
+import os
+import re
+import select
+from stat import *
+
+MountEntry = namedtuple('MountEntry', ['device', 'mountPoint', 'fsType', 'majorMinor', 'root', 'options'])
+_mountInfoPath = '/proc/self/mountinfo'
+_mountInfoFd = None
+_poller = None
+_table = None
+_lock = Lock()
+
+def _unescape(field):
+  """
+  Spaces, tabs, new lines and backslashes are escaped as octal sequences in mountinfo.
+  """
+  return re.sub(r'\\([0-7]{3})', lambda m: unichr(int(m.group(1), 8)), field)
+
+def _readMountInfo():
+  global _mountInfoFd, _poller
+  if _mountInfoFd is None:
+    _mountInfoFd = os.open(_mountInfoPath, os.O_RDONLY)
+    if hasattr(select, 'poll'):
+      _poller = select.poll()
+      _poller.register(_mountInfoFd, select.POLLPRI | select.POLLERR)
+  os.lseek(_mountInfoFd, 0, os.SEEK_SET)
+  chunks = []
+  while True:
+    chunk = os.read(_mountInfoFd, 65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  return b''.join(chunks).decode('utf-8', 'replace').splitlines()
+
+def _hasChanged():
+  """
+  The mountinfo file descriptor is signaled with POLLPRI|POLLERR once the mount table changed.
+  """
+  if _poller is None:
+    return True
+  for fd, event in _poller.poll(0):
+    if event & (select.POLLPRI | select.POLLERR):
+      return True
+  return False
+
+def _loopBackingFile(device):
+  try:
+    return open('/sys/block/{0}/loop/backing_file'.format(os.path.basename(device)), 'r').read().strip()
+  except IOError:
+    return None
+
+def _parseMountInfo(lines):
+  """
+  Returns a tuple of dictionaries (byDevice, byMajorMinor, byMountPoint) of MountEntry.
+  Line format:
+  id parentId major:minor root mountPoint options [optionalFields...] - fsType source superOptions
+  """
+  byDevice = {}
+  byMajorMinor = {}
+  byMountPoint = {}
+  for line in lines:
+    fields = line.split(' ')
+    try:
+      sep = fields.index('-', 6)
+    except ValueError:
+      continue
+    majorMinor = fields[2]
+    root = _unescape(fields[3])
+    mountPoint = _unescape(fields[4])
+    fsType = fields[sep + 1]
+    device = _unescape(fields[sep + 2])
+    entry = MountEntry(device, mountPoint, fsType, majorMinor, root, fields[5])
+    byMountPoint[mountPoint] = entry # the last one hides the previous ones
+    deviceKeys = [device]
+    if device.startswith('/'):
+      if os.path.islink(device):
+        deviceKeys.append(os.path.realpath(device))
+      if device.startswith('/dev/loop'):
+        backingFile = _loopBackingFile(device)
+        if backingFile:
+          deviceKeys.append(backingFile)
+    for index, keys in ((byDevice, deviceKeys), (byMajorMinor, [majorMinor])):
+      for key in keys:
+        # the first mount of a device wins, except if it's a bind of a sub-directory
+        if key not in index or (index[key].root != '/' and root == '/'):
+          index[key] = entry
+  return (byDevice, byMajorMinor, byMountPoint)
+
+def getMountTable():
+  """
+  Returns the mount table as a tuple of dictionaries of MountEntry (device, mountPoint, fsType, majorMinor, root, options):
+    - byDevice: keyed by mount source, symbolic links are also resolved.
+    - byMajorMinor: keyed by 'major:minor' of the mounted device.
+    - byMountPoint: keyed by mount point.
+  /proc/self/mountinfo is only read again if it changed since the last call.
+  """
+  global _table
+  with _lock:
+    if _table is None or _hasChanged():
+      _table = _parseMountInfo(_readMountInfo())
+    return _table
+
+def invalidateMountTable():
+  """
+  Forces the mount table to be read again on the next access.
+  """
+  global _table
+  with _lock:
+    _table = None
+
+def findMountEntry(device):
+  """
+  Returns the MountEntry of 'device' or None if not mounted.
+  'device' is a path to a block device (symbolic links are resolved) or to a file mounted by a loop device.
+  """
+  byDevice, byMajorMinor, byMountPoint = getMountTable()
+  path = os.path.abspath(device)
+  try:
+    st = os.stat(path)
+    if S_ISBLK(st.st_mode):
+      majorMinor = '{0}:{1}'.format(os.major(st.st_rdev), os.minor(st.st_rdev))
+      if majorMinor in byMajorMinor:
+        return byMajorMinor[majorMinor]
+  except OSError:
+    pass
+  return byDevice.get(path) or byDevice.get(os.path.realpath(path))
+
+def findMountEntryByMountPoint(mountPoint):
+  """
+  Returns the MountEntry mounted on 'mountPoint' or None if nothing is mounted there.
+  """
+  return getMountTable()[2].get(os.path.abspath(mountPoint))
+
+# Unit test
+if __name__ == '__main__':
+  from assertPlus import *
+  byDevice, byMajorMinor, byMountPoint = getMountTable()
+  assertTrue('/' in byMountPoint)
+  assertTrue(getMountTable()[0] is byDevice) # not changed, so not read again
+  invalidateMountTable()
+  assertFalse(getMountTable()[0] is byDevice)
+  assertEquals('/proc', findMountEntryByMountPoint('/proc').mountPoint)
+  assertEquals(None, findMountEntry('/nonexistant'))
+  entries = _parseMountInfo(['36 35 98:0 / /mnt/my\\040disk rw,noatime master:1 - ext3 /dev/sdz1 rw,errors=continue', '37 35 98:0 /sub /mnt/bind rw - ext3 /dev/sdz1 rw'])
+  assertEquals('/mnt/my disk', entries[0]['/dev/sdz1'].mountPoint)
+  assertEquals('/', entries[1]['98:0'].root)
+  assertEquals('/sub', entries[2]['/mnt/bind'].root)
@@ -3,6 +3,8 @@
 # vim: set et ai sta sw=2 ts=2 tw=0:
 """
 SaLT functions:
+  - getSaLTEnvironment
+  - refreshSaLTEnvironment
   - getSaLTVersion
   - isSaLTVersionAtLeast
   - isSaLTLiveEnv
@@ -13,6 +15,7 @@ SaLT functions:
   - getSaLTBaseDir
   - listSaLTModules
   - installSaLTModule
+  - installSaLTModules
 """
 from __future__ import unicode_literals
 
@@ -21,17 +24,233 @@ __license__ = 'GPL2+'
 import os
 import glob
 import re
-import subprocess
+import json
+import codecs
+import struct
+import tempfile
+from threading import Thread, Event, RLock
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+from time import time
 from freesize import *
-from threading import Thread
-from time import sleep
+from filecopy import copyTree, scanTree, prefetchTree, CopyProgress
+
+_manifestName = '.salt-install.json'
+_prefetchBytes = 256 * 1024 * 1024 # read ahead of the next module, not more to keep the current one in memory
+
+SaLTModule = namedtuple('SaLTModule', ['name', 'path', 'size'])
+SaLTModuleSize = namedtuple('SaLTModuleSize', ['name', 'size', 'files', 'inodes'])
+_squashfsMagic = 0x73717368
+_sizeCachePath = '/var/cache/bootsetup/salt-modules.json' # root-owned, in memory in a Live session
+_sizeCacheVersion = 1
+
+def _readSquashfsSuperblock(path):
+  """
+  Returns the (inodes count, modification time, bytes used) of the squashfs superblock of the module file 'path', or None if it is not a squashfs image.
+  """
+  try:
+    with open(path, 'rb') as f:
+      data = f.read(48)
+    (magic, inodes, mtime) = struct.unpack(b'<III', data[0:12])
+    (bytesUsed,) = struct.unpack(b'<Q', data[40:48])
+  except (IOError, struct.error):
+    return None
+  if magic != _squashfsMagic:
+    return None
+  return (inodes, mtime, bytesUsed)
+
+class SaLTEnvironment(object):
+  """
+  Description of the SaLT Live environment, read from the files of 'saltDir' the first time each value is needed and kept until refresh is called.
+  The values are:
+    - isLive, isClone
+    - version
+    - liveMountPoint, identFile, baseDir, rootDir, moduleDir
+    - config: the values of etc/salt.cfg
+    - modules: the SaLTModule of each module of the Live session, by name, with the path and the size of its .salt file
+    - moduleSizes: the SaLTModuleSize of each module, by name: uncompressed size in bytes, number of files and number of inodes
+  Reading a value other than isLive raises an Exception if not in a SaLT Live environment.
+  """
+
+  def __init__(self, saltDir = '/mnt/salt', sizeCachePath = _sizeCachePath):
+    self.saltDir = saltDir
+    self.sizeCachePath = sizeCachePath
+    self._lock = RLock()
+    self._values = {}
+
+  def refresh(self):
+    """
+    Forgets every value, they will be read again when needed.
+    """
+    with self._lock:
+      self._values = {}
+
+  def _value(self, name, read):
+    with self._lock:
+      if name not in self._values:
+        self._values[name] = read()
+      return self._values[name]
+
+  def _path(self, *parts):
+    return os.path.join(self.saltDir, *parts)
+
+  def _checkLive(self):
+    if not self.isLive:
+      raise Exception('Not in SaLT Live environment.')
+
+  @staticmethod
+  def _readKeyValues(path, separator = '='):
+    values = {}
+    with open(path, 'r') as f:
+      for line in f.read().splitlines():
+        if separator in line:
+          (key, value) = line.split(separator, 1)
+          values.setdefault(key, value)
+    return values
+
+  @property
+  def isLive(self):
+    return self._value('isLive', lambda: os.path.isfile(self._path('salt-version')) and os.path.isfile(self._path('tmp', 'distro_infos')))
+
+  @property
+  def version(self):
+    self._checkLive()
+    return self._value('version', lambda: open(self._path('salt-version'), 'r').read().strip())
+
+  @property
+  def liveMountPoint(self):
+    self._checkLive()
+    def read():
+      try:
+        # format:
+        # mountpoint:device
+        ret = open(self._path('tmp', 'distro_infos'), 'r').read().splitlines()[0].split(':', 1)[0]
+      except:
+        ret = None
+      return "{0}{1}".format(self.saltDir, ret)
+    return self._value('liveMountPoint', read)
+
+  @property
+  def config(self):
+    self._checkLive()
+    return self._value('config', lambda: self._readKeyValues(self._path('etc', 'salt.cfg')))
+
+  @property
+  def rootDir(self):
+    return self.config.get('ROOT_DIR')
+
+  @property
+  def identFile(self):
+    return self.config.get('IDENT_FILE')
+
+  @property
+  def baseDir(self):
+    def read():
+      mountpoint = self.liveMountPoint
+      identfile = self.identFile
+      ret = None
+      if mountpoint and identfile:
+        ret = self._readKeyValues('{0}/{1}'.format(mountpoint, identfile)).get('basedir')
+      if ret != None and len(ret) == 0:
+        ret = '.' # for not having empty path. GNU is ok having a path like a/b//c/d but it's preferable to have a/b/./c/d if possible
+      return ret
+    self._checkLive()
+    return self._value('baseDir', read)
+
+  @property
+  def moduleDir(self):
+    return '{0}/{1}/{2}/modules'.format(self.liveMountPoint, self.baseDir, self.rootDir)
+
+  @property
+  def isClone(self):
+    if not self.isLive:
+      return False
+    return '01-clone' in self.modules
+
+  @property
+  def modules(self):
+    def read():
+      modules = OrderedDict()
+      for path in sorted(glob.glob('{0}/*.salt'.format(self.moduleDir))):
+        name = re.sub(r'.*/([^/]+).salt$', r'\1', path)
+        modules[name] = SaLTModule(name, path, os.stat(path).st_size)
+      return modules
+    self._checkLive()
+    return self._value('modules', read)
+
+  def _moduleSize(self, module, cache):
+    """
+    The inodes count is read in the squashfs superblock. The uncompressed size and the number of files need the files list, which is only in the compressed tables of the image, so the mounted module is scanned, once: the result is kept in the cache, keyed by the image.
+    The size and the number of files are None if the module is not mounted.
+    """
+    superblock = _readSquashfsSuperblock(module.path)
+    st = os.stat(module.path)
+    key = [module.path, st.st_size, st.st_mtime, superblock and superblock[1]]
+    cached = cache.get(module.name)
+    if cached and cached['key'] == key:
+      return SaLTModuleSize(module.name, cached['size'], cached['files'], cached['inodes'])
+    mountPoint = os.path.join(self.saltDir, 'mnt', 'modules', module.name)
+    if os.path.isdir(mountPoint) and os.listdir(mountPoint):
+      (size, files) = scanTree(mountPoint)
+    else:
+      (size, files) = (None, None)
+    inodes = superblock and superblock[0]
+    if size is not None:
+      cache[module.name] = {'key':key, 'size':size, 'files':files, 'inodes':inodes}
+    return SaLTModuleSize(module.name, size, files, inodes)
+
+  @property
+  def moduleSizes(self):
+    def read():
+      try:
+        with codecs.open(self.sizeCachePath, 'r', 'utf-8') as f:
+          data = json.load(f)
+        cache = data.get('version') == _sizeCacheVersion and data.get('modules') or {}
+      except (IOError, ValueError):
+        cache = {}
+      modules = self.modules.values()
+      if modules:
+        pool = ThreadPool(min(4, len(modules))) # the scans mostly wait for the Live media
+        try:
+          sizes = pool.map(lambda m: self._moduleSize(m, cache), modules)
+        finally:
+          pool.close()
+          pool.join()
+      else:
+        sizes = []
+      try:
+        cacheDir = os.path.dirname(self.sizeCachePath)
+        if not os.path.isdir(cacheDir):
+          os.makedirs(cacheDir, 0755)
+        _writeJson(self.sizeCachePath, {'version':_sizeCacheVersion, 'modules':cache})
+      except (IOError, OSError):
+        pass # only an optimization
+      return OrderedDict([(size.name, size) for size in sizes])
+    self._checkLive()
+    return self._value('moduleSizes', read)
+
+_environment = None
+
+def getSaLTEnvironment():
+  """
+  Returns the SaLTEnvironment of this Live session, shared by all the SaLT functions.
+  """
+  global _environment
+  if _environment is None:
+    _environment = SaLTEnvironment()
+  return _environment
+
+def refreshSaLTEnvironment():
+  """
+  Reads again the SaLT environment the next time it is needed, for instance after the Live media has been mounted.
+  """
+  getSaLTEnvironment().refresh()
 
 def getSaLTVersion():
   """
   Returns the SaLT version if run in a SaLT Live environment
   """
-  _checkLive()
-  return open('/mnt/salt/salt-version', 'r').read().strip()
+  return getSaLTEnvironment().version
 
 def isSaLTVersionAtLeast(version):
   """
@@ -51,99 +270,74 @@ def isSaLTLiveEnv():
   """
   Returns True if it is executed in a SaLT Live environment, False otherwise
   """
-  return os.path.isfile('/mnt/salt/salt-version') and os.path.isfile('/mnt/salt/tmp/distro_infos')
+  return getSaLTEnvironment().isLive
 
 def _checkLive():
-  if not isSaLTLiveEnv():
-    raise Exception('Not in SaLT Live environment.')
+  getSaLTEnvironment()._checkLive()
 
 def isSaLTLiveCloneEnv():
   """
   Returns True if it is executed in a SaLT LiveClone environment, False otherwise
   """
-  if not isSaLTLiveEnv():
-    return False
-  else:
-    moduledir = '{0}/{1}/{2}/modules'.format(getSaLTLiveMountPoint(), getSaLTBaseDir(), getSaLTRootDir())
-    return os.path.isfile(moduledir + '/01-clone.salt')
+  return getSaLTEnvironment().isClone
 
 def getSaLTLiveMountPoint():
   """
   Returns the SaLT source mount point path. It could be the mount point of the optical drive or the USB stick for example.
   """
-  _checkLive()
-  try:
-    # format:
-    # mountpoint:device
-    ret = open('/mnt/salt/tmp/distro_infos', 'r').read().splitlines()[0].split(':', 1)[0]
-  except:
-    ret = None
-  return "/mnt/salt{0}".format(ret)
+  return getSaLTEnvironment().liveMountPoint
 
 def getSaLTRootDir():
   """
   Returns the SaLT ROOT_DIR, which is the directory containing SaLT modules.
   This is not the full path but a relative path to BASEDIR.
   """
-  _checkLive()
-  ret = None
-  for line in open('/mnt/salt/etc/salt.cfg', 'r').read().splitlines():
-    if line.startswith('ROOT_DIR='):
-      ret = line.split('=', 1)[1]
-      break
-  return ret
+  return getSaLTEnvironment().rootDir
 
 def getSaLTIdentFile():
   """
   Returns the SaLT IDENT_FILE, which is the file located at the root of a filesystem containing some SaLT information for this Live session.
   This is not the full path but a relative path to the mount point.
   """
-  _checkLive()
-  ret = None
-  for line in open('/mnt/salt/etc/salt.cfg', 'r').read().splitlines():
-    if line.startswith('IDENT_FILE='):
-      ret = line.split('=', 1)[1]
-      break
-  return ret
+  return getSaLTEnvironment().identFile
 
 def getSaLTBaseDir():
   """
   Returns the SaLT BASEDIR, which is the directory containing all files for this Live session.
   This is not a full path but a relative path to the mount point.
   """
-  _checkLive()
-  mountpoint = getSaLTLiveMountPoint()
-  identfile = getSaLTIdentFile()
-  ret = None
-  if mountpoint and identfile:
-    for line in open('{0}/{1}'.format(mountpoint, identfile), 'r').read().splitlines():
-      if line.startswith('basedir='):
-        ret = line.split('=', 1)[1]
-        break
-  if ret != None and len(ret) == 0:
-    ret = '.' # for not having empty path. GNU is ok having a path like a/b//c/d but it's preferable to have a/b/./c/d if possible
-  return ret
-
-def listSaLTModules():
+  return getSaLTEnvironment().baseDir
+
+def listSaLTModules(withSizes = False):
   """
   Returns the list of SaLT modules for this Live session.
+  If 'withSizes' is True, returns a list of SaLTModuleSize (name, uncompressed size in bytes, number of files, number of inodes) instead, which can be given to installSaLTModules.
+  The sizes are computed once per Live session and cached.
   """
-  _checkLive()
-  moduledir = '{0}/{1}/{2}/modules'.format(getSaLTLiveMountPoint(), getSaLTBaseDir(), getSaLTRootDir())
-  return sorted(map(lambda(x): re.sub(r'.*/([^/]+).salt$', r'\1', x), glob.glob('{0}/*.salt'.format(moduledir))))
+  if withSizes:
+    return getSaLTEnvironment().moduleSizes.values()
+  return getSaLTEnvironment().modules.keys()
 
 def getSaLTModulePath(moduleName):
   """
   Get the module full path.
   """
-  return '/mnt/salt/mnt/modules/{0}'.format(moduleName)
+  return os.path.join(getSaLTEnvironment().saltDir, 'mnt', 'modules', moduleName)
 
-def installSaLTModule(moduleName, moduleSize, targetMountPoint, callback, callback_args = (), interval = 10, completeCallback = None):
+def installSaLTModule(moduleName, moduleSize, targetMountPoint, callback, callback_args = (), interval = 10, completeCallback = None, bufferSize = None, workers = 1, resume = False, checksum = None, verify = False):
   """
   Install the module 'moduleName' from this Live session into the targetMountPoint.
-  'moduleSize' is the uncompressed size of the module expressed in bytes.
-  The 'callback' function will be called each 'interval' seconds with the pourcentage (0 ≤ x ≤ 1) of progression (based on used size of target partition) as first argument and all value of callback_args as next arguments
+  'moduleSize' is the uncompressed size of the module expressed in bytes. It is not needed anymore, the files of the module are counted before the copy.
+  The 'callback' function will be called at most each 'interval' seconds, and at the end, with the pourcentage (0 ≤ x ≤ 1) of progression (based on the bytes copied) as first argument and all value of callback_args as next arguments.
+  This pourcentage is a filecopy.CopyProgress which also gives the bytes and files copied, the throughput and the ETA.
+  If the 'callback' function returns a false value, the installation is stopped.
+  'bufferSize' is the size of the chunks copied between two progress checks.
+  'workers' is the number of files copied in parallel, which helps on fast disks with big modules.
+  The files linked together in the module are linked together in the target too.
+  If 'resume' is True, each file copied is recorded in a manifest on the target, and an installation which has been stopped or interrupted only copies what is missing when run again. The manifest is removed once the module is installed without error.
+  'checksum' (like 'sha1') records the checksum of each file in the manifest, and with 'verify' the files are checked against the manifest at the end.
   The 'completeCallback' function will be called after the completion of installation.
+  Returns the final CopyProgress.
   """
   _checkLive()
   src = getSaLTModulePath(moduleName)
@@ -151,40 +345,150 @@ def installSaLTModule(moduleName, moduleSize, targetMountPoint, callback, callba
     raise IOError("The module '{0}' does not exists".format(moduleName))
   if not os.path.isdir(targetMountPoint):
     raise IOError("The target mount point '{0}' does not exists".format(targetMountPoint))
-  def get_used_size(p):
-    return getSizes(p, False)['used']
-  class ExecCopyTask:
-    def _run(self, *args, **kwargs):
-      cmd = args[0]
-      self._p = subprocess.Popen(cmd)
-      self._p.wait()
-    def start(self, cmd):
-      self._t = Thread(target=self._run, args=(cmd,))
-      self._t.start()
-    def is_running(self):
-      return self._t and self._t.is_alive()
-    def stop(self):
-      if self._p:
-        self._p.kill()
-        self._p = None
-  init_size = get_used_size(targetMountPoint)
-  actual_size = init_size
-  t = ExecCopyTask()
-  t.start(['cp', '--preserve', '-r', '-f', '--remove-destination', '{0}/.'.format(src), targetMountPoint + '/'])
-  while t.is_running():
-    for x in range(interval):
-      sleep(1)
-      if not t.is_running():
-        break
-    if t.is_running():
-      actual_size = get_used_size(targetMountPoint)
-      diff_size = float(actual_size - init_size)
-      if diff_size < 0: # is this possible?
-        diff_size = 0
-      p = diff_size / moduleSize
-      if p > 1:
-        p = 1
-      if not callback(p, *callback_args):
-        t.stop()
+  options = {}
+  if bufferSize:
+    options['bufferSize'] = bufferSize
+  manifest = None
+  if resume or verify:
+    manifest = _fileManifestPath(targetMountPoint, moduleName)
+  result = copyTree(src, targetMountPoint, callback, callback_args, interval, workers = workers, links = True,
+      manifest = manifest, checksum = checksum, verify = verify, **options)
+  if manifest and not result.canceled and not result.errors:
+    os.remove(manifest)
+  if completeCallback:
+    completeCallback()
+  return result
+
+def _fileManifestPath(targetMountPoint, moduleName):
+  return os.path.join(targetMountPoint, '.salt-install-{0}.files'.format(moduleName))
+
+def _readManifest(path):
+  try:
+    with codecs.open(path, 'r', 'utf-8') as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return None
+
+def _writeJson(path, data):
+  """
+  Writes 'data' as JSON so that 'path' is either the previous file or the new one, even after a crash.
+  The data goes to a new file of the same directory, created without following any symbolic link, then renamed over 'path'.
+  """
+  (fd, tmp) = tempfile.mkstemp(prefix = '.' + os.path.basename(path) + '.', dir = os.path.dirname(path) or '.')
+  try:
+    with codecs.getwriter('utf-8')(os.fdopen(fd, 'w')) as f:
+      json.dump(data, f, indent = 2, sort_keys = True)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, path)
+  except:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
+
+def _writeManifest(path, manifest):
+  """
+  Writes the manifest so that it is either the previous one or the new one, even after a crash.
+  """
+  _writeJson(path, manifest)
+
+def installSaLTModules(modules, targetMountPoint, callback, callback_args = (), interval = 10, completeCallback = None, bufferSize = None, workers = 1, manifest = None, checksum = None, verify = False):
+  """
+  Install the 'modules' of this Live session into the targetMountPoint, as one job.
+  'modules' is a list of module names, of (name, size) or of SaLTModuleSize as listSaLTModules(withSizes = True) returns. If all the sizes are given, they are used as the total to copy, else the modules are counted before the copy.
+  While a module is copied, the next one is read ahead, so that reading the Live media and writing the target overlap.
+  The 'callback' function will be called at most each 'interval' seconds with a filecopy.CopyProgress of the whole job as first argument and all value of callback_args as next arguments.
+  It also has the 'module' being copied, 'modulesDone' and 'modulesTotal'. If the 'callback' function returns a false value, the installation is stopped.
+  The job is recorded in the 'manifest' file, by default .salt-install.json in the targetMountPoint. If the installation is stopped or interrupted, calling this function again skips the modules already installed.
+  The files of each module are recorded too, as installSaLTModule does with 'resume', so that only what is missing of an interrupted module is copied again.
+  A module is only recorded as installed if it has no error, the manifests are removed once all the modules are installed.
+  'bufferSize', 'workers', 'checksum' and 'verify' are as for installSaLTModule.
+  The 'completeCallback' function will be called after the completion of installation.
+  Returns the final CopyProgress.
+  """
+  _checkLive()
+  if not os.path.isdir(targetMountPoint):
+    raise IOError("The target mount point '{0}' does not exists".format(targetMountPoint))
+  modules = [isinstance(m, (list, tuple)) and (m[0], m[1], len(m) > 2 and m[2] or 0) or (m, None, 0) for m in modules]
+  for (name, size, files) in modules:
+    if not os.path.isdir(getSaLTModulePath(name)):
+      raise IOError("The module '{0}' does not exists".format(name))
+  if not manifest:
+    manifest = os.path.join(targetMountPoint, _manifestName)
+  names = [name for (name, size, files) in modules]
+  state = _readManifest(manifest) or {}
+  done = [name for name in state.get('done', []) if name in names]
+  state = {'modules':names, 'done':done, 'current':None}
+  _writeManifest(manifest, state)
+  if [size for (name, size, files) in modules if size is None]:
+    totals = dict([(name, scanTree(getSaLTModulePath(name))) for (name, size, files) in modules])
+  else:
+    totals = dict([(name, (size, files)) for (name, size, files) in modules])
+  job = {
+      'bytesTotal':sum([totals[name][0] for name in names]),
+      'filesTotal':sum([totals[name][1] for name in names]),
+      'bytesDone':sum([totals[name][0] for name in done]),
+      'bytesSkipped':sum([totals[name][0] for name in done]),
+      'start':time(),
+      'filesDone':0,
+      'filesSkipped':0,
+      'errors':[],
+      'module':None,
+    }
+  def progressOf(p, canceled = False):
+    bytesCopied = job['bytesDone'] + (p and p.bytesCopied or 0)
+    elapsed = time() - job['start']
+    if job['bytesTotal']:
+      fraction = min(1.0, float(bytesCopied) / job['bytesTotal'])
+    else:
+      fraction = 1.0
+    throughput = (bytesCopied - job['bytesSkipped']) / elapsed if elapsed > 0 else 0.0
+    remaining = max(0, job['bytesTotal'] - bytesCopied)
+    return CopyProgress(fraction, bytesCopied = bytesCopied, bytesTotal = job['bytesTotal'],
+        filesCopied = job['filesDone'] + (p and p.filesCopied or 0), filesTotal = job['filesTotal'],
+        filesSkipped = job['filesSkipped'] + (p and p.filesSkipped or 0),
+        elapsed = elapsed, throughput = throughput, eta = remaining / throughput if throughput else (0.0 if not remaining else None),
+        canceled = canceled or (p and p.canceled or False), errors = job['errors'] + (p and p.errors or []),
+        module = job['module'], modulesDone = len(state['done']), modulesTotal = len(names))
+  def moduleCallback(p):
+    return callback(progressOf(p), *callback_args)
+  options = {}
+  if bufferSize:
+    options['bufferSize'] = bufferSize
+  todo = [name for name in names if name not in done]
+  result = progressOf(None)
+  for (i, name) in enumerate(todo):
+    stopPrefetch = Event()
+    prefetch = None
+    if i + 1 < len(todo):
+      prefetch = Thread(target = prefetchTree, args = (getSaLTModulePath(todo[i + 1]), _prefetchBytes, stopPrefetch))
+      prefetch.daemon = True
+      prefetch.start()
+    job['module'] = name
+    state['current'] = name
+    _writeManifest(manifest, state)
+    try:
+      p = copyTree(getSaLTModulePath(name), targetMountPoint, moduleCallback, (), interval, total = totals[name], workers = workers, links = True,
+          manifest = _fileManifestPath(targetMountPoint, name), checksum = checksum, verify = verify, **options)
+    finally:
+      stopPrefetch.set()
+      if prefetch:
+        prefetch.join()
+    result = progressOf(p)
+    if p.canceled:
+      break
+    job['bytesDone'] += totals[name][0]
+    job['filesDone'] += p.filesCopied
+    job['filesSkipped'] += p.filesSkipped
+    job['errors'].extend(p.errors)
+    if not p.errors:
+      state['done'].append(name)
+      os.remove(_fileManifestPath(targetMountPoint, name))
+    state['current'] = None
+    _writeManifest(manifest, state)
+    result = progressOf(None)
+  if len(state['done']) == len(names):
+    os.remove(manifest)
   if completeCallback:
     completeCallback()
+  return result
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Filesystem signatures and partition tables read directly from the devices, without blkid.
+The first 68 KiB of a device are read once and every known superblock is looked for in them: ext2/3/4, xfs, btrfs, vfat, ntfs, swap, reiserfs, jfs, iso9660, squashfs, then the GPT and MBR partition tables.
+The result uses the names of the blkid tags: TYPE, LABEL, UUID for a filesystem, PTTYPE, PTUUID for a partition table.
+md RAID members, LVM physical volumes and LUKS volumes are not recognized, so that they are left to blkid: the filesystem found at the start of a RAID1 member is the one of its array.
+Functions:
+  - probeDevice
+  - getPartitionTable
+  - isExtendedBootRecord
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2011-2013, Salix OS'
+__license__ = 'GPL2+'
+import os
+import uuid
+import struct
+from collections import namedtuple
+
+_probeSize = 0x10000 + 0x1000 # btrfs and reiserfs superblocks are at 64 KiB, swap signature can be at the end of a 64 KiB page
+_sectorSizes = (512, 4096)
+_extendedTypes = (0x05, 0x0f, 0x85)
+_maxLogicalPartitions = 128
+_mdMagic = 0xa92b4efc
+_gptFlags = {
+    'c12a7328-f81f-11d2-ba4b-00a0c93ec93b':'esp',
+    '21686148-6449-6e6f-744e-656564454649':'bios_grub',
+  }
+
+# 'number' is the partition number as used by the kernel, 'start' and 'size' are in sectors of 'sectorSize'
+PartitionEntry = namedtuple('PartitionEntry', ['number', 'start', 'size', 'type', 'uuid', 'name', 'flags'])
+PartitionTable = namedtuple('PartitionTable', ['type', 'uuid', 'sectorSize', 'entries'])
+
+def _read(path, offset, size):
+  """
+  Returns up to 'size' bytes of 'path' at 'offset', or None if it cannot be read.
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return None
+  try:
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+    while size > 0:
+      chunk = os.read(fd, size)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      size -= len(chunk)
+    return b''.join(chunks)
+  except OSError:
+    return None
+  finally:
+    os.close(fd)
+
+def _size(path):
+  """
+  Returns the size of the device or file 'path', or None if it cannot be read.
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return None
+  try:
+    return os.lseek(fd, 0, os.SEEK_END)
+  except OSError:
+    return None
+  finally:
+    os.close(fd)
+
+def _unpack(fmt, data, offset):
+  """
+  Returns the unpacked values, or None if 'data' is too short.
+  """
+  size = struct.calcsize(fmt)
+  if len(data) < offset + size:
+    return None
+  return struct.unpack(fmt, data[offset:offset + size])
+
+def _bytes(data, offset, size):
+  if len(data) < offset + size:
+    return None
+  return data[offset:offset + size]
+
+def _label(raw, encoding = 'utf-8'):
+  if raw is None:
+    return ''
+  return raw.split(b'\0', 1)[0].decode(encoding, 'replace').rstrip(' ')
+
+def _uuid(raw):
+  if not raw or raw == b'\0' * len(raw):
+    return None
+  return unicode(uuid.UUID(bytes = raw))
+
+def _tags(fsType, label = None, uuid = None):
+  tags = {'TYPE':fsType}
+  if label:
+    tags['LABEL'] = label
+  if uuid:
+    tags['UUID'] = uuid
+  return tags
+
+def _probeExt(data, path):
+  (magic,) = _unpack(b'<H', data, 1024 + 56) or (None,)
+  if magic != 0xEF53:
+    return None
+  (compat, incompat, roCompat) = _unpack(b'<III', data, 1024 + 92)
+  if incompat & 0x0008: # journal device
+    fsType = 'jbd'
+  elif (incompat & ~0x0016) or (roCompat & ~0x0007): # features unknown to ext3
+    fsType = 'ext4'
+  elif compat & 0x0004: # has journal
+    fsType = 'ext3'
+  else:
+    fsType = 'ext2'
+  return _tags(fsType, _label(_bytes(data, 1024 + 120, 16)), _uuid(_bytes(data, 1024 + 104, 16)))
+
+def _probeXfs(data, path):
+  if _bytes(data, 0, 4) != b'XFSB':
+    return None
+  return _tags('xfs', _label(_bytes(data, 108, 12)), _uuid(_bytes(data, 32, 16)))
+
+def _probeBtrfs(data, path):
+  offset = 0x10000
+  if _bytes(data, offset + 0x40, 8) != b'_BHRfS_M':
+    return None
+  return _tags('btrfs', _label(_bytes(data, offset + 0x12b, 256)), _uuid(_bytes(data, offset + 0x20, 16)))
+
+def _probeReiserfs(data, path):
+  for offset in (0x10000, 0x2000):
+    magic = _bytes(data, offset + 52, 10) or b''
+    if magic.startswith(b'ReIsErFs'):
+      return _tags('reiserfs')
+    elif magic.startswith(b'ReIsEr2Fs') or magic.startswith(b'ReIsEr3Fs'):
+      return _tags('reiserfs', _label(_bytes(data, offset + 100, 16)), _uuid(_bytes(data, offset + 84, 16)))
+  return None
+
+def _probeJfs(data, path):
+  offset = 0x8000
+  if _bytes(data, offset, 4) != b'JFS1':
+    return None
+  return _tags('jfs', _label(_bytes(data, offset + 152, 16)), _uuid(_bytes(data, offset + 136, 16)))
+
+def _probeSwap(data, path):
+  for pageSize in (4096, 8192, 16384, 65536):
+    magic = _bytes(data, pageSize - 10, 10)
+    if magic == b'SWAPSPACE2':
+      return _tags('swap', _label(_bytes(data, 1024 + 28, 16)), _uuid(_bytes(data, 1024 + 12, 16)))
+    elif magic == b'SWAP-SPACE':
+      return _tags('swap')
+  return None
+
+def _readNtfsLabel(data, path):
+  """
+  The label is the $VOLUME_NAME attribute of the $Volume file, the fourth record of the MFT.
+  """
+  values = _unpack(b'<HB', data, 0x0B)
+  mftCluster = _unpack(b'<Q', data, 0x30)
+  clustersPerRecord = _unpack(b'<b', data, 0x40)
+  if not (values and mftCluster and clustersPerRecord):
+    return ''
+  (bytesPerSector, sectorsPerCluster) = values
+  if sectorsPerCluster > 0x80:
+    sectorsPerCluster = 1 << (256 - sectorsPerCluster)
+  clusterSize = bytesPerSector * sectorsPerCluster
+  if clustersPerRecord[0] > 0:
+    recordSize = clustersPerRecord[0] * clusterSize
+  else:
+    recordSize = 1 << -clustersPerRecord[0]
+  if not clusterSize or recordSize > 65536:
+    return ''
+  record = _read(path, mftCluster[0] * clusterSize + 3 * recordSize, recordSize)
+  if not record or len(record) < recordSize or record[0:4] != b'FILE':
+    return ''
+  record = bytearray(record)
+  (usaOffset, usaCount) = struct.unpack(b'<HH', bytes(record[4:8]))
+  for i in range(1, usaCount): # update sequence: the last 2 bytes of each sector are saved in the array
+    end = i * bytesPerSector
+    if end <= len(record) and usaOffset + 2 * i + 2 <= len(record):
+      record[end - 2:end] = record[usaOffset + 2 * i:usaOffset + 2 * i + 2]
+  record = bytes(record)
+  (offset,) = struct.unpack(b'<H', record[0x14:0x16])
+  while offset + 24 <= len(record):
+    (attrType, length) = struct.unpack(b'<II', record[offset:offset + 8])
+    if attrType == 0xFFFFFFFF or length == 0:
+      break
+    if attrType == 0x60 and record[offset + 8:offset + 9] == b'\0': # resident $VOLUME_NAME
+      (valueLength, valueOffset) = struct.unpack(b'<IH', record[offset + 16:offset + 22])
+      return record[offset + valueOffset:offset + valueOffset + valueLength].decode('utf-16-le', 'replace')
+    offset += length
+  return ''
+
+def _probeNtfs(data, path):
+  if _bytes(data, 3, 8) != b'NTFS    ':
+    return None
+  (serial,) = _unpack(b'<Q', data, 0x48)
+  return _tags('ntfs', _readNtfsLabel(data, path), '{0:016X}'.format(serial))
+
+def _probeVfat(data, path):
+  if _bytes(data, 510, 2) != b'\x55\xaa':
+    return None
+  if _bytes(data, 82, 5) == b'FAT32':
+    (serialOffset, labelOffset) = (67, 71)
+  elif _bytes(data, 54, 3) == b'FAT':
+    (serialOffset, labelOffset) = (39, 43)
+  else:
+    return None
+  (serial,) = _unpack(b'<I', data, serialOffset)
+  label = _label(_bytes(data, labelOffset, 11), 'cp437')
+  if label == 'NO NAME':
+    label = ''
+  return _tags('vfat', label, '{0:04X}-{1:04X}'.format(serial >> 16, serial & 0xFFFF))
+
+def _probeIso9660(data, path):
+  offset = 0x8000
+  if _bytes(data, offset + 1, 5) != b'CD001':
+    return None
+  date = _bytes(data, offset + 813, 16) or b''
+  uuid = None
+  if date.isdigit() and date != b'0' * 16: # creation date, as blkid does
+    date = date.decode('ascii')
+    uuid = '-'.join([date[0:4]] + [date[i:i + 2] for i in range(4, 16, 2)])
+  return _tags('iso9660', _label(_bytes(data, offset + 40, 32)), uuid)
+
+def _probeSquashfs(data, path):
+  if _bytes(data, 0, 4) != b'hsqs':
+    return None
+  return _tags('squashfs')
+
+_filesystemProbes = [_probeExt, _probeXfs, _probeBtrfs, _probeReiserfs, _probeJfs, _probeSwap, _probeNtfs, _probeVfat, _probeIso9660, _probeSquashfs]
+
+def _parseGpt(data, path):
+  for sectorSize in _sectorSizes:
+    header = _bytes(data, sectorSize, 92)
+    if not header or header[0:8] != b'EFI PART':
+      continue
+    diskUuid = unicode(uuid.UUID(bytes_le = header[56:72]))
+    (entriesLba, count, entrySize) = struct.unpack(b'<QII', header[72:88])
+    if entrySize < 128 or count > 4096:
+      return None
+    offset = entriesLba * sectorSize
+    size = count * entrySize
+    if offset + size <= len(data):
+      raw = data[offset:offset + size]
+    else:
+      raw = _read(path, offset, size) or b''
+    entries = []
+    for i in range(min(count, len(raw) // entrySize)):
+      entry = raw[i * entrySize:i * entrySize + entrySize]
+      if entry[0:16] == b'\0' * 16:
+        continue
+      partType = unicode(uuid.UUID(bytes_le = entry[0:16]))
+      (first, last, attributes) = struct.unpack(b'<QQQ', entry[32:56])
+      flags = set()
+      if attributes & 0x4: # legacy BIOS bootable
+        flags.add('boot')
+      if partType in _gptFlags:
+        flags.add(_gptFlags[partType])
+      entries.append(PartitionEntry(i + 1, first, last - first + 1, partType, unicode(uuid.UUID(bytes_le = entry[16:32])), entry[56:128].decode('utf-16-le', 'replace').split('\0', 1)[0], frozenset(flags)))
+    return PartitionTable('gpt', diskUuid, sectorSize, entries)
+  return None
+
+def _mbrEntries(sector):
+  """
+  Returns the list of (index, boot flag, type, start, size) of the four entries of a MBR or EBR sector, or None if it does not look like one.
+  """
+  if len(sector) < 512 or sector[510:512] != b'\x55\xaa':
+    return None
+  entries = []
+  for i in range(4):
+    (flag, partType, start, size) = struct.unpack(b'<B3xB3xII', sector[446 + 16 * i:462 + 16 * i])
+    if flag not in (0x00, 0x80):
+      return None
+    entries.append((i, flag, partType, start, size))
+  return entries
+
+def _mbrEntry(diskId, number, flag, partType, start, size, logical = False):
+  flags = set()
+  if flag == 0x80:
+    flags.add('boot')
+  if partType in _extendedTypes:
+    flags.add('extended')
+  elif partType == 0xef:
+    flags.add('esp')
+  if logical:
+    flags.add('logical')
+  return PartitionEntry(number, start, size, '0x{0:x}'.format(partType), '{0:08x}-{1:02x}'.format(diskId, number), '', frozenset(flags))
+
+def _parseEbrChain(path, diskId, extendedStart, sectorSize):
+  """
+  Returns the logical partitions, numbered from 5, of the chain of extended boot records starting at sector 'extendedStart'.
+  The logical partition of each record is relative to the record, the link to the next one is relative to the extended partition.
+  """
+  entries = []
+  seen = set()
+  ebr = extendedStart
+  while ebr not in seen and len(entries) < _maxLogicalPartitions:
+    seen.add(ebr)
+    records = _mbrEntries(_read(path, ebr * sectorSize, 512) or b'')
+    if records is None:
+      break
+    (logical, link) = records[0:2]
+    if logical[2] and logical[4]:
+      entries.append(_mbrEntry(diskId, 5 + len(entries), logical[1], logical[2], ebr + logical[3], logical[4], True))
+    if link[2] not in _extendedTypes or not link[3]:
+      break
+    ebr = extendedStart + link[3]
+  return entries
+
+def _parseMbr(data, path, sectorSize):
+  records = _mbrEntries(data[0:512])
+  if records is None or not [r for r in records if r[2]]:
+    return None
+  (diskId,) = struct.unpack(b'<I', data[440:444])
+  entries = []
+  logical = []
+  for (i, flag, partType, start, size) in records:
+    if partType:
+      entries.append(_mbrEntry(diskId, i + 1, flag, partType, start, size))
+      if partType in _extendedTypes and not logical and start:
+        logical = _parseEbrChain(path, diskId, start, sectorSize)
+  return PartitionTable('dos', '{0:08x}'.format(diskId), sectorSize, entries + logical)
+
+def isExtendedBootRecord(data):
+  """
+  Returns True if 'data', the start of a device, is an extended boot record: a partition table without boot code nor disk signature, with the entry of a logical partition and at most the link to the next one.
+  """
+  entries = _mbrEntries(data[0:512])
+  if entries is None or data[0:446].strip(b'\0'):
+    return False
+  used = [e for e in entries if e[2]]
+  return 0 < len(used) <= 2 and not [e for e in entries[2:] if e[2]] and entries[0][2] not in _extendedTypes and entries[1][2] in (0,) + _extendedTypes
+
+def getPartitionTable(path, data = None, sectorSize = 512):
+  """
+  Returns the PartitionTable (type: gpt or dos, uuid, sectorSize, entries) of the disk 'path', or None if it has none.
+  The entries are PartitionEntry (number, start, size, type, uuid, name, flags) ordered by number:
+    - type is the type GUID for gpt, the type byte as '0x83' for dos, as blkid reports them in PART_ENTRY_TYPE
+    - uuid is the PARTUUID
+    - name is only set for gpt
+    - flags is a set of 'boot' (active, or legacy BIOS bootable), 'esp' (EFI system partition), 'bios_grub' (BIOS boot partition), 'extended', 'logical'
+  The logical partitions of a dos table are read by following the chain of extended boot records.
+  'data' is the start of the device if it has already been read, 'sectorSize' is its logical sector size, the unit of a dos table.
+  """
+  if data is None:
+    data = _read(path, 0, _probeSize)
+    if data is None:
+      return None
+  return _parseGpt(data, path) or _parseMbr(data, path, sectorSize)
+
+def _isMdMagic(raw):
+  """
+  The md superblock is in the byte order of the host for the 0.90 metadata, little endian for 1.x.
+  """
+  return raw is not None and len(raw) == 4 and _mdMagic in struct.unpack(b'<I', raw) + struct.unpack(b'>I', raw)
+
+def _isVolumeMember(data, path):
+  """
+  Returns True if 'path' is a md RAID member, a LVM physical volume or a LUKS volume.
+  The md 0.90 and 1.0 superblocks are at the end of the device, they are read from there.
+  """
+  if _bytes(data, 0, 6) == b'LUKS\xba\xbe':
+    return True
+  for offset in (0, 512, 1024, 1536): # LVM2 label in one of the first four sectors
+    if _bytes(data, offset, 8) == b'LABELONE' and _bytes(data, offset + 24, 8) == b'LVM2 001':
+      return True
+  if _isMdMagic(_bytes(data, 0, 4)) or _isMdMagic(_bytes(data, 4096, 4)): # md 1.1 and 1.2
+    return True
+  size = _size(path)
+  if size >= 0x20000 and _isMdMagic(_read(path, (size & ~0xFFFF) - 0x10000, 4)): # md 0.90: last 64 KiB aligned block
+    return True
+  if size >= 0x3000 and _isMdMagic(_read(path, ((size // 512 - 16) & ~7) * 512, 4)): # md 1.0: 8 to 12 KiB from the end, 4 KiB aligned
+    return True
+  return False
+
+def _probe(data, path, table):
+  for probe in _filesystemProbes:
+    tags = probe(data, path)
+    if tags:
+      return tags
+  if table is False:
+    table = getPartitionTable(path, data)
+  if table:
+    tags = {'PTTYPE':table.type}
+    if table.uuid.strip('0-'): # an extended boot record has no disk identifier
+      tags['PTUUID'] = table.uuid
+    return tags
+  return {}
+
+def probeDevice(path, table = False):
+  """
+  Returns the blkid tags of the device or file 'path': TYPE, LABEL and UUID if it has a known filesystem, else PTTYPE and PTUUID if it has a partition table.
+  Returns an empty dictionary if nothing is recognized, or if it is a md RAID member, a LVM physical volume or a LUKS volume, and None if the device cannot be read.
+  'table' is the partition table of 'path' if it has already been read (None if it has none), else it is read with 512 bytes sectors.
+  """
+  data = _read(path, 0, _probeSize)
+  if data is None:
+    return None
+  tags = _probe(data, path, table)
+  if tags and _isVolumeMember(data, path):
+    return {}
+  return tags
+
+# Unit test
+if __name__ == '__main__':
+  from assertPlus import *
+  import shutil
+  import tempfile
+  import subprocess
+  tmp = tempfile.mkdtemp()
+  def image(name, chunks, size = _probeSize):
+    path = os.path.join(tmp, name)
+    data = bytearray(size)
+    for (offset, raw) in chunks:
+      data[offset:offset + len(raw)] = raw
+    open(path, 'wb').write(bytes(data))
+    return path
+  fsUuid = uuid.UUID('0123abcd-4567-89ef-0123-456789abcdef')
+  assertEquals({'TYPE':'xfs', 'LABEL':'test_xfs', 'UUID':unicode(fsUuid)}, probeDevice(image('xfs', [(0, b'XFSB'), (32, fsUuid.bytes), (108, b'test_xfs')])))
+  assertEquals({'TYPE':'btrfs', 'LABEL':'test_btrfs', 'UUID':unicode(fsUuid)}, probeDevice(image('btrfs', [(0x10040, b'_BHRfS_M'), (0x10020, fsUuid.bytes), (0x1012b, b'test_btrfs')])))
+  assertEquals({'TYPE':'reiserfs', 'LABEL':'test_reiserfs', 'UUID':unicode(fsUuid)}, probeDevice(image('reiserfs', [(0x10034, b'ReIsEr2Fs'), (0x10054, fsUuid.bytes), (0x10064, b'test_reiserfs')])))
+  assertEquals({'TYPE':'jfs', 'LABEL':'test_jfs', 'UUID':unicode(fsUuid)}, probeDevice(image('jfs', [(0x8000, b'JFS1'), (0x8088, fsUuid.bytes), (0x8098, b'test_jfs')])))
+  assertEquals({'TYPE':'vfat', 'LABEL':'TEST_FAT32', 'UUID':'1234-ABCD'}, probeDevice(image('fat32', [(67, struct.pack(b'<I', 0x1234ABCD)), (71, b'TEST_FAT32 '), (82, b'FAT32   '), (510, b'\x55\xaa')])))
+  assertEquals({'TYPE':'vfat', 'UUID':'1234-ABCD'}, probeDevice(image('fat16', [(39, struct.pack(b'<I', 0x1234ABCD)), (43, b'NO NAME    '), (54, b'FAT16   '), (510, b'\x55\xaa')])))
+  assertEquals({'TYPE':'iso9660', 'LABEL':'SALIX', 'UUID':'2013-12-11-10-20-30-00'}, probeDevice(image('iso', [(0x8001, b'CD001'), (0x8028, b'SALIX' + b' ' * 27), (0x8000 + 813, b'2013121110203000')])))
+  # ntfs: 512 bytes per sector, 8 sectors per cluster, MFT at cluster 2, 1 KiB records
+  record = bytearray(1024)
+  record[0:4] = b'FILE'
+  record[4:8] = struct.pack(b'<HH', 48, 3)
+  record[48:54] = b'\x01\x00\xaa\xaa\xbb\xbb' # update sequence number, then the saved end of each sector
+  record[510:512] = b'\x01\x00'
+  record[1022:1024] = b'\x01\x00'
+  record[0x14:0x16] = struct.pack(b'<H', 56)
+  name = 'test_ntfs'.encode('utf-16-le')
+  record[56:80] = struct.pack(b'<IIBBHHHIH2x', 0x60, 24 + len(name) + 6, 0, 0, 0, 0, 0, len(name), 24)
+  record[80:80 + len(name)] = name
+  record[86 + len(name):90 + len(name)] = b'\xff\xff\xff\xff'
+  ntfs = image('ntfs', [(3, b'NTFS    '), (0x0B, struct.pack(b'<HB', 512, 8)), (0x30, struct.pack(b'<Q', 2)), (0x40, struct.pack(b'<b', -10)), (0x48, struct.pack(b'<Q', 0x0123456789ABCDEF)), (510, b'\x55\xaa'), (2 * 4096 + 3 * 1024, bytes(record))])
+  assertEquals({'TYPE':'ntfs', 'LABEL':'test_ntfs', 'UUID':'0123456789ABCDEF'}, probeDevice(ntfs))
+  mbr = image('mbr', [(440, struct.pack(b'<I', 0xdeadbeef)), (446, struct.pack(b'<B3xB3xII', 0x80, 0x83, 2048, 4096)), (462, struct.pack(b'<B3xB3xII', 0, 0x05, 6144, 8192)), (510, b'\x55\xaa')])
+  assertEquals({'PTTYPE':'dos', 'PTUUID':'deadbeef'}, probeDevice(mbr))
+  assertEquals({'PTTYPE':'dos', 'PTUUID':'deadbeef'}, probeDevice(mbr, table = getPartitionTable(mbr)))
+  assertEquals({}, probeDevice(mbr, table = None))
+  assertEquals([PartitionEntry(1, 2048, 4096, '0x83', 'deadbeef-01', '', frozenset(['boot'])), PartitionEntry(2, 6144, 8192, '0x5', 'deadbeef-02', '', frozenset(['extended']))], getPartitionTable(mbr).entries)
+  # extended partition at sector 64: two logical partitions, the link to the second record is relative to the extended partition
+  logical = image('logical', [(440, struct.pack(b'<I', 0xdeadbeef)), (446, struct.pack(b'<B3xB3xII', 0, 0xef, 1, 63)), (462, struct.pack(b'<B3xB3xII', 0, 0x0f, 64, 64)), (510, b'\x55\xaa'),
+      (64 * 512 + 446, struct.pack(b'<B3xB3xII', 0x80, 0x83, 2, 14)), (64 * 512 + 462, struct.pack(b'<B3xB3xII', 0, 0x05, 16, 48)), (64 * 512 + 510, b'\x55\xaa'),
+      (80 * 512 + 446, struct.pack(b'<B3xB3xII', 0, 0x82, 2, 46)), (80 * 512 + 462, struct.pack(b'<B3xB3xII', 0, 0x05, 0, 0)), (80 * 512 + 510, b'\x55\xaa')])
+  assertEquals([(1, 1, 63, frozenset(['esp'])), (2, 64, 64, frozenset(['extended'])), (5, 66, 14, frozenset(['boot', 'logical'])), (6, 82, 46, frozenset(['logical']))],
+      [(e.number, e.start, e.size, e.flags) for e in getPartitionTable(logical).entries])
+  assertTrue(isExtendedBootRecord(open(logical, 'rb').read()[64 * 512:]))
+  loop = image('loop', [(446, struct.pack(b'<B3xB3xII', 0, 0x05, 1, 8)), (510, b'\x55\xaa'), (512 + 446, struct.pack(b'<B3xB3xII', 0, 0x83, 1, 1)), (512 + 462, struct.pack(b'<B3xB3xII', 0, 0x05, 0, 8)), (1022, b'\x55\xaa')])
+  assertEquals([1, 5], [e.number for e in getPartitionTable(loop).entries]) # a chain looping on itself is read once
+  assertFalse(isExtendedBootRecord(open(mbr, 'rb').read()))
+  assertTrue(isExtendedBootRecord(open(image('ebr', [(446, struct.pack(b'<B3xB3xII', 0, 0x83, 63, 4096)), (510, b'\x55\xaa')]), 'rb').read()))
+  partUuid = uuid.UUID('11111111-2222-3333-4444-555555555555')
+  gpt = image('gpt', [(446, struct.pack(b'<B3xB3xII', 0, 0xee, 1, 0xffffffff)), (510, b'\x55\xaa'),
+      (512, b'EFI PART'), (512 + 56, fsUuid.bytes_le), (512 + 72, struct.pack(b'<QII', 2, 128, 128)),
+      (1024, uuid.UUID('21686148-6449-6e6f-744e-656564454649').bytes_le), (1024 + 16, fsUuid.bytes_le), (1024 + 32, struct.pack(b'<QQQ', 34, 2047, 0)),
+      (1152, uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b').bytes_le), (1152 + 16, partUuid.bytes_le), (1152 + 32, struct.pack(b'<QQQ', 2048, 4095, 0x4)), (1152 + 56, 'EFI System'.encode('utf-16-le'))])
+  assertEquals({'PTTYPE':'gpt', 'PTUUID':unicode(fsUuid)}, probeDevice(gpt))
+  assertEquals([PartitionEntry(1, 34, 2014, '21686148-6449-6e6f-744e-656564454649', unicode(fsUuid), '', frozenset(['bios_grub'])),
+      PartitionEntry(2, 2048, 2048, 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b', unicode(partUuid), 'EFI System', frozenset(['boot', 'esp']))], getPartitionTable(gpt).entries)
+  assertEquals({}, probeDevice(image('empty', [])))
+  # RAID1 members with the ext2 filesystem of the array at their start: md 0.90 and 1.0 superblocks at the end, 1.2 at 4 KiB
+  ext2 = [(1024 + 56, struct.pack(b'<H', 0xEF53))]
+  size = 1024 * 1024
+  assertEquals('ext2', probeDevice(image('ext2', ext2, size))['TYPE'])
+  assertEquals({}, probeDevice(image('md090', ext2 + [(size - 0x10000, struct.pack(b'<I', _mdMagic))], size)))
+  assertEquals({}, probeDevice(image('md10', ext2 + [(size - 0x2000, struct.pack(b'<I', _mdMagic))], size)))
+  assertEquals({}, probeDevice(image('md12', ext2 + [(4096, struct.pack(b'<I', _mdMagic))], size)))
+  assertEquals({}, probeDevice(image('lvm', [(512, b'LABELONE'), (512 + 24, b'LVM2 001')] + ext2)))
+  assertEquals({}, probeDevice(image('luks', [(0, b'LUKS\xba\xbe')] + ext2)))
+  assertEquals(None, probeDevice(os.path.join(tmp, 'missing')))
+  # real filesystems, compared to blkid
+  for (mkfs, fsType) in (('mkfs.ext2', 'ext2'), ('mkfs.ext3', 'ext3'), ('mkfs.ext4', 'ext4'), ('mkswap', 'swap')):
+    path = image(fsType, [], 8 * 1024 * 1024)
+    try:
+      subprocess.check_call([mkfs, '-q', '-L', 'test_' + fsType, path] if mkfs != 'mkswap' else [mkfs, '-L', 'test_' + fsType, path], stdout = open(os.devnull, 'w'), stderr = open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+      continue
+    tags = probeDevice(path)
+    assertEquals(fsType, tags['TYPE'])
+    assertEquals('test_' + fsType, tags['LABEL'])
+    try:
+      assertEquals(subprocess.check_output(['blkid', '-s', 'UUID', '-o', 'value', path]).strip(), tags['UUID'])
+    except (OSError, subprocess.CalledProcessError):
+      pass
+  shutil.rmtree(tmp)
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Benchmark of the discovery and of the bootloader configuration of BootSetup.
+
+A fake computer of N disks × M partitions is built in a private mount namespace:
+  - /proc/partitions, /sys/block, /sys/class/block and /dev are replaced by fake ones,
+  - /sbin/blkid and /bin/mount are replaced by shell stubs, mount only binds a fake root directory per partition,
+  - the os-prober tests are stubs too.
+The real code paths are then run against it, each scenario in its own forked process, and the following are reported:
+  - spawns: number of processes spawned through the salix_livetools_library
+  - calls: number of commands run through the salix_livetools_library
+  - wall: wall time in seconds
+  - maxrss: peak memory of the scenario process in KiB
+Nothing is changed outside of the namespace, but it must be run as root.
+
+Usage: benchmark.py [--disks N] [--partitions M] [--runs R] [--json]
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import sys
+import atexit
+import json
+import ctypes
+import codecs
+import getopt
+import shutil
+import resource
+import tempfile
+import uuid
+from time import time
+from stat import *
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import gettext
+gettext.install('bootsetup', unicode = True)
+import salix_livetools_library as sltl
+
+CLONE_NEWNS = 0x00020000
+FAKE_MAJOR = 240 # local/experimental block major, not used by real disks
+SECTORS = 2 * 1024 * 1024 # 1 GiB per partition
+
+_blkidStub = """#!/bin/sh
+# blkid stub: -c, -s TAG, -o value|export [device...]
+db={db}
+tag=
+fmt=full
+devs=
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -c) shift ;;
+    -s) shift; tag=$1 ;;
+    -o) shift; fmt=$1 ;;
+    *) devs="$devs $1" ;;
+  esac
+  shift
+done
+if [ -z "$devs" ]; then
+  for f in $db/*; do
+    echo "DEVNAME=/dev/${{f##*/}}"
+    cat $f
+    echo
+  done
+  exit 0
+fi
+set -- $devs
+if [ -z "$tag" ] && [ "$fmt" = export ]; then
+  found=2
+  for dev in "$@"; do
+    f=$db/${{dev#/dev/}}
+    [ -f "$f" ] || continue
+    echo "DEVNAME=$dev"
+    cat $f
+    echo
+    found=0
+  done
+  exit $found
+fi
+f=$db/${{1#/dev/}}
+[ -f "$f" ] || exit 2
+if [ -n "$tag" ]; then
+  v=$(sed -n "s/^$tag=//p" $f)
+  [ -n "$v" ] || exit 2
+  if [ "$fmt" = value ]; then echo "$v"; else echo "$tag=$v"; fi
+else
+  cat $f
+fi
+"""
+
+_mountStub = """#!/bin/sh
+# mount stub: binds are done for real, a partition is replaced by its fake root directory
+case " $* " in
+  *bind*) exec {realMount} "$@" ;;
+esac
+prev=
+last=
+for a in "$@"; do
+  prev=$last
+  last=$a
+done
+root={roots}/${{prev#/dev/}}
+if [ -d "$root" ]; then
+  exec {realMount} --bind "$root" "$last"
+fi
+echo "mount: $prev: can't read superblock" >&2
+exit 32
+"""
+
+_linuxTest = """#!/bin/sh
+[ -e "$2/etc/slackware-version" ] || exit 1
+echo "$1:$(cat $2/etc/slackware-version):Salix:linux"
+"""
+
+_windowsTest = """#!/bin/sh
+[ -e "$2/bootmgr" ] || exit 1
+echo "$1:Windows 7 (loader):Windows:chain"
+"""
+
+_failTest = """#!/bin/sh
+exit 1
+"""
+
+def _write(path, content, mode = None):
+  d = os.path.dirname(path)
+  if not os.path.isdir(d):
+    os.makedirs(d)
+  with open(path, 'w') as f:
+    f.write(content.encode('utf-8'))
+  if mode:
+    os.chmod(path, mode)
+
+def _diskName(i):
+  """
+  sda…sdz, sdaa…
+  """
+  letters = 'abcdefghijklmnopqrstuvwxyz'
+  name = ''
+  i += 1
+  while i > 0:
+    i, r = divmod(i - 1, 26)
+    name = letters[r] + name
+  return 'sd' + name
+
+def _partitionKind(j):
+  return ('linux', 'windows', 'data')[(j - 1) % 3]
+
+class FakeSystem:
+  """
+  Fake /proc, /sys, /dev and commands, in a private mount namespace.
+  """
+
+  def __init__(self, nbDisks, nbPartitions):
+    self.nbDisks = nbDisks
+    self.nbPartitions = nbPartitions
+    self.dir = tempfile.mkdtemp(prefix = 'bootsetup.bench-')
+    self.disks = []
+    self.partitions = [] # (device, disk, kind, minor)
+
+  def cleanup(self):
+    os.chdir('/')
+    sltl.execCall(['/bin/umount', '-l', self.dir], shell = False)
+    try:
+      os.rmdir(self.dir)
+    except OSError:
+      pass
+
+  def _mount(self, *args):
+    if sltl.execCall(['/bin/mount'] + list(args), shell = False) != 0:
+      raise Exception("Cannot mount {0}".format(' '.join(args)))
+
+  def setup(self):
+    libc = ctypes.CDLL(None, use_errno = True)
+    if libc.unshare(CLONE_NEWNS) != 0:
+      raise OSError(ctypes.get_errno(), "unshare: " + os.strerror(ctypes.get_errno()))
+    self._mount('--make-rprivate', '/')
+    # everything created here disappears with the namespace
+    self._mount('-t', 'tmpfs', 'bench', self.dir)
+    shutil.copy('/bin/mount', os.path.join(self.dir, 'real-mount'))
+    self._buildTrees()
+    self._mount('--bind', os.path.join(self.dir, 'proc/partitions'), '/proc/partitions')
+    self._mount('--bind', os.path.join(self.dir, 'sys/block'), '/sys/block')
+    self._mount('--bind', os.path.join(self.dir, 'sys/class/block'), '/sys/class/block')
+    self._mount('--bind', os.path.join(self.dir, 'bin/blkid'), '/sbin/blkid')
+    self._mount('-t', 'tmpfs', 'benchdev', '/dev')
+    self._buildDev()
+    self._mount('--bind', os.path.join(self.dir, 'bin/mount'), '/bin/mount')
+
+  def _buildTrees(self):
+    d = self.dir
+    procLines = ['major minor  #blocks  name', '']
+    minor = 0
+    for i in range(self.nbDisks):
+      disk = _diskName(i)
+      self.disks.append((disk, minor))
+      procLines.append('{0:4d} {1:7d} {2:10d} {3}'.format(FAKE_MAJOR, minor, SECTORS * self.nbPartitions / 2, disk))
+      sysDisk = os.path.join(d, 'sys/block', disk)
+      _write(os.path.join(sysDisk, 'size'), '{0}\n'.format(SECTORS * self.nbPartitions))
+      _write(os.path.join(sysDisk, 'removable'), '0\n')
+      _write(os.path.join(sysDisk, 'device/model'), 'BENCH{0:03d}\n'.format(i))
+      _write(os.path.join(sysDisk, 'queue/logical_block_size'), '512\n')
+      os.symlink('../../block/{0}'.format(disk), os.path.join(self._classDir(), disk))
+      _write(os.path.join(d, 'blkid', disk), 'PTUUID={0}\nPTTYPE=dos\n'.format(uuid.uuid5(uuid.NAMESPACE_DNS, disk.encode('utf-8')).hex[:8]))
+      minor += 1
+      for j in range(1, self.nbPartitions + 1):
+        part = '{0}{1}'.format(disk, j)
+        kind = _partitionKind(j)
+        self.partitions.append((part, disk, kind, minor))
+        procLines.append('{0:4d} {1:7d} {2:10d} {3}'.format(FAKE_MAJOR, minor, SECTORS / 2, part))
+        _write(os.path.join(sysDisk, part, 'partition'), '{0}\n'.format(j))
+        _write(os.path.join(sysDisk, part, 'size'), '{0}\n'.format(SECTORS))
+        os.symlink('../../block/{0}/{1}'.format(disk, part), os.path.join(self._classDir(), part))
+        fstype = kind == 'windows' and 'ntfs' or 'ext4'
+        _write(os.path.join(d, 'blkid', part), 'UUID={0}\nTYPE={1}\nLABEL={2}\n'.format(uuid.uuid5(uuid.NAMESPACE_DNS, part.encode('utf-8')), fstype, part.upper()))
+        self._buildRoot(part, kind)
+        minor += 1
+    _write(os.path.join(d, 'proc/partitions'), '\n'.join(procLines) + '\n')
+    _write(os.path.join(d, 'bin/blkid'), _blkidStub.format(db = os.path.join(d, 'blkid')), 0755)
+    _write(os.path.join(d, 'bin/mount'), _mountStub.format(realMount = os.path.join(d, 'real-mount'), roots = os.path.join(d, 'roots')), 0755)
+    probes = os.path.join(d, 'os-probes')
+    os.makedirs(os.path.join(probes, 'init'))
+    _write(os.path.join(probes, '05efi'), _failTest, 0755)
+    _write(os.path.join(probes, 'mounted/20microsoft'), _windowsTest, 0755)
+    _write(os.path.join(probes, 'mounted/90linux-distro'), _linuxTest, 0755)
+
+  def _classDir(self):
+    path = os.path.join(self.dir, 'sys/class/block')
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    return path
+
+  def _buildRoot(self, part, kind):
+    root = os.path.join(self.dir, 'roots', part)
+    for sub in ('dev', 'proc', 'sys', 'boot'):
+      os.makedirs(os.path.join(root, sub))
+    if kind == 'linux':
+      _write(os.path.join(root, 'etc/slackware-version'), 'Salix 14.1\n')
+      _write(os.path.join(root, 'etc/fstab'), '/dev/{0} / ext4 defaults 1 1\n'.format(part))
+      _write(os.path.join(root, 'etc/default/grub'), 'GRUB_TIMEOUT=5\n')
+      for version in ('3.10.17', '3.12.6'):
+        _write(os.path.join(root, 'boot/vmlinuz-{0}'.format(version)), 'kernel')
+        _write(os.path.join(root, 'boot/initrd-{0}.gz'.format(version)), 'initrd')
+    elif kind == 'windows':
+      _write(os.path.join(root, 'bootmgr'), 'bootmgr')
+
+  def _buildDev(self):
+    for name, major, minor in (('null', 1, 3), ('zero', 1, 5), ('full', 1, 7), ('random', 1, 8), ('urandom', 1, 9), ('tty', 5, 0)):
+      os.mknod(os.path.join('/dev', name), S_IFCHR | 0666, os.makedev(major, minor))
+    os.mkdir('/dev/shm')
+    os.symlink('/proc/self/fd', '/dev/fd')
+    for disk, minor in self.disks:
+      os.mknod(os.path.join('/dev', disk), S_IFBLK | 0660, os.makedev(FAKE_MAJOR, minor))
+    for part, disk, kind, minor in self.partitions:
+      os.mknod(os.path.join('/dev', part), S_IFBLK | 0660, os.makedev(FAKE_MAJOR, minor))
+
+  def lilo_partitions(self):
+    """
+    Boot partitions in the format of Lilo: [device, filesystem, boot type, label]
+    """
+    partitions = []
+    for n, (part, disk, kind, minor) in enumerate(self.partitions):
+      if kind == 'linux':
+        partitions.append([part, 'ext4', 'linux', 'Salix{0}'.format(n)])
+      elif kind == 'windows':
+        partitions.append([part, 'ntfs', 'chain', 'Windows{0}'.format(n)])
+    return partitions
+
+def _discovery(fake, rescan):
+  from config import Config
+  Config(None, None, False, False, rescan)
+
+def scenario_discovery(fake):
+  _discovery(fake, True)
+
+def scenario_discovery_cached(fake):
+  _discovery(fake, False)
+
+def scenario_lilo_config(fake):
+  from lilo import Lilo
+  lilo = Lilo(False)
+  lilo.createConfiguration(fake.disks[0][0], fake.partitions[0][0], fake.lilo_partitions())
+
+def scenario_lilo_relabel(fake):
+  from lilo import Lilo
+  from mountsession import MountSession
+  # like in the UIs: the partitions stay mounted, then the rows are reordered and relabeled
+  mounts = MountSession(False)
+  lilo = Lilo(False, mounts)
+  partitions = fake.lilo_partitions()
+  lilo.createConfiguration(fake.disks[0][0], partitions[0][0], partitions)
+  partitions = [partitions[0]] + [[p[0], p[1], p[2], 'New' + p[3]] for p in reversed(partitions[1:])]
+  lilo.createConfiguration(fake.disks[0][0], partitions[0][0], partitions)
+  mounts.close()
+
+def scenario_lilo_preview(fake):
+  from lilo import Lilo
+  lilo = Lilo(False)
+  lilo.previewConfiguration(fake.disks[0][0], fake.partitions[0][0], fake.lilo_partitions())
+
+def scenario_grub2_install(fake):
+  from grub2 import Grub2
+  # test mode: grub-install and update-grub are not run
+  Grub2(True).install(fake.disks[0][0], fake.partitions[0][0])
+
+def scenario_lilo_install(fake):
+  from lilo import Lilo
+  # test mode: lilo is run with -t
+  lilo = Lilo(True)
+  lilo.createConfiguration(fake.disks[0][0], fake.partitions[0][0], fake.lilo_partitions())
+  lilo.install()
+
+def scenario_grub2_plans(fake):
+  from grub2 import Grub2
+  # one plan per disk and linux partition, none is executed
+  grub2 = Grub2(False)
+  for disk, minor in fake.disks:
+    for part, d, kind, m in fake.partitions:
+      if kind == 'linux':
+        grub2.planInstall(disk, part).execute(dryRun = True)
+
+_scenarios = [
+    ('discovery', scenario_discovery),
+    ('discovery-cached', scenario_discovery_cached),
+    ('lilo-config', scenario_lilo_config),
+    ('lilo-relabel', scenario_lilo_relabel),
+    ('lilo-preview', scenario_lilo_preview),
+    ('lilo-install', scenario_lilo_install),
+    ('grub2-install', scenario_grub2_install),
+    ('grub2-plans', scenario_grub2_plans),
+  ]
+
+def runScenario(fake, fct):
+  """
+  Runs 'fct' in a forked process, so that every run starts with cold caches and has its own peak memory.
+  Returns a dictionary with spawns, calls, wall, maxrss, commands and error keys.
+  """
+  r, w = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(r)
+    # the code paths print progress and debug messages
+    devnull = os.open('/dev/null', os.O_WRONLY)
+    os.dup2(devnull, 1)
+    sys.stdout = codecs.getwriter('utf-8')(os.fdopen(1, 'w'))
+    os.chdir(fake.dir)
+    result = {'error':None}
+    try:
+      sltl.resetExecStats()
+      start = time()
+      fct(fake)
+      result['wall'] = time() - start
+    except Exception as e:
+      result['wall'] = time() - start
+      result['error'] = unicode(e)
+    # os._exit does not run them, they release the mount sessions
+    atexit._run_exitfuncs()
+    stats = sltl.getExecStats()
+    result['spawns'] = stats['spawns']
+    result['calls'] = stats['calls']
+    result['commands'] = stats['commands']
+    result['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(w, json.dumps(result))
+    os.close(w)
+    os._exit(0)
+  os.close(w)
+  chunks = []
+  while True:
+    chunk = os.read(r, 65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  os.close(r)
+  os.waitpid(pid, 0)
+  if not chunks:
+    return {'error':'the scenario process died', 'wall':0, 'spawns':0, 'calls':0, 'commands':{}, 'maxrss':0}
+  return json.loads(b''.join(chunks))
+
+def runScenarios(fake, runs):
+  report = {'disks':fake.nbDisks, 'partitions':fake.nbPartitions, 'runs':runs, 'scenarios':{}}
+  for name, fct in _scenarios:
+    results = [runScenario(fake, fct) for i in range(runs)]
+    walls = [res['wall'] for res in results]
+    report['scenarios'][name] = {
+        'spawns':results[-1]['spawns'],
+        'calls':results[-1]['calls'],
+        'commands':results[-1]['commands'],
+        'wall':sum(walls) / len(walls),
+        'wallMin':min(walls),
+        'maxrss':max([res['maxrss'] for res in results]),
+        'errors':sorted(set([res['error'] for res in results if res['error']])),
+      }
+  return report
+
+def usage():
+  print __doc__.split('Usage: ')[1].strip()
+
+def main(args):
+  nbDisks = 4
+  nbPartitions = 6
+  runs = 3
+  asJson = False
+  try:
+    opts, args = getopt.getopt(args, 'h', ['help', 'disks=', 'partitions=', 'runs=', 'json'])
+  except getopt.GetoptError as e:
+    sys.stderr.write("{0}\n".format(e))
+    usage()
+    return 1
+  for o, a in opts:
+    if o in ('-h', '--help'):
+      usage()
+      return 0
+    elif o == '--disks':
+      nbDisks = int(a)
+    elif o == '--partitions':
+      nbPartitions = int(a)
+    elif o == '--runs':
+      runs = int(a)
+    elif o == '--json':
+      asJson = True
+  if os.getuid() != 0:
+    sys.stderr.write("Root privileges are required to create the mount namespace.\n")
+    return 1
+  from osprober import OsProber
+  from probecache import ProbeCache
+  fake = FakeSystem(nbDisks, nbPartitions)
+  try:
+    fake.setup()
+    OsProber._probesDir = os.path.join(fake.dir, 'os-probes')
+    ProbeCache._path = os.path.join(fake.dir, 'probes.json')
+    report = runScenarios(fake, runs)
+  finally:
+    fake.cleanup()
+  if asJson:
+    print json.dumps(report, indent = 2, sort_keys = True)
+  else:
+    print "{0} disks x {1} partitions, {2} runs".format(nbDisks, nbPartitions, runs)
+    print "{0:<18} {1:>7} {2:>7} {3:>9} {4:>9} {5:>10}".format('scenario', 'spawns', 'calls', 'wall', 'wall min', 'maxrss KiB')
+    for name, fct in _scenarios:
+      s = report['scenarios'][name]
+      print "{0:<18} {1:>7} {2:>7} {3:>9.3f} {4:>9.3f} {5:>10}".format(name, s['spawns'], s['calls'], s['wall'], s['wallMin'], s['maxrss'])
+      for error in s['errors']:
+        print "  error: " + error
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Benchmark of the copy of a SaLT module: the single 'cp --preserve -r' formerly used against the in-process copy of the salix_livetools_library, with several numbers of workers.
+
+A fake module of D directories × F files is generated, or an existing tree is used with --source.
+Each copy goes to a new directory of the target directory, which should be on the disk to benchmark, and the following are reported:
+  - wall: wall time in seconds, the best of the runs
+  - MiB/s: throughput of the best run
+  - files: entries copied
+With --drop-caches (as root), the page cache is dropped before each run, so that the source is read from the disk.
+
+Usage: copybench.py [--dirs D] [--files F] [--size KiB] [--source DIR] [--target DIR] [--workers 1,2,4,8] [--runs R] [--drop-caches] [--json]
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import sys
+import json
+import getopt
+import shutil
+import tempfile
+import subprocess
+from time import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import salix_livetools_library as sltl
+
+def makeModule(path, dirs, files, size):
+  """
+  Fills 'path' with 'dirs' directories of 'files' files of about 'size' bytes, plus a few symbolic and hard links.
+  """
+  chunk = os.urandom(size)
+  for d in range(dirs):
+    dirPath = os.path.join(path, 'usr', 'share', 'dir{0:03}'.format(d))
+    os.makedirs(dirPath)
+    for f in range(files):
+      with open(os.path.join(dirPath, 'file{0:04}'.format(f)), 'wb') as fd:
+        fd.write(chunk[f % 64:] + chunk[:f % 64])
+    os.symlink('file0000', os.path.join(dirPath, 'symlink'))
+    os.link(os.path.join(dirPath, 'file0000'), os.path.join(dirPath, 'hardlink'))
+
+def dropCaches():
+  subprocess.call(['sync'])
+  with open('/proc/sys/vm/drop_caches', 'w') as f:
+    f.write('3\n')
+
+def runCp(src, dst):
+  subprocess.check_call(['cp', '--preserve', '-r', '-f', '--remove-destination', '{0}/.'.format(src), dst + '/'])
+
+def runCopyTree(workers):
+  def run(src, dst):
+    res = sltl.copyTree(src, dst, workers = workers, links = True)
+    if res.errors:
+      raise Exception("; ".join(res.errors))
+  return run
+
+def measure(name, function, src, target, runs, drop, total):
+  best = None
+  for i in range(runs):
+    dst = tempfile.mkdtemp(prefix = 'copybench-', dir = target)
+    try:
+      if drop:
+        dropCaches()
+      start = time()
+      function(src, dst)
+      elapsed = time() - start
+    finally:
+      shutil.rmtree(dst)
+    if best is None or elapsed < best:
+      best = elapsed
+  return {'case':name, 'wall':best, 'throughput':total[0] / best / 1024 / 1024, 'files':total[1]}
+
+def usage():
+  print __doc__.strip()
+
+def main(args):
+  dirs = 20
+  files = 200
+  size = 64
+  source = None
+  target = None
+  workersList = [1, 2, 4, 8]
+  runs = 3
+  drop = False
+  asJson = False
+  try:
+    (opts, rest) = getopt.getopt(args, 'h', ['help', 'dirs=', 'files=', 'size=', 'source=', 'target=', 'workers=', 'runs=', 'drop-caches', 'json'])
+  except getopt.GetoptError as e:
+    sys.stderr.write("{0}\n".format(e))
+    usage()
+    return 2
+  for (opt, val) in opts:
+    if opt in ('-h', '--help'):
+      usage()
+      return 0
+    elif opt == '--dirs':
+      dirs = int(val)
+    elif opt == '--files':
+      files = int(val)
+    elif opt == '--size':
+      size = int(val)
+    elif opt == '--source':
+      source = val
+    elif opt == '--target':
+      target = val
+    elif opt == '--workers':
+      workersList = [int(w) for w in val.split(',')]
+    elif opt == '--runs':
+      runs = int(val)
+    elif opt == '--drop-caches':
+      drop = True
+    elif opt == '--json':
+      asJson = True
+  generated = None
+  if not source:
+    generated = tempfile.mkdtemp(prefix = 'copybench-module-', dir = target)
+    makeModule(generated, dirs, files, size * 1024)
+    source = generated
+  try:
+    total = sltl.scanTree(source)
+    results = [measure('cp', runCp, source, target, runs, drop, total)]
+    for workers in workersList:
+      results.append(measure('copyTree x{0}'.format(workers), runCopyTree(workers), source, target, runs, drop, total))
+  finally:
+    if generated:
+      shutil.rmtree(generated)
+  if asJson:
+    print json.dumps({'source':source, 'bytes':total[0], 'files':total[1], 'runs':runs, 'dropCaches':drop, 'results':results}, indent = 2, sort_keys = True)
+  else:
+    print "{0} MiB in {1} files, {2} runs{3}".format(total[0] // 1024 // 1024, total[1], runs, drop and ", caches dropped" or "")
+    print "{0:<16} {1:>9} {2:>9}".format('case', 'wall', 'MiB/s')
+    for res in results:
+      print "{0:<16} {1:>8.3f}s {2:>9.1f}".format(res['case'], res['wall'], res['throughput'])
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set et ai sta sw=2 ts=2 tw=0:
+"""
+Startup time of BootSetup and of its backends.
+
+Each case is run in a fresh interpreter, several times, and the following are reported:
+  - import: time spent importing the case in seconds, the best of the runs
+  - process: wall time of the whole interpreter in seconds, the best of the runs
+  - modules: number of modules in sys.modules after the import
+  - sltl: modules of the salix_livetools_library that have been loaded
+  - ui: UI toolkits that have been loaded (gtk, urwid)
+A UI case whose toolkit is not installed is reported as unavailable.
+
+Usage: startup.py [--runs R] [--json]
+"""
+from __future__ import unicode_literals
+
+__copyright__ = 'Copyright 2013-2014, Salix OS'
+__license__ = 'GPL2+'
+
+import os
+import sys
+import json
+import getopt
+import subprocess
+from time import time
+
+_srcDir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+_sltl = 'salix_livetools_library'
+
+# (name, statement, toolkit needed or None)
+_cases = [
+    ('python', 'pass', None),
+    ('launcher --version', "sys.argv = ['bootsetup.py', '--version']\ntry:\n  execfile('bootsetup.py', {'__name__':'__main__', '__file__':'./bootsetup.py'})\nexcept SystemExit:\n  pass", None),
+    ('sltl lazy', 'import {0}'.format(_sltl), None),
+    ('sltl eager', 'from {0} import *'.format(_sltl), None),
+    ('lib.config', 'import lib.config', None),
+    ('lib.lilo', 'import lib.lilo', None),
+    ('lib.grub2', 'import lib.grub2', None),
+    ('lib.bootsetup_batch', 'import lib.bootsetup_batch', None),
+    ('lib.bootsetup_curses', 'import lib.bootsetup_curses', 'urwid'),
+    ('lib.bootsetup_gtk', 'import lib.bootsetup_gtk', 'gtk'),
+  ]
+
+_probe = """
+import sys, json
+from time import time
+sys.path.insert(0, 'lib')
+import gettext
+gettext.install('bootsetup', unicode = True)
+_start = time()
+{statement}
+_elapsed = time() - _start
+sys.stdout.flush()
+sys.__stdout__.write('\\n' + json.dumps({{
+    'import':_elapsed,
+    'modules':len([m for m in sys.modules.values() if m]),
+    'sltl':sorted(set([n.split('.')[-1] for (n, m) in sys.modules.items() if m and n.split('.')[-2:-1] == ['{sltl}']])),
+    'ui':sorted([n for n in ('gtk', 'urwid') if sys.modules.get(n)]),
+  }}) + '\\n')
+"""
+
+def isAvailable(toolkit):
+  """
+  Checks in another interpreter that the toolkit can be imported.
+  """
+  with open(os.devnull, 'w') as null:
+    return subprocess.call([sys.executable, '-c', 'import ' + toolkit], stdout = null, stderr = null) == 0
+
+def measure(statement, runs):
+  """
+  Returns the measures of the best run of 'statement' in a fresh interpreter, or None if it fails.
+  """
+  best = None
+  code = _probe.format(statement = statement, sltl = _sltl)
+  for i in range(runs):
+    start = time()
+    p = subprocess.Popen([sys.executable, '-c', code], cwd = _srcDir, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    (out, err) = p.communicate()
+    process = time() - start
+    if p.returncode != 0:
+      sys.stderr.write(err)
+      return None
+    res = json.loads(out.strip().splitlines()[-1])
+    res['process'] = process
+    if best is None or res['process'] < best['process']:
+      best = res
+  return best
+
+def usage():
+  print __doc__.strip()
+
+def main(args):
+  runs = 5
+  asJson = False
+  try:
+    (opts, rest) = getopt.getopt(args, 'h', ['help', 'runs=', 'json'])
+  except getopt.GetoptError as e:
+    sys.stderr.write("{0}\n".format(e))
+    usage()
+    return 2
+  for (opt, val) in opts:
+    if opt in ('-h', '--help'):
+      usage()
+      return 0
+    elif opt == '--runs':
+      runs = int(val)
+    elif opt == '--json':
+      asJson = True
+  results = []
+  for (name, statement, toolkit) in _cases:
+    if toolkit and not isAvailable(toolkit):
+      results.append({'case':name, 'available':False})
+      continue
+    res = measure(statement, runs)
+    if res is None:
+      results.append({'case':name, 'available':True, 'failed':True})
+      continue
+    res['case'] = name
+    res['available'] = True
+    results.append(res)
+  if asJson:
+    print json.dumps({'runs':runs, 'results':results}, indent = 2, sort_keys = True)
+  else:
+    print "{0:<22} {1:>9} {2:>9} {3:>8} {4:>5}  {5}".format('case', 'import', 'process', 'modules', 'sltl', 'ui')
+    for res in results:
+      if not res['available']:
+        print "{0:<22} unavailable".format(res['case'])
+      elif res.get('failed'):
+        print "{0:<22} failed".format(res['case'])
+      else:
+        print "{0:<22} {1:>8.4f}s {2:>8.4f}s {3:>8} {4:>5}  {5}".format(res['case'], res['import'], res['process'], res['modules'], len(res['sltl']), ", ".join(res['ui']) or '-')
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))